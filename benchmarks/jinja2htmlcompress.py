@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+HTML 压缩扩展对大模板的编译耗时与输出大小，对比改动前后的实现
+
+    python benchmarks/jinja2htmlcompress.py [重复块数] [编译次数]
+
+- 旧实现：逐个 data token 用正则切分标签，每段文本检查 stack 中是否有
+  isolated 元素，属性和注释不处理，由模块的 enabled 开关
+- 新实现：qianka.flaskext.jinja2htmlcompress（单次扫描，environment 上配置）
+"""
+import re
+import sys
+import time
+
+from jinja2 import DictLoader, Environment, TemplateSyntaxError
+from jinja2.ext import Extension
+from jinja2.lexer import Token, describe_token
+
+from qianka.flaskext.jinja2htmlcompress import (
+    HTMLCompress, SelectiveHTMLCompress, WHOLE_TEMPLATE_EXTENSIONS)
+
+
+# 改动前的实现。`(?s)` 移到了开头，新版本 Python 不允许写在末尾
+_old_tag_re = re.compile(r'(?s)(?:<(/?)([a-zA-Z0-9_-]+)\s*|(>\s*))')
+_old_ws_normalize_re = re.compile(r'[ \t\r\n]+')
+
+
+class OldStreamProcessContext(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.token = None
+        self.stack = []
+
+    def fail(self, message):
+        raise TemplateSyntaxError(message, self.token.lineno,
+                                  self.stream.name, self.stream.filename)
+
+
+def _make_dict_from_listing(listing):
+    rv = {}
+    for keys, value in listing:
+        for key in keys:
+            rv[key] = value
+    return rv
+
+
+class OldHTMLCompress(Extension):
+    """ 改动前的 HTMLCompress，enabled 对应旧的模块开关
+    """
+    enabled = True
+    isolated_elements = {'script', 'style', 'noscript', 'textarea'}
+    void_elements = {
+        'br', 'img', 'area', 'hr', 'param', 'input', 'embed', 'col'
+    }
+    block_elements = {
+        'div', 'p', 'form', 'ul', 'ol', 'li', 'table', 'tr', 'tbody', 'thead',
+        'tfoot', 'tr', 'td', 'th', 'dl', 'dt', 'dd', 'blockquote', 'h1', 'h2',
+        'h3', 'h4', 'h5', 'h6', 'pre'
+    }
+    breaking_rules = _make_dict_from_listing([
+        (['p'], {'#block'}),
+        (['li'], {'li'}),
+        (['td', 'th'], {'td', 'th', 'tr', 'tbody', 'thead', 'tfoot'}),
+        (['tr'], {'tr', 'tbody', 'thead', 'tfoot'}),
+        (['thead', 'tbody', 'tfoot'], {'thead', 'tbody', 'tfoot'}),
+        (['dd', 'dt'], {'dl', 'dt', 'dd'})
+    ])
+
+    def is_isolated(self, stack):
+        for tag in reversed(stack):
+            if tag in self.isolated_elements:
+                return True
+        return False
+
+    def is_breaking(self, tag, other_tag):
+        breaking = self.breaking_rules.get(other_tag)
+        return breaking and (tag in breaking or
+            ('#block' in breaking and tag in self.block_elements))
+
+    def enter_tag(self, tag, ctx):
+        while ctx.stack and self.is_breaking(tag, ctx.stack[-1]):
+            self.leave_tag(ctx.stack[-1], ctx)
+        if tag not in self.void_elements:
+            ctx.stack.append(tag)
+
+    def leave_tag(self, tag, ctx):
+        if not ctx.stack:
+            ctx.fail('Tried to leave "%s" but something closed '
+                     'it already' % tag)
+        if tag == ctx.stack[-1]:
+            ctx.stack.pop()
+            return
+        for idx, other_tag in enumerate(reversed(ctx.stack)):
+            if other_tag == tag:
+                for num in range(idx + 1):
+                    ctx.stack.pop()
+            elif not self.breaking_rules.get(other_tag):
+                break
+
+    def normalize(self, ctx):
+        if not self.enabled:
+            return ctx.token.value
+
+        pos = 0
+        buffer = []
+
+        def write_data(value):
+            if not self.is_isolated(ctx.stack):
+                value = _old_ws_normalize_re.sub(' ', value.strip())
+            buffer.append(value)
+
+        for match in _old_tag_re.finditer(ctx.token.value):
+            closes, tag, sole = match.groups()
+            preamble = ctx.token.value[pos:match.start()]
+            write_data(preamble)
+            if sole:
+                write_data(sole)
+            else:
+                buffer.append(match.group())
+                (closes and self.leave_tag or self.enter_tag)(tag, ctx)
+            pos = match.end()
+
+        write_data(ctx.token.value[pos:])
+        return u''.join(buffer)
+
+    def filter_stream(self, stream):
+        ctx = OldStreamProcessContext(stream)
+        for token in stream:
+            if token.type != 'data':
+                yield token
+                continue
+            ctx.token = token
+            value = self.normalize(ctx)
+            yield Token(token.lineno, 'data', value)
+
+
+class OldSelectiveHTMLCompress(OldHTMLCompress):
+    """ 改动前的 SelectiveHTMLCompress
+    """
+    def filter_stream(self, stream):
+        ctx = OldStreamProcessContext(stream)
+        strip_depth = 0
+        while 1:
+            if stream.current.type == 'block_begin':
+                if stream.look().test('name:strip') or \
+                   stream.look().test('name:endstrip'):
+                    stream.skip()
+                    if stream.current.value == 'strip':
+                        strip_depth += 1
+                    else:
+                        strip_depth -= 1
+                        if strip_depth < 0:
+                            ctx.fail('Unexpected tag endstrip')
+                    stream.skip()
+                    if stream.current.type != 'block_end':
+                        ctx.fail('expected end of block, got %s' %
+                                 describe_token(stream.current))
+                    stream.skip()
+            if strip_depth > 0 and stream.current.type == 'data':
+                ctx.token = stream.current
+                value = self.normalize(ctx)
+                yield Token(stream.current.lineno, 'data', value)
+            else:
+                yield stream.current
+            next(stream)
+
+
+class OldSelectiveDisabled(OldSelectiveHTMLCompress):
+    enabled = False
+
+
+BLOCK = u'''
+    <div class="item {{ loop.cycle('odd', 'even') }}">
+      <!-- item {{ loop.index }} -->
+      <h2 class="title">
+        <a href="{{ item.url }}"   title="{{ item.title }}">{{ item.title }}</a>
+      </h2>
+      {% if item.tags %}
+      <ul class="tags">
+        {% for tag in item.tags %}
+        <li><a href="/tag/{{ tag }}">{{ tag }}</a></li>
+        {% endfor %}
+      </ul>
+      {% endif %}
+      <p>
+        {{ item.summary }}
+        <span class="meta">by   <b>{{ item.author }}</b>   on {{ item.date }}</span>
+      </p>
+      <pre class="code">
+  {{ item.code }}
+      </pre>
+      <script type="text/javascript">
+        if (window.track && {{ loop.index }} < 10) { track('{{ item.url }}'); }
+      </script>
+    </div>
+'''
+
+
+def make_sources(repeat):
+    body = u'{% for item in items %}' + BLOCK * repeat + u'{% endfor %}'
+    return {
+        'plain.html': u'<!DOCTYPE html>\n<html>\n  <body>\n' + body +
+                      u'\n  </body>\n</html>\n',
+        'strip.txt': u'{% strip %}<!DOCTYPE html>\n<html>\n  <body>\n' + body +
+                     u'\n  </body>\n</html>\n{% endstrip %}',
+    }
+
+
+CONTEXT = {'items': [dict(url='/item/%d' % i, title='Item   %d' % i,
+                          tags=['a', 'b'], summary='Summary  %d' % i,
+                          author='author', date='2016-01-01',
+                          code='x  =  %d' % i) for i in range(3)]}
+
+
+def measure(sources, number, label, name, extensions, compress=None,
+            templates=()):
+    env = Environment(loader=DictLoader(sources), extensions=extensions,
+                      cache_size=0)
+    env.html_compress = compress
+    env.html_compress_templates = templates
+    start = time.time()
+    for i in range(number):
+        tmpl = env.get_template(name)
+    elapsed = (time.time() - start) / number
+    output = tmpl.render(CONTEXT)
+    print('%-32s compile %8.2fms  output %9d bytes'
+          % (label, elapsed * 1000, len(output.encode('utf-8'))))
+
+
+def bench(repeat, number):
+    sources = make_sources(repeat)
+    print('template: %d bytes' % len(sources['plain.html'].encode('utf-8')))
+    measure(sources, number, 'no extension', 'plain.html', [])
+    measure(sources, number, 'old strip, disabled', 'strip.txt',
+            [OldSelectiveDisabled])
+    measure(sources, number, 'new strip, disabled', 'strip.txt',
+            [SelectiveHTMLCompress], False)
+    measure(sources, number, 'old strip, enabled', 'strip.txt',
+            [OldSelectiveHTMLCompress])
+    measure(sources, number, 'new strip, enabled', 'strip.txt',
+            [SelectiveHTMLCompress], True)
+    measure(sources, number, 'new whole template', 'plain.html',
+            [SelectiveHTMLCompress], True, WHOLE_TEMPLATE_EXTENSIONS)
+    measure(sources, number, 'old HTMLCompress', 'plain.html',
+            [OldHTMLCompress])
+    measure(sources, number, 'new HTMLCompress', 'plain.html',
+            [HTMLCompress], True)
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    bench(repeat, number)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+appctx teardown 与 QKSession.get_bind 的开销，对比改动前后的实现
+
+    python benchmarks/sqlalchemy_teardown.py [次数]
+
+- teardown：SQLALCHEMY_SKIP_IDLE_TEARDOWN = False（每个 appctx 都调用 db.reset()）
+  与 True（当前线程没有 session 时跳过）
+- get_bind：旧实现（hasattr + isinstance 查找 use_bind 栈，日志参数立即格式化）
+  与当前实现
+"""
+import sys
+import timeit
+
+from flask import Flask
+from flask.globals import _app_ctx_stack
+
+from qianka.sqlalchemy import QKSession as SessionBase
+from qianka.sqlalchemy import QKSQLAlchemy
+from qianka.flaskext.sqlalchemy import QKFlaskSQLAlchemy, QKSession, _CTX_ATTR
+
+
+class OldQKSession(QKSession):
+    """ 改动前的 get_bind
+    """
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        ctx = _app_ctx_stack.top
+        stack = hasattr(ctx, _CTX_ATTR) and getattr(ctx, _CTX_ATTR, None)
+        if isinstance(stack, list) and len(stack) > 0:
+            bind_key = stack[-1]
+            monitor = getattr(self.db, 'replica_monitor', None)
+            if monitor is None or monitor.is_healthy(bind_key):
+                engine = self.db.get_engine(bind_key)
+                self.app.logger.debug('sqlalchemy_use_bind: %s' % bind_key)
+                return engine
+            return SessionBase.get_bind(self, mapper, clause, **kwargs)
+
+        replica_pool = getattr(self.db, 'replica_pool', None)
+        if replica_pool is not None and ctx is not None:
+            bind_key = self._route_replica(ctx, replica_pool, clause)
+            if bind_key is not None:
+                self.app.logger.debug('sqlalchemy_auto_bind: %s' % bind_key)
+                return self.db.get_engine(bind_key)
+
+        return SessionBase.get_bind(self, mapper, clause, **kwargs)
+
+
+def make_app(session_class, **config):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_BINDS'] = {'slave': 'sqlite://'}
+    app.config.update(config)
+    db = QKSQLAlchemy(session_class=session_class)
+    ext = QKFlaskSQLAlchemy(db, app)
+    return app, db, ext
+
+
+def bench_teardown(n):
+    for skip in (False, True):
+        app, db, ext = make_app(QKSession, SQLALCHEMY_SKIP_IDLE_TEARDOWN=skip)
+
+        def idle_request():
+            with app.app_context():
+                pass
+        cost = timeit.timeit(idle_request, number=n) / n
+        print('appctx without session, SQLALCHEMY_SKIP_IDLE_TEARDOWN=%s: %.2fus'
+              % (skip, cost * 1e6))
+
+
+def bench_get_bind(n):
+    for name, session_class in (('old', OldQKSession), ('new', QKSession)):
+        app, db, ext = make_app(session_class)
+        for debug in (False, True):
+            app.debug = debug
+            with app.app_context():
+                session = db.session()
+                cost = timeit.timeit(session.get_bind, number=n) / n
+                print('%s get_bind, debug=%s: %.2fus' % (name, debug, cost * 1e6))
+                with ext.use_bind('slave'):
+                    cost = timeit.timeit(session.get_bind, number=n) / n
+                print('%s get_bind in use_bind, debug=%s: %.2fus'
+                      % (name, debug, cost * 1e6))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bench_teardown(n)
+    bench_get_bind(n)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+资源文件的构建，只在构建时使用
+
+- FlaskArgparseInterface: webassets 命令行构建，包括模板中的 bundle
+- build_bundles(): 并行、增量构建。每个 bundle 的缓存键由所有源文件（含 depends）的
+  内容哈希、过滤器链和输出路径生成，保存在 JSON 文件中；缓存键不变且输出文件存在的
+  bundle 不再构建。需要构建的 bundle 在进程池（fork）中并行构建，
+  webassets 的 manifest 由主进程统一写入
+- write_manifest(): 输出 bundle 到 URL 的对照表，供 manifest 模式（assetsmanifest）使用
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from webassets.bundle import Bundle, get_all_bundle_files, wrap
+from webassets.ext.jinja2 import Jinja2Loader
+from webassets.script import GenericArgparseImplementation
+
+from .staticfiles import _dump_json
+
+__all__ = ['FlaskArgparseInterface', 'build_bundles', 'write_manifest']
+
+# fork 之前设置，子进程按下标取 bundle，避免 pickle bundle
+_jobs = []
+
+
+class FlaskArgparseInterface(GenericArgparseImplementation):
+
+    def _setup_assets_env(self, ns, log):
+        env = super(FlaskArgparseInterface, self)._setup_assets_env(ns, log)
+        log.info('Searching templates...')
+        # Note that we exclude container bundles. By their very nature,
+        # they are guaranteed to have been created by solely referencing
+        # other bundles which are already registered.
+        env.add(*[b for b in self.load_from_templates(env, log)
+                        if not b.is_container])
+
+        return env
+
+    @staticmethod
+    def load_from_templates(env, log):
+        # Use the application's Jinja environment to parse
+        jinja2_env = current_app.jinja_env
+
+        # Get the template directories of app and blueprints
+        template_dirs = [
+            os.path.join(current_app.root_path, current_app.template_folder)
+        ]
+        for blueprint in current_app.blueprints.values():
+            if blueprint.template_folder is None:
+                continue
+            template_dirs.append(
+                os.path.join(blueprint.root_path, blueprint.template_folder))
+
+        log.info('Loading templates from: %s' % template_dirs)
+        loader = Jinja2Loader(env, template_dirs, [jinja2_env], jinja_ext='*.*')
+        return loader.load_bundles()
+
+
+def iter_bundles(env):
+    """ 已注册的 bundle 以名称标识，模板中的 bundle 以输出路径标识
+    :return: [(key, bundle)]
+    """
+    names = dict((id(b), name) for name, b in env._named_bundles.items())
+    seen = set()
+    for bundle in env:
+        key = names.get(id(bundle), bundle.output)
+        if key not in seen:
+            seen.add(key)
+            yield key, bundle
+
+
+def write_manifest(env, path):
+    """ 输出 {bundle 名称或输出路径: [URL]}。env.url 下的 URL 保存为相对路径，
+    运行时再加上当时的 CDN_URL_PREFIX_ASSETS
+    :return: manifest
+    """
+    base = env.url.rstrip('/') + '/'
+    manifest = {}
+    # 使用刚构建时记下的版本，不再触发构建或重新计算版本
+    auto_build, env.auto_build = env.auto_build, False
+    try:
+        for key, bundle in iter_bundles(env):
+            manifest[key] = [url[len(base):] if url.startswith(base) else url
+                             for url in bundle.urls()]
+    finally:
+        env.auto_build = auto_build
+    _dump_json(path, manifest)
+    return manifest
+
+
+def _filter_chain(bundle):
+    chain = ['%s:%r' % (f.name, f.unique()) for f in bundle.filters]
+    for item in bundle.contents:
+        if isinstance(item, Bundle):
+            chain.append(_filter_chain(item))
+    return chain
+
+
+def bundle_cache_key(bundle, root):
+    """
+    :param bundle:
+    :param root: 源文件路径相对于 root 计算，构建目录变化时缓存仍然有效
+    :return: str
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps([bundle.output, _filter_chain(bundle)]).encode('utf-8'))
+    for path in sorted(set(get_all_bundle_files(bundle))):
+        digest.update(os.path.relpath(path, root).encode('utf-8'))
+        with open(path, 'rb') as f:
+            digest.update(hashlib.sha1(f.read()).digest())
+    return digest.hexdigest()
+
+
+def _build_job(index, in_worker=True):
+    bundle = _jobs[index]
+    if in_worker:
+        # 多个进程同时写 manifest 会互相覆盖，由主进程统一写入
+        bundle.env.manifest = False
+    start = time.time()
+    bundle.build(force=True)
+    version = getattr(bundle, 'version', None)
+    return {
+        'version': version,
+        'output': bundle.resolve_output(version=version),
+        'elapsed': time.time() - start,
+    }
+
+
+def _load_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def build_bundles(env, workers=1, cache_path=None, root='.', log=None):
+    """ 构建 env 中所有的 bundle
+
+    :param env: webassets Environment
+    :param workers: 进程数，1 表示在当前进程中构建
+    :param cache_path: 构建缓存文件，None 表示不使用缓存
+    :param root: 计算缓存键时源文件的相对根目录
+    :param log: logger
+    :return: [{'name', 'status': 'built'/'cached'/'failed', 'elapsed', 'output', 'version', 'error'}]
+    """
+    global _jobs
+    jobs = list(iter_bundles(env))
+
+    cache = _load_cache(cache_path) if cache_path else {}
+    start = time.time()
+    report = []
+    pending = []
+    for name, bundle in jobs:
+        key = bundle_cache_key(bundle, root)
+        entry = cache.get(name)
+        if entry and entry['key'] == key and os.path.exists(entry['output']):
+            bundle.version = entry['version']
+            _remember(env, bundle, entry['version'])
+            report.append(dict(name=name, status='cached', elapsed=0.0,
+                               output=entry['output'], version=entry['version'],
+                               error=None))
+            if log:
+                log.info('[%d/%d] %s: cached' % (len(report), len(jobs), name))
+        else:
+            pending.append((name, bundle, key))
+
+    if workers > 1 and len(pending) > 1 and \
+            'fork' in multiprocessing.get_all_start_methods():
+        _jobs = [bundle for _, bundle, _ in pending]
+        executor = ProcessPoolExecutor(
+            min(workers, len(pending)), mp_context=multiprocessing.get_context('fork'))
+        with executor:
+            futures = [executor.submit(_build_job, i) for i in range(len(pending))]
+            results = [_result(future.result) for future in futures]
+    else:
+        _jobs = [bundle for _, bundle, _ in pending]
+        results = [_result(_build_job, i, False) for i in range(len(pending))]
+    _jobs = []
+
+    for (name, bundle, key), result in zip(pending, results):
+        if isinstance(result, Exception):
+            cache.pop(name, None)
+            report.append(dict(name=name, status='failed', elapsed=0.0, output=None,
+                               version=None, error=result))
+            if log:
+                log.error('[%d/%d] %s: %r' % (len(report), len(jobs), name, result))
+            continue
+        bundle.version = result['version']
+        _remember(env, bundle, result['version'])
+        cache[name] = {'key': key, 'output': result['output'],
+                       'version': result['version']}
+        report.append(dict(name=name, status='built', elapsed=result['elapsed'],
+                           output=result['output'], version=result['version'],
+                           error=None))
+        if log:
+            log.info('[%d/%d] %s: built in %.2fs' % (
+                len(report), len(jobs), name, result['elapsed']))
+
+    if cache_path:
+        _dump_json(cache_path, cache)
+    if log:
+        log.info('%d built, %d cached, %d failed in %.2fs' % tuple(
+            [sum(1 for r in report if r['status'] == s)
+             for s in ('built', 'cached', 'failed')] + [time.time() - start]))
+    return report
+
+
+def _result(func, *args):
+    try:
+        return func(*args)
+    except Exception as e:
+        return e
+
+
+def _remember(env, bundle, version):
+    if version is not None and env.manifest:
+        env.manifest.remember(bundle, wrap(env, bundle), version)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+资源文件 manifest 模式
+
+build_assets 输出的 manifest 为 {bundle 名称或输出路径: [URL]}，运行时只做字典查找，
+不导入 webassets 及其过滤器。模板中的 `{% assets %}` 写法与 webassets 相同：
+
+    {% assets "app.js" %}<script src="{{ ASSET_URL }}"></script>{% endassets %}
+    {% assets "a.js", "b.js", filters="uglifyjs", output="ab.%(version)s.js" %}...{% endassets %}
+
+已注册的 bundle 按名称查找，模板中定义的 bundle 按 output 查找。
+"""
+import json
+
+from jinja2 import nodes
+from jinja2.exceptions import TemplateRuntimeError
+from jinja2.ext import Extension
+
+__all__ = ['AssetsManifest', 'ManifestAssetsExtension']
+
+
+class AssetsManifest(object):
+
+    def __init__(self, data, url_prefix):
+        """
+        :param data: manifest
+        :param url_prefix: 相对路径的 URL 前缀，如 `{CDN_URL_PREFIX_ASSETS}/assets/`
+        """
+        self.url_prefix = url_prefix
+        self.urls = dict((key, [self._absolute(url) for url in urls])
+                         for key, urls in data.items())
+
+    @classmethod
+    def load(cls, path, url_prefix):
+        with open(path) as f:
+            return cls(json.load(f), url_prefix)
+
+    def _absolute(self, url):
+        if url.startswith('/') or '://' in url:
+            return url
+        return self.url_prefix + url
+
+    def __contains__(self, key):
+        return key in self.urls
+
+    def get(self, key):
+        """
+        :return: URL 列表，不存在时为 None
+        """
+        return self.urls.get(key)
+
+    def resolve(self, names, output=None):
+        """ 与 `{% assets %}` 的参数相同
+        :param names: bundle 名称或源文件
+        :param output: 模板中定义的 bundle 的输出路径
+        :return: URL 列表
+        """
+        if output is not None:
+            urls = self.urls.get(output)
+            if urls is None:
+                raise TemplateRuntimeError('assets manifest: unknown output %r' % output)
+            return urls
+        urls = []
+        for name in names:
+            if name not in self.urls:
+                raise TemplateRuntimeError('assets manifest: unknown bundle %r' % name)
+            urls.extend(self.urls[name])
+        return urls
+
+
+class ManifestAssetsExtension(Extension):
+    """ 使用 environment.assets_manifest 解析 `{% assets %}`
+    """
+    tags = set(['assets'])
+
+    def __init__(self, environment):
+        super(ManifestAssetsExtension, self).__init__(environment)
+        environment.extend(assets_manifest=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        names = []
+        output = nodes.Const(None)
+        while parser.stream.current.type != 'block_end':
+            if parser.stream.current.type == 'name' and \
+                    parser.stream.look().type == 'assign':
+                key = parser.stream.current.value
+                parser.stream.skip(2)
+                value = parser.parse_expression()
+                # filters、depends、debug 等参数只在构建时有用
+                if key == 'output':
+                    output = value
+            else:
+                names.append(parser.parse_expression())
+            if parser.stream.current.type != 'block_end':
+                parser.stream.expect('comma')
+
+        body = parser.parse_statements(['name:endassets'], drop_needle=True)
+        call = self.call_method('_render_assets', args=[nodes.List(names), output])
+        return nodes.CallBlock(call, [nodes.Name('ASSET_URL', 'param'),
+                                      nodes.Name('EXTRA', 'param')],
+                               [], body).set_lineno(lineno)
+
+    def _render_assets(self, names, output, caller):
+        urls = self.environment.assets_manifest.resolve(names, output)
+        return ''.join(caller(url, {}) for url in urls)
@@ -1,12 +1,41 @@
 # -*- coding: utf-8 -*-
+import functools
+import hashlib
 import os
-from flask import Flask, current_app
-from webassets.ext.jinja2 import Jinja2Loader
-from webassets.script import GenericArgparseImplementation
+from flask import Flask, _request_ctx_stack, current_app, has_request_context, request
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.urls import url_quote
 
 __all__ = ['QKFlask']
 
 
+class _TemplateBytecodeCache(FileSystemBytecodeCache):
+    """ 缓存键由模板名称和 environment 的扩展、HTML 压缩配置生成：
+    不包含模板文件的绝对路径，构建目录与部署目录不同时仍然有效；
+    扩展或压缩配置变化后不会读到旧的字节码。模板内容的变化由 jinja2 的 checksum 检查
+    """
+
+    def __init__(self, directory, environment):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        super(_TemplateBytecodeCache, self).__init__(directory)
+        self.environment = environment
+
+    def dump_bytecode(self, bucket):
+        # 缓存目录只读（如只在构建时可写）时照常渲染
+        try:
+            super(_TemplateBytecodeCache, self).dump_bytecode(bucket)
+        except (IOError, OSError):
+            pass
+
+    def get_cache_key(self, name, filename=None):
+        env = self.environment
+        signature = '%s|%s|%s|%s' % (name, ','.join(sorted(env.extensions)),
+                                     getattr(env, 'html_compress', None),
+                                     ','.join(getattr(env, 'html_compress_templates', ())))
+        return hashlib.sha1(signature.encode('utf-8')).hexdigest()
+
+
 class QKFlask(Flask):
     """
     Flask Application
@@ -17,9 +46,25 @@ class QKFlask(Flask):
     - prepare_webassets()
     - prepare_celery()
     - build_assets()
+    - compile_templates()
     - HTML_COMPRESS
+    - HTML_COMPRESS_ALL
     - CDN_URL_PREFIX_STATIC
     - CDN_URL_PREFIX_ASSETS
+    - ASSETS_BUILD_WORKERS
+    - ASSETS_BUILD_CACHE
+    - ASSETS_PRECOMPRESS
+    - ASSETS_MEMORY_CACHE_SIZE
+    - ASSETS_MEMORY_CACHE_MAX_FILE
+    - ASSETS_MANIFEST_FILE
+    - ASSETS_MANIFEST_MODE
+    - STATIC_FINGERPRINT
+    - STATIC_MANIFEST_FILE
+    - STATIC_URL_CACHE_SIZE
+    - TEMPLATE_BYTECODE_CACHE
+    - TEMPLATE_PRECOMPILE_EXTENSIONS
+    - FRAGMENT_CACHE
+    - FRAGMENT_CACHE_TTL
     """
     def __init__(self, import_name, static_path=None, static_url_path=None,
                  static_folder='static', template_folder='templates',
@@ -33,10 +78,31 @@ class QKFlask(Flask):
 
         self.bower_components_folder = bower_components_folder
         self.config.setdefault('HTML_COMPRESS', False)
+        self.config.setdefault('HTML_COMPRESS_ALL', False)
         self.config.setdefault('CDN_URL_PREFIX_STATIC', '')
         self.config.setdefault('CDN_URL_PREFIX_ASSETS', '')
+        self.config.setdefault('ASSETS_BUILD_WORKERS', None)
+        self.config.setdefault('ASSETS_BUILD_CACHE', None)
+        self.config.setdefault('ASSETS_PRECOMPRESS', False)
+        self.config.setdefault('ASSETS_MEMORY_CACHE_SIZE', 0)
+        self.config.setdefault('ASSETS_MEMORY_CACHE_MAX_FILE', 64 * 1024)
+        self.config.setdefault('ASSETS_MANIFEST_FILE', None)
+        self.config.setdefault('ASSETS_MANIFEST_MODE', False)
+        self.config.setdefault('STATIC_FINGERPRINT', False)
+        self.config.setdefault('STATIC_MANIFEST_FILE', None)
+        self.config.setdefault('STATIC_URL_CACHE_SIZE', 1024)
+        self.config.setdefault('TEMPLATE_BYTECODE_CACHE', None)
+        self.config.setdefault('TEMPLATE_PRECOMPILE_EXTENSIONS',
+                               ('.html', '.htm', '.xml', '.xhtml', '.txt', '.jinja'))
+        self.config.setdefault('FRAGMENT_CACHE', None)
+        self.config.setdefault('FRAGMENT_CACHE_TTL', 300)
 
         self.webassets = None
+        self.assets_manifest = None
+        self.static_fingerprints = None
+
+        if getattr(self, 'cli', None) is not None:
+            self.cli.command('compile-templates')(self._compile_templates_command)
 
     def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
         """
@@ -61,7 +127,10 @@ class QKFlask(Flask):
         :return:
 
         最后输出的文件名为 `{name}.{hash}.css` 或 `{name}.{hash}.js`。其中 hash 与内容相关。
+        manifest 模式下资源文件已经构建好，不做任何事。
         """
+        if self.assets_manifest is not None:
+            return
         if self.webassets is None:
             raise Exception('webassets is not ready. init_app() should be invoked')
 
@@ -114,41 +183,168 @@ class QKFlask(Flask):
 
     def prepare_templates(self):
         """
-        - 支持 HTML 压缩，`{% strip %} ... {% endstrip %}`
+        - 支持 HTML 压缩，`{% strip %} ... {% endstrip %}`；
+          HTML_COMPRESS_ALL 为 True 时 .html/.html.jinja 模板不需要 strip 整个压缩
+        - 片段缓存，`{% cache key, ttl %} ... {% endcache %}`。
+          FRAGMENT_CACHE = MemoryFragmentCache() 或 RedisFragmentCache()，
+          ttl 省略时为 FRAGMENT_CACHE_TTL 秒；FRAGMENT_CACHE 为 None 时不缓存
         - 纯静态文件 URL 路径 `/static`
         - 可配置 CDN 域名及路径前缀。`url_for(endpoint='static')`
+        - STATIC_FINGERPRINT 为 True 时，启动时读取 STATIC_MANIFEST_FILE
+          （不存在时扫描 static_folder）得到文件的内容哈希，
+          `url_for('static', filename=...)` 直接从预先生成的字典中返回带 `?v={hash}` 的 URL，
+          带正确 `v` 的请求使用 immutable 长期缓存。文件变化后需要重启
+        - 其他 `url_for('static')` 调用的结果缓存在最多 STATIC_URL_CACHE_SIZE 项的 LRU 中，
+          0 表示不缓存
+        - TEMPLATE_BYTECODE_CACHE 为目录时，模板编译结果缓存在该目录中，
+          由 compile_templates() 预先生成后，worker 直接加载字节码而不再编译
         """
+        if self.config['TEMPLATE_BYTECODE_CACHE']:
+            self.jinja_env.bytecode_cache = _TemplateBytecodeCache(
+                self.config['TEMPLATE_BYTECODE_CACHE'], self.jinja_env)
+
         # HTML_compress
         from . import jinja2htmlcompress
-        if self.config['HTML_COMPRESS']:
-            jinja2htmlcompress.enabled = True
         self.jinja_env.add_extension("%s.%s" % (
             jinja2htmlcompress.SelectiveHTMLCompress.__module__,
             jinja2htmlcompress.SelectiveHTMLCompress.__name__)
         )
+        self.jinja_env.html_compress = bool(self.config['HTML_COMPRESS'])
+        if self.config['HTML_COMPRESS_ALL']:
+            self.jinja_env.html_compress_templates = jinja2htmlcompress.WHOLE_TEMPLATE_EXTENSIONS
+
+        # fragment cache
+        from .jinja2fragmentcache import FragmentCacheExtension
+        self.jinja_env.add_extension(FragmentCacheExtension)
+        self.jinja_env.fragment_cache = self.config['FRAGMENT_CACHE']
+        self.jinja_env.fragment_cache_ttl = self.config['FRAGMENT_CACHE_TTL']
 
         # url_for that supports CDN
         origin_url_for = self.jinja_env.globals['url_for']
+        cdn_prefix = self.config['CDN_URL_PREFIX_STATIC']
+
+        fingerprints = {}
+        if self.config['STATIC_FINGERPRINT'] and self.has_static_folder:
+            fingerprints = self._load_static_fingerprints()
+        # {filename: 不含 script_root 的 URL}
+        static_urls = dict(
+            (filename, '%s/%s?v=%s' % (self.static_url_path, url_quote(filename), fingerprint))
+            for filename, fingerprint in fingerprints.items())
+
+        def static_url_for(values):
+            filename = values.get('filename')
+            if filename in fingerprints and 'v' not in values:
+                values['v'] = fingerprints[filename]
+            return origin_url_for('static', **values)
+
+        cache_size = self.config['STATIC_URL_CACHE_SIZE']
+        if cache_size:
+            @functools.lru_cache(maxsize=cache_size)
+            def cached_static_url_for(url_root, items):
+                return static_url_for(dict(items))
+        else:
+            cached_static_url_for = None
 
         def url_for(endpoint, **values):
-            url = origin_url_for(endpoint, **values)
-
-            external = values.pop('_external', False)
-            if external:
-                return url
-
             if endpoint == 'static':
-                url = self.config['CDN_URL_PREFIX_STATIC'] + url
-            return url
+                external = values.get('_external', False)
+                if len(values) == 1:
+                    url = static_urls.get(values.get('filename'))
+                    if url is not None:
+                        ctx = _request_ctx_stack.top
+                        if ctx is not None:
+                            url = ctx.request.script_root + url
+                        return cdn_prefix + url
+
+                url = None
+                if cached_static_url_for is not None:
+                    # url_root 包含 host 和 script_root，_external 时 URL 与之相关
+                    url_root = request.url_root if has_request_context() else None
+                    try:
+                        url = cached_static_url_for(url_root, frozenset(values.items()))
+                    except TypeError:
+                        # 参数不可哈希
+                        pass
+                if url is None:
+                    url = static_url_for(values)
+                return url if external else cdn_prefix + url
+
+            if endpoint == 'assets' and self.assets_manifest is not None and \
+                    not values.get('_external') and \
+                    values.get('filename') in self.assets_manifest:
+                urls = self.assets_manifest.get(values['filename'])
+                if len(urls) == 1:
+                    return urls[0]
+
+            return origin_url_for(endpoint, **values)
 
         self.jinja_env.globals['url_for'] = url_for
 
+        if fingerprints and 'static' in self.view_functions:
+            from .staticfiles import IMMUTABLE_MAX_AGE
+            send_static_file = self.view_functions['static']
+
+            def _send_fingerprinted_static_file(filename):
+                response = send_static_file(filename)
+                fingerprint = request.args.get('v')
+                if fingerprint is not None and fingerprints.get(filename) == fingerprint:
+                    response.headers['Cache-Control'] = \
+                        'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+                return response
+
+            self.view_functions['static'] = _send_fingerprinted_static_file
+
+    def _load_static_fingerprints(self):
+        from .staticfiles import fingerprint_directory, load_fingerprints
+
+        path = self.config['STATIC_MANIFEST_FILE']
+        if path and os.path.exists(path):
+            self.static_fingerprints = load_fingerprints(path)
+            self.logger.info("static.manifest: %s" % path)
+        else:
+            self.static_fingerprints = fingerprint_directory(self.static_folder)
+            self.logger.info("static.fingerprint: %d files in %s" % (
+                len(self.static_fingerprints), self.static_folder))
+        return self.static_fingerprints
+
+    def build_static_manifest(self, path=None):
+        """
+        扫描 static_folder，输出文件内容哈希到 path（默认为 STATIC_MANIFEST_FILE），
+        部署时生成后 worker 启动时不必再扫描
+        :param path:
+        :return: {filename: hash}
+        """
+        from .staticfiles import fingerprint_directory, write_fingerprints
+
+        path = path or self.config['STATIC_MANIFEST_FILE']
+        if not path:
+            raise Exception('STATIC_MANIFEST_FILE is not configured')
+        fingerprints = fingerprint_directory(self.static_folder)
+        write_fingerprints(path, fingerprints)
+        self.logger.info("static.manifest: %s" % path)
+        return fingerprints
+
     def prepare_webassets(self):
         """
         - webassets 资源文件
         - 资源文件 URL 路径 `/assets`
         - 可配置 CDN 域名及路径前缀。`url_for(endpoint='assets')`
+        - 优先返回 build_assets 生成的 .br/.gz 文件，带哈希的文件名使用 immutable 长期缓存，
+          ASSETS_MEMORY_CACHE_SIZE 大于 0 时在内存中缓存不超过 ASSETS_MEMORY_CACHE_MAX_FILE 字节的文件
+        - ASSETS_MANIFEST_MODE 为 True 时不加载 webassets，`{% assets %}` 与
+          `url_for('assets')` 从 build_assets 生成的 manifest 中查找，
+          资源文件从 ASSETS_DIRECTORY 读取
         """
+        from .staticfiles import PrecompressedFiles
+
+        if self.config['ASSETS_MANIFEST_MODE']:
+            directory = self.config.get('ASSETS_DIRECTORY')
+            if not directory:
+                raise Exception('ASSETS_DIRECTORY is required in manifest mode')
+            self._load_assets_manifest(directory)
+            self._add_assets_url_rule(PrecompressedFiles, directory)
+            return
+
         import flask.ext.assets
 
         self.webassets = flask.ext.assets.Environment(self)
@@ -171,10 +367,17 @@ class QKFlask(Flask):
             self.webassets.directory = tempfile.mkdtemp()
             self.logger.warn("assets.directory: %s" % self.webassets.directory)
 
+        self._add_assets_url_rule(PrecompressedFiles, self.webassets.directory)
+
+    def _add_assets_url_rule(self, file_class, directory):
+        assets_files = file_class(
+            directory,
+            max_age=self.get_send_file_max_age,
+            memory_cache_size=self.config['ASSETS_MEMORY_CACHE_SIZE'],
+            memory_cache_max_file=self.config['ASSETS_MEMORY_CACHE_MAX_FILE'])
+
         def _send_assets_file(filename):
-            cache_timeout = self.get_send_file_max_age(filename)
-            return flask.send_from_directory(
-                self.webassets.directory, filename, cache_timeout=cache_timeout)
+            return assets_files.send(filename)
 
         self.add_url_rule(
             '/assets/<path:filename>',
@@ -182,20 +385,112 @@ class QKFlask(Flask):
             view_func=_send_assets_file
         )
 
-    def build_assets(self, args=None):
+    def _load_assets_manifest(self, directory):
+        from .assetsmanifest import AssetsManifest, ManifestAssetsExtension
+
+        path = self.config['ASSETS_MANIFEST_FILE'] or os.path.join(directory, 'manifest.json')
+        self.assets_manifest = AssetsManifest.load(
+            path, '%s/assets/' % self.config['CDN_URL_PREFIX_ASSETS'])
+        self.jinja_env.add_extension(ManifestAssetsExtension)
+        self.jinja_env.assets_manifest = self.assets_manifest
+        self.logger.info("assets.manifest: %s" % path)
+
+    def build_assets(self, args=None, workers=None):
         """
-        :param args: the command line arguments
-        :return:
+        构建资源文件
+
+        指定 workers（或 ASSETS_BUILD_WORKERS）时使用并行增量构建：
+        已注册和模板中的 bundle 在 workers 个进程中并行构建，
+        源文件内容与过滤器链都没有变化的 bundle 直接跳过。
+        构建缓存保存在 ASSETS_BUILD_CACHE，默认为 assets 目录下的 .build-cache.json
+
+        ASSETS_PRECOMPRESS 为 True 时为输出文件生成 .gz/.br。
+        构建完成后输出 manifest 到 ASSETS_MANIFEST_FILE（默认为 assets 目录下的 manifest.json）
+
+        :param args: the command line arguments，仅用于 webassets 命令行构建
+        :param workers: 并行构建的进程数，None 表示使用 webassets 命令行构建
+        :return: 并行增量构建时返回每个 bundle 的构建结果
         """
         if args is None:
             args = ['-v', 'build']
+        if workers is None:
+            workers = self.config['ASSETS_BUILD_WORKERS']
 
         with self.app_context():
             if not hasattr(current_app.jinja_env, 'assets_environment'):
                 self.logger.warn("Assets environment not found.")
                 return
-            impl = FlaskArgparseInterface(current_app.jinja_env.assets_environment)
-            impl.main(args)
+            env = current_app.jinja_env.assets_environment
+            from .assets import FlaskArgparseInterface, build_bundles
+            if workers is None:
+                impl = FlaskArgparseInterface(env)
+                impl.main(args)
+                self._after_build_assets(env)
+                return
+
+            env.add(*[b for b in FlaskArgparseInterface.load_from_templates(env, self.logger)
+                      if not b.is_container])
+            cache_path = self.config['ASSETS_BUILD_CACHE'] or \
+                os.path.join(env.directory, '.build-cache.json')
+            report = build_bundles(env, workers, cache_path, self.root_path, self.logger)
+            failed = [r['name'] for r in report if r['status'] == 'failed']
+            if failed:
+                raise Exception('failed to build assets: %s' % ', '.join(failed))
+            self._after_build_assets(env)
+            return report
+
+    def _after_build_assets(self, env):
+        from .assets import write_manifest
+        path = self.config['ASSETS_MANIFEST_FILE'] or os.path.join(env.directory, 'manifest.json')
+        write_manifest(env, path)
+        self.logger.info("assets.manifest: %s" % path)
+
+        if self.config['ASSETS_PRECOMPRESS']:
+            from .staticfiles import precompress
+            precompress(env.directory, log=self.logger)
+
+    def compile_templates(self, directory=None):
+        """
+        预编译 app 和 blueprint 模板目录中扩展名在 TEMPLATE_PRECOMPILE_EXTENSIONS 中的模板，
+        字节码写入 directory（默认为 TEMPLATE_BYTECODE_CACHE）。
+        应在 prepare_templates()、prepare_webassets() 及注册 blueprint 之后调用，
+        保证 jinja 扩展与运行时相同。
+        部署时执行 `flask compile-templates`，worker 启动后调用本方法则只加载字节码，
+        同时填充 jinja 的内存缓存
+
+        :param directory: 字节码缓存目录
+        :return: 编译失败的模板 {name: exception}
+        """
+        directory = directory or self.config['TEMPLATE_BYTECODE_CACHE']
+        if not directory:
+            raise Exception('TEMPLATE_BYTECODE_CACHE is not configured')
+        env = self.jinja_env
+        bytecode_cache = env.bytecode_cache
+        if not isinstance(bytecode_cache, _TemplateBytecodeCache) or \
+                bytecode_cache.directory != directory:
+            env.bytecode_cache = _TemplateBytecodeCache(directory, env)
+
+        extensions = tuple(self.config['TEMPLATE_PRECOMPILE_EXTENSIONS'])
+        names = env.list_templates(filter_func=lambda name: name.endswith(extensions))
+        failed = {}
+        with self.app_context():
+            for name in names:
+                try:
+                    env.get_template(name)
+                except Exception as e:
+                    failed[name] = e
+                    self.logger.error("template %s: %r" % (name, e))
+        self.logger.info("templates: %d compiled, %d failed in %s" % (
+            len(names) - len(failed), len(failed), directory))
+
+        env.bytecode_cache = bytecode_cache
+        return failed
+
+    def _compile_templates_command(self):
+        """ Precompile templates into TEMPLATE_BYTECODE_CACHE. """
+        failed = self.compile_templates()
+        if failed:
+            raise Exception('failed to compile templates: %s' % ', '.join(sorted(failed)))
 
     def prepare_celery(self, celery):
         """
@@ -216,34 +511,10 @@ class QKFlask(Flask):
         celery.Task = ContextTask
 
 
-class FlaskArgparseInterface(GenericArgparseImplementation):
-
-    def _setup_assets_env(self, ns, log):
-        env = super(FlaskArgparseInterface, self)._setup_assets_env(ns, log)
-        log.info('Searching templates...')
-        # Note that we exclude container bundles. By their very nature,
-        # they are guaranteed to have been created by solely referencing
-        # other bundles which are already registered.
-        env.add(*[b for b in self.load_from_templates(env, log)
-                        if not b.is_container])
-
-        return env
-
-    @staticmethod
-    def load_from_templates(env, log):
-        # Use the application's Jinja environment to parse
-        jinja2_env = current_app.jinja_env
-
-        # Get the template directories of app and blueprints
-        template_dirs = [
-            os.path.join(current_app.root_path, current_app.template_folder)
-        ]
-        for blueprint in current_app.blueprints.values():
-            if blueprint.template_folder is None:
-                continue
-            template_dirs.append(
-                os.path.join(blueprint.root_path, blueprint.template_folder))
-
-        log.info('Loading templates from: %s' % template_dirs)
-        loader = Jinja2Loader(env, template_dirs, [jinja2_env], jinja_ext='*.*')
-        return loader.load_bundles()
+def __getattr__(name):
+    # FlaskArgparseInterface 依赖 webassets，移到了 assets 模块，
+    # 这里按需导入以保持兼容；manifest 模式下不会导入 webassets
+    if name == 'FlaskArgparseInterface':
+        from .assets import FlaskArgparseInterface
+        return FlaskArgparseInterface
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+模板片段缓存
+
+    {% cache 'nav', 600 %} ... {% endcache %}
+    {% cache ['category', category.id] %} ... {% endcache %}
+
+key 可以是字符串或列表，与模板名称一起组成缓存键；ttl 省略时使用
+environment.fragment_cache_ttl。environment.fragment_cache 为 None 时直接渲染。
+
+过期后的条目在 grace 秒内仍然保留：同一个 key 只有一个请求（持有锁）重新渲染，
+其他请求直接返回旧内容；没有旧内容时等待渲染结果，最多 lock_timeout 秒。
+"""
+import abc
+from collections import OrderedDict
+import logging
+import threading
+import time
+import uuid
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from .serializers import MsgpackSerializer
+
+__all__ = ['FragmentCacheExtension', 'MemoryFragmentCache', 'RedisFragmentCache']
+
+logger = logging.getLogger(__name__)
+
+
+class FragmentCache(abc.ABC):
+    """
+    后端需要实现 _get、_set、_acquire、_release、_wait
+
+    hits: 返回未过期的内容（包括等到的其他请求的渲染结果）
+    stale_hits: 其他请求正在重新渲染，返回过期的内容
+    misses: 本请求渲染
+    """
+
+    def __init__(self, grace=60, lock_timeout=10):
+        """
+        :param grace: 过期后继续保留的秒数，期间可以返回旧内容
+        :param lock_timeout: 渲染锁的有效期，也是等待渲染结果的最长时间
+        """
+        self.grace = grace
+        self.lock_timeout = lock_timeout
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def render(self, key, ttl, render):
+        """
+        :param key:
+        :param ttl: 秒
+        :param render: 渲染函数，返回 str
+        :return: str
+        """
+        entry = self._get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.time():
+                self.hits += 1
+                return value
+            if not self._acquire(key):
+                self.stale_hits += 1
+                return value
+        elif not self._acquire(key):
+            value = self._wait(key, self.lock_timeout)
+            if value is not None:
+                self.hits += 1
+                return value
+            # 渲染锁超时，自行渲染，不再加锁
+            self.misses += 1
+            value = render()
+            self._set(key, value, ttl)
+            return value
+
+        self.misses += 1
+        try:
+            value = render()
+            self._set(key, value, ttl)
+        finally:
+            self._release(key)
+        return value
+
+    @abc.abstractmethod
+    def _get(self, key):
+        """
+        :return: (value, expires)，不存在或已超过 grace 时为 None
+        """
+
+    @abc.abstractmethod
+    def _set(self, key, value, ttl):
+        """
+        保存渲染结果，expires 为 ttl 秒后，之后再保留 grace 秒
+        """
+
+    @abc.abstractmethod
+    def _acquire(self, key):
+        """
+        获取 key 的渲染锁
+        :return: 是否获取成功
+        """
+
+    @abc.abstractmethod
+    def _release(self, key):
+        """
+        释放本请求持有的渲染锁
+        """
+
+    @abc.abstractmethod
+    def _wait(self, key, timeout):
+        """
+        等待持有锁的请求渲染完成
+        :return: value，超时为 None
+        """
+
+
+class MemoryFragmentCache(FragmentCache):
+    """
+    进程内 LRU 缓存，渲染锁只在本进程内有效
+    """
+
+    def __init__(self, maxsize=1024, grace=60, lock_timeout=10):
+        super(MemoryFragmentCache, self).__init__(grace, lock_timeout)
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._rendering = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires + self.grace < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry
+
+    def _set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def _acquire(self, key):
+        with self._lock:
+            if key in self._rendering:
+                return False
+            self._rendering[key] = threading.Event()
+            return True
+
+    def _release(self, key):
+        with self._lock:
+            event = self._rendering.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def _wait(self, key, timeout):
+        with self._lock:
+            event = self._rendering.get(key)
+        if event is not None:
+            event.wait(timeout)
+        entry = self._get(key)
+        return entry[0] if entry is not None else None
+
+
+class RedisFragmentCache(FragmentCache):
+    """
+    redis 缓存，多进程共享，渲染锁为 `SET NX PX`。
+    redis 不可用时记录日志并直接渲染
+    """
+
+    serializer = MsgpackSerializer()
+    wait_interval = 0.05
+
+    _release_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, redis=None, key_prefix='fragment_cache:',
+                 grace=60, lock_timeout=10):
+        """
+        :param redis: A ``redis.StrictRedis`` instance.
+        :param key_prefix: A prefix that is added to all Redis store keys.
+        """
+        super(RedisFragmentCache, self).__init__(grace, lock_timeout)
+        if redis is None:
+            from redis import StrictRedis
+            redis = StrictRedis()
+        self.redis = redis
+        self.key_prefix = key_prefix
+        self._tokens = threading.local()
+        self._release_lock = redis.register_script(self._release_script)
+
+    def _lock_key(self, key):
+        return '%slock:%s' % (self.key_prefix, key)
+
+    def _get(self, key):
+        # 无法解码的条目（如序列化格式变化后的旧数据）视为未命中，重新渲染后覆盖
+        try:
+            data = self.redis.get(self.key_prefix + key)
+            if data is None:
+                return None
+            value, expires = self.serializer.loads(data)
+        except Exception as e:
+            logger.warning('fragment cache get failed: %r', e)
+            return None
+        return value, expires
+
+    def _set(self, key, value, ttl):
+        data = self.serializer.dumps([value, time.time() + ttl])
+        try:
+            self.redis.set(self.key_prefix + key, data,
+                           ex=max(int(ttl + self.grace), 1))
+        except Exception as e:
+            logger.warning('fragment cache set failed: %r', e)
+
+    def _acquire(self, key):
+        token = uuid.uuid4().hex
+        try:
+            acquired = self.redis.set(self._lock_key(key), token, nx=True,
+                                      px=int(self.lock_timeout * 1000))
+        except Exception as e:
+            # 无法加锁时照常渲染
+            logger.warning('fragment cache lock failed: %r', e)
+            return True
+        if acquired:
+            tokens = getattr(self._tokens, 'value', None)
+            if tokens is None:
+                tokens = self._tokens.value = {}
+            tokens[key] = token
+        return bool(acquired)
+
+    def _release(self, key):
+        tokens = getattr(self._tokens, 'value', None)
+        token = tokens.pop(key, None) if tokens else None
+        if token is None:
+            return
+        try:
+            self._release_lock(keys=[self._lock_key(key)], args=[token])
+        except Exception as e:
+            logger.warning('fragment cache unlock failed: %r', e)
+
+    def _wait(self, key, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(self.wait_interval)
+            entry = self._get(key)
+            if entry is not None:
+                return entry[0]
+        return None
+
+
+class FragmentCacheExtension(Extension):
+    """ `{% cache key[, ttl] %} ... {% endcache %}`
+    """
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(
+            fragment_cache=None,
+            fragment_cache_ttl=300,
+        )
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [nodes.Const(parser.name), parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', args),
+                               [], [], body).set_lineno(lineno)
+
+    def _cache(self, name, key, ttl, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+        if isinstance(key, (list, tuple)):
+            key = ':'.join(str(k) for k in key)
+        if ttl is None:
+            ttl = self.environment.fragment_cache_ttl
+        # 缓存渲染后的字符串，输出时不再转义
+        return Markup(cache.render('%s:%s' % (name, key), ttl, lambda: str(caller())))
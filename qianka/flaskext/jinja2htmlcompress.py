@@ -6,16 +6,43 @@
     compilation time without extra overhead.
     :copyright: (c) 2011 by Armin Ronacher.
     :license: BSD, see LICENSE for more details.
+
+    单次扫描的实现：标签、属性、注释的状态跨越 data token 保存，
+    isolated 元素的深度增量维护；属性值原样保留，
+    `<script>`/`<style>`/`<textarea>` 的内容不做解析，`<pre>` 内保留空白；
+    注释被删除（条件注释和 `<!--!` 开头的注释除外），
+    空白折叠为一个空格，只在块级元素前后删除。
+
+    配置保存在 environment 上：
+
+    - environment.html_compress: 是否压缩，None 时使用模块的 enabled（兼容旧用法）
+    - environment.html_compress_templates: 扩展名元组，名称以其结尾的模板
+      不需要 `{% strip %}` 整个压缩（仅 SelectiveHTMLCompress）
 """
 import re
 from jinja2.ext import Extension
 from jinja2.lexer import Token, describe_token
 from jinja2 import TemplateSyntaxError
 
+# 已废弃，使用 environment.html_compress
 enabled = False
 
-_tag_re = re.compile(r'(?:<(/?)([a-zA-Z0-9_-]+)\s*|(>\s*))(?s)')
-_ws_normalize_re = re.compile(r'[ \t\r\n]+')
+WHOLE_TEMPLATE_EXTENSIONS = ('.html', '.html.jinja')
+
+# 注释 | 标签名、属性、标签结束（标签在一个 token 中完整时） | `<!doctype`、`<?`
+_markup_re = re.compile(r'<(?:(!--)|(/?)([a-zA-Z][a-zA-Z0-9:_-]*)'
+                        r'((?:[^>"\']+|"[^"]*"|\'[^\']*\')*)(>)?|([!?]))')
+_tag_part_re = re.compile(r'["\'>]')
+_attr_ws_re = re.compile(r'("[^"]*"|\'[^\']*\')|\s+')
+_ws_normalize_re = re.compile(r'[ \t\r\n\f]+')
+_raw_end_res = {}
+
+
+def _attr_ws_replace(match):
+    return match.group(1) or ' '
+
+
+_TEXT, _TAG, _COMMENT, _RAW = range(4)
 
 
 class StreamProcessContext(object):
@@ -24,9 +51,27 @@ class StreamProcessContext(object):
         self.stream = stream
         self.token = None
         self.stack = []
+        # stack 中 isolated 元素的个数
+        self.isolated = 0
+        self.state = _TEXT
+        # _TAG: 标签名（`<!doctype` 等为 None），是否为结束标签，所在的引号；
+        # _RAW: 所在的元素
+        self.tag = None
+        self.closing = False
+        self.quote = None
+        # 已输出的内容以空格结尾
+        self.space = False
+        # 块级元素之后，删除接下来的空白
+        self.strip_next = False
+
+    def reset_whitespace(self):
+        """ 非 data token 可能有输出，不能跨过它合并空白 """
+        self.space = False
+        self.strip_next = False
 
     def fail(self, message):
-        raise TemplateSyntaxError(message, self.token.lineno,
+        token = self.token or self.stream.current
+        raise TemplateSyntaxError(message, token.lineno,
                                   self.stream.name, self.stream.filename)
 
 
@@ -38,15 +83,33 @@ def _make_dict_from_listing(listing):
     return rv
 
 
+def _raw_end_re(tag):
+    rv = _raw_end_res.get(tag)
+    if rv is None:
+        rv = _raw_end_res[tag] = re.compile(r'</%s(?=[\s/>]|$)' % tag, re.I)
+    return rv
+
+
 class HTMLCompress(Extension):
-    isolated_elements = {'script', 'style', 'noscript', 'textarea'}
+    # 保留空白
+    isolated_elements = {'script', 'style', 'noscript', 'textarea', 'pre'}
+    # 内容不是 HTML，直到结束标签前都原样输出
+    raw_text_elements = {'script', 'style', 'textarea'}
     void_elements = {
-        'br', 'img', 'area', 'hr', 'param', 'input', 'embed', 'col'
+        'br', 'img', 'area', 'hr', 'param', 'input', 'embed', 'col',
+        'meta', 'link', 'base', 'source', 'track', 'wbr', 'keygen'
     }
     block_elements = {
         'div', 'p', 'form', 'ul', 'ol', 'li', 'table', 'tr', 'tbody', 'thead',
         'tfoot', 'tr', 'td', 'th', 'dl', 'dt', 'dd', 'blockquote', 'h1', 'h2',
-        'h3', 'h4', 'h5', 'h6', 'pre'
+        'h3', 'h4', 'h5', 'h6', 'pre', 'address', 'article', 'aside',
+        'fieldset', 'figure', 'footer', 'header', 'hr', 'main', 'nav', 'section'
+    }
+    # 前后的空白不影响显示
+    strip_elements = block_elements | {
+        'html', 'head', 'body', 'title', 'meta', 'link', 'base', 'br',
+        'caption', 'colgroup', 'col', 'figcaption', 'legend', 'option',
+        'optgroup'
     }
     breaking_rules = _make_dict_from_listing([
         (['p'], {'#block'}),
@@ -57,11 +120,16 @@ class HTMLCompress(Extension):
         (['dd', 'dt'], {'dl', 'dt', 'dd'})
     ])
 
-    def is_isolated(self, stack):
-        for tag in reversed(stack):
-            if tag in self.isolated_elements:
-                return True
-        return False
+    def __init__(self, environment):
+        super(HTMLCompress, self).__init__(environment)
+        environment.extend(
+            html_compress=None,
+            html_compress_templates=(),
+        )
+
+    def is_enabled(self):
+        value = self.environment.html_compress
+        return enabled if value is None else value
 
     def is_breaking(self, tag, other_tag):
         breaking = self.breaking_rules.get(other_tag)
@@ -69,55 +137,181 @@ class HTMLCompress(Extension):
             ('#block' in breaking and tag in self.block_elements))
 
     def enter_tag(self, tag, ctx):
-        while ctx.stack and self.is_breaking(tag, ctx.stack[-1]):
-            self.leave_tag(ctx.stack[-1], ctx)
+        stack = ctx.stack
+        while stack and self.is_breaking(tag, stack[-1]):
+            if stack.pop() in self.isolated_elements:
+                ctx.isolated -= 1
         if tag not in self.void_elements:
-            ctx.stack.append(tag)
+            stack.append(tag)
+            if tag in self.isolated_elements:
+                ctx.isolated += 1
 
     def leave_tag(self, tag, ctx):
-        if not ctx.stack:
-            ctx.fail('Tried to leave "%s" but something closed '
-                     'it already' % tag)
-        if tag == ctx.stack[-1]:
-            ctx.stack.pop()
+        stack = ctx.stack
+        if stack and stack[-1] == tag:
+            stack.pop()
+            if tag in self.isolated_elements:
+                ctx.isolated -= 1
             return
-        for idx, other_tag in enumerate(reversed(ctx.stack)):
+        # 没有对应开始标签的结束标签（如 `{% block %}` 中关闭父模板中的元素）忽略
+        for idx, other_tag in enumerate(reversed(stack)):
             if other_tag == tag:
                 for num in range(idx + 1):
-                    ctx.stack.pop()
+                    if stack.pop() in self.isolated_elements:
+                        ctx.isolated -= 1
+                return
             elif not self.breaking_rules.get(other_tag):
-                break
+                return
 
     def normalize(self, ctx):
-        if not enabled:
-            return ctx.token.value
-
-        pos = 0
+        value = ctx.token.value
         buffer = []
+        append = buffer.append
+        pos = 0
+        end = len(value)
+        while pos < end:
+            state = ctx.state
+            if state == _TAG:
+                pos = self._process_tag(value, pos, buffer, ctx)
+                continue
+            elif state == _RAW:
+                match = _raw_end_re(ctx.tag).search(value, pos)
+                if match is None:
+                    append(value[pos:])
+                    break
+                append(value[pos:match.start()])
+                ctx.state = _TEXT
+                pos = match.start()
+                continue
+            elif state == _COMMENT:
+                close = value.find('-->', pos)
+                if close < 0:
+                    append(value[pos:])
+                    break
+                append(value[pos:close + 3])
+                ctx.state = _TEXT
+                pos = close + 3
+                continue
+
+            match = _markup_re.search(value, pos)
+            text = value[pos:match.start()] if match else value[pos:]
+            if text:
+                if ctx.isolated:
+                    append(text)
+                    ctx.space = ctx.strip_next = False
+                else:
+                    text = _ws_normalize_re.sub(' ', text)
+                    if ctx.space or ctx.strip_next:
+                        text = text.lstrip(' ')
+                    if text and match is not None and (
+                            match.group(6) or match.group(3) and
+                            match.group(3).lower() in self.strip_elements):
+                        text = text.rstrip(' ')
+                    if text:
+                        append(text)
+                        ctx.space = text[-1] == ' '
+                        ctx.strip_next = False
+            if match is None:
+                break
 
-        def write_data(value):
-            if not self.is_isolated(ctx.stack):
-                value = _ws_normalize_re.sub(' ', value.strip())
-            buffer.append(value)
-
-        for match in _tag_re.finditer(ctx.token.value):
-            closes, tag, sole = match.groups()
-            preamble = ctx.token.value[pos:match.start()]
-            write_data(preamble)
-            if sole:
-                write_data(sole)
+            comment, closing, tag, attrs, tag_end, other = match.groups()
+            if tag is not None:
+                if tag_end is None:
+                    # 标签在这个 token 中没有结束（如属性值中有 `{{ }}`），逐段处理
+                    append(value[match.start():match.end(3)])
+                    ctx.state = _TAG
+                    ctx.tag = tag.lower()
+                    ctx.closing = bool(closing)
+                    pos = match.end(3)
+                    continue
+                self_closing = False
+                if attrs:
+                    if '\n' in attrs or '  ' in attrs or '\t' in attrs:
+                        attrs = _attr_ws_re.sub(_attr_ws_replace, attrs)
+                    if attrs[-1] == '/':
+                        self_closing = True
+                        attrs = attrs[:-1].rstrip(' ') + '/'
+                    elif attrs[-1] == ' ':
+                        attrs = attrs.rstrip(' ')
+                append('<%s%s%s>' % (closing, tag, attrs))
+                ctx.closing = bool(closing)
+                self._finish_tag(ctx, tag.lower(), self_closing)
+                pos = match.end()
+            elif comment:
+                close = value.find('-->', match.end())
+                if close < 0:
+                    append(value[match.start():])
+                    ctx.state = _COMMENT
+                    break
+                if value.startswith(('[', '<!', '!'), match.end()):
+                    append(value[match.start():close + 3])
+                    ctx.space = ctx.strip_next = False
+                pos = close + 3
             else:
-                buffer.append(match.group())
-                (closes and self.leave_tag or self.enter_tag)(tag, ctx)
+                append(match.group())
+                ctx.state = _TAG
+                ctx.tag = None
+                pos = match.end()
+        return u''.join(buffer)
+
+    def _process_tag(self, value, pos, buffer, ctx):
+        while True:
+            if ctx.quote:
+                close = value.find(ctx.quote, pos)
+                if close < 0:
+                    buffer.append(value[pos:])
+                    return len(value)
+                buffer.append(value[pos:close + 1])
+                ctx.quote = None
+                pos = close + 1
+
+            match = _tag_part_re.search(value, pos)
+            chunk = value[pos:match.start()] if match else value[pos:]
+            if chunk:
+                chunk = _ws_normalize_re.sub(' ', chunk)
+            if match is None:
+                buffer.append(chunk)
+                return len(value)
+            char = match.group()
+            if char == '>':
+                self_closing = chunk.endswith('/')
+                if self_closing:
+                    chunk = chunk[:-1].rstrip(' ') + '/'
+                else:
+                    chunk = chunk.rstrip(' ')
+                buffer.append(chunk)
+                buffer.append(char)
+                self._finish_tag(ctx, ctx.tag, self_closing)
+                return match.end()
+            buffer.append(chunk)
+            buffer.append(char)
+            ctx.quote = char
             pos = match.end()
 
-        write_data(ctx.token.value[pos:])
-        return u''.join(buffer)
+    def _finish_tag(self, ctx, tag, self_closing):
+        ctx.state = _TEXT
+        ctx.space = False
+        ctx.strip_next = tag is None or tag in self.strip_elements
+        if tag is None:
+            return
+        if ctx.closing:
+            self.leave_tag(tag, ctx)
+        elif not self_closing:
+            self.enter_tag(tag, ctx)
+            if tag in self.raw_text_elements:
+                ctx.tag = tag
+                ctx.state = _RAW
 
     def filter_stream(self, stream):
+        if not self.is_enabled():
+            return stream
+        return self._filter_stream(stream)
+
+    def _filter_stream(self, stream):
         ctx = StreamProcessContext(stream)
         for token in stream:
             if token.type != 'data':
+                ctx.reset_whitespace()
                 yield token
                 continue
             ctx.token = token
@@ -126,37 +320,48 @@ class HTMLCompress(Extension):
 
 
 class SelectiveHTMLCompress(HTMLCompress):
+    """ 只压缩 `{% strip %} ... {% endstrip %}` 中的内容；
+    名称以 environment.html_compress_templates 中的扩展名结尾的模板整个压缩
+    """
+
+    def is_whole_template(self, name):
+        extensions = self.environment.html_compress_templates
+        return bool(extensions and name and name.endswith(tuple(extensions)))
+
     def filter_stream(self, stream):
         ctx = StreamProcessContext(stream)
+        compress = self.is_enabled()
+        whole = compress and self.is_whole_template(stream.name)
         strip_depth = 0
-        while 1:
-            if stream.current.type == 'block_begin':
-                if stream.look().test('name:strip') or \
-                   stream.look().test('name:endstrip'):
-                    stream.skip()
-                    if stream.current.value == 'strip':
-                        strip_depth += 1
-                    else:
-                        strip_depth -= 1
-                        if strip_depth < 0:
-                            ctx.fail('Unexpected tag endstrip')
-                    stream.skip()
-                    if stream.current.type != 'block_end':
-                        ctx.fail('expected end of block, got %s' %
-                                 describe_token(stream.current))
-                    stream.skip()
-            if strip_depth > 0 and stream.current.type == 'data':
-                ctx.token = stream.current
-                value = self.normalize(ctx)
-                yield Token(stream.current.lineno, 'data', value)
-            else:
-                yield stream.current
-            next(stream)
+        for token in stream:
+            if token.type == 'data':
+                if compress and (whole or strip_depth > 0):
+                    ctx.token = token
+                    token = Token(token.lineno, 'data', self.normalize(ctx))
+                yield token
+                continue
+            # 迭代时 stream.current 即为下一个 token
+            if token.type == 'block_begin' and stream.current.type == 'name' and \
+                    stream.current.value in ('strip', 'endstrip'):
+                if next(stream).value == 'strip':
+                    strip_depth += 1
+                else:
+                    strip_depth -= 1
+                    if strip_depth < 0:
+                        ctx.fail('Unexpected tag endstrip')
+                if stream.current.type != 'block_end':
+                    ctx.fail('expected end of block, got %s' %
+                             describe_token(stream.current))
+                next(stream)
+                continue
+            ctx.reset_whitespace()
+            yield token
 
 
 def _test():
     from jinja2 import Environment
     env = Environment(extensions=[HTMLCompress])
+    env.html_compress = True
     tmpl = env.from_string('''
         <html>
           <head>
@@ -176,17 +381,22 @@ def _test():
     print(tmpl.render(title=42, href='index.html'))
 
     env = Environment(extensions=[SelectiveHTMLCompress])
+    env.html_compress = True
     tmpl = env.from_string('''
         Normal   <span>  unchanged </span> stuff
         {% strip %}Stripped <span class=foo  >   test   </span>
-        <a href="foo">  test </a> {{ foo }}
+        <a href="foo"  title="a   >  b">  test </a> {{ foo }}
         Normal <stuff>   again {{ foo }}  </stuff>
+        <!-- removed -->
         <p>
           Foo<br>Bar
           Baz
         <p>
           Moep    <span>Test</span>    Moep
         </p>
+        <pre>
+  keep   {{ foo }}
+    this</pre>
         {% endstrip %}
     ''')
     print(tmpl.render(foo=42))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+按进程初始化的对象
+
+fork 只复制调用 fork 的线程，父进程中启动的后台线程、创建的线程池在子进程中
+不可用。ProcessLocal 在每个进程中首次使用时各自创建一次。
+"""
+import os
+import threading
+
+__all__ = ['ProcessLocal']
+
+
+class ProcessLocal(object):
+    """
+    Usage::
+
+        executor = ProcessLocal(ThreadPoolExecutor)
+        executor.get(8).submit(...)
+    """
+
+    def __init__(self, factory):
+        """
+        :param factory: 创建对象的函数，每个进程调用一次
+        """
+        self.factory = factory
+        self._pid = None
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self, *args, **kwargs):
+        """
+        :param args: 当前进程首次调用时传给 factory，之后忽略
+        :return: 当前进程的对象
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._value = self.factory(*args, **kwargs)
+                    self._pid = pid
+        return self._value
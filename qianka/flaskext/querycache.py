@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+查询结果缓存
+
+缓存条目记录所依赖的表在执行查询之前的版本号，读取时与当前版本比较；
+session 提交对某张表的写入后递增该表的版本号，使相关条目全部失效。
+
+get() 未命中时同时返回当时的版本号，执行查询后原样传给 set()。
+如果在 set() 时才读取版本号，查询期间其他进程提交的写入会被漏掉，
+旧的查询结果以新版本号缓存下来，直到 ttl 过期。
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from .serializers import MsgpackSerializer
+
+__all__ = ['MemoryQueryCache', 'RedisQueryCache']
+
+
+class MemoryQueryCache(object):
+    """
+    进程内 LRU 缓存。只能感知本进程提交的写入，
+    多进程部署时其他进程的写入要等 ttl 过期后才可见
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, tables):
+        """
+        :return: (value, versions)。未命中时 value 为 None
+        """
+        with self._lock:
+            current = tuple(self._versions.get(t, 0) for t in tables)
+            entry = self._data.get(key)
+            if entry is not None:
+                expires, versions, value = entry
+                if expires >= time.time() and versions == current:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value, current
+                del self._data[key]
+            self.misses += 1
+            return None, current
+
+    def set(self, key, tables, value, ttl, versions):
+        """
+        :param versions: 执行查询之前由 get() 返回的版本号
+        """
+        with self._lock:
+            self._data[key] = (time.time() + ttl, tuple(versions), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+
+class RedisQueryCache(object):
+    """
+    redis 缓存，多进程共享。条目以 msgpack 序列化，
+    读取条目与读取表版本号在同一个 pipeline 里完成
+    """
+
+    serializer = MsgpackSerializer()
+
+    def __init__(self, redis=None, key_prefix='query_cache:'):
+        """
+        :param redis: A ``redis.StrictRedis`` instance.
+        :param key_prefix: A prefix that is added to all Redis store keys.
+        """
+        if redis is None:
+            from redis import StrictRedis
+            redis = StrictRedis()
+        self.redis = redis
+        self.key_prefix = key_prefix
+        self.hits = 0
+        self.misses = 0
+
+    def _version_keys(self, tables):
+        return ['%sversion:%s' % (self.key_prefix, t) for t in tables]
+
+    def get(self, key, tables):
+        """
+        :return: (value, versions)。未命中时 value 为 None
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.key_prefix + key)
+        if tables:
+            pipe.mget(self._version_keys(tables))
+        result = pipe.execute()
+        current = [int(v or 0) for v in result[1]] if tables else []
+        if result[0] is not None:
+            versions, value = self.serializer.loads(result[0])
+            if list(versions) == current:
+                self.hits += 1
+                return value, current
+        self.misses += 1
+        return None, current
+
+    def set(self, key, tables, value, ttl, versions):
+        """
+        :param versions: 执行查询之前由 get() 返回的版本号
+        """
+        self.redis.setex(self.key_prefix + key, int(ttl),
+                         self.serializer.dumps([list(versions), value]))
+
+    def invalidate(self, tables):
+        pipe = self.redis.pipeline(transaction=False)
+        for version_key in self._version_keys(tables):
+            pipe.incr(version_key)
+        pipe.execute()
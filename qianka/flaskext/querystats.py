@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+SQL 执行统计
+
+QueryStats 记录一个 appctx 内各个 bind 的查询次数、总耗时和最慢的语句；
+同一语句（参数化后的 SQL）在一个请求中重复执行多次视为疑似 N+1。
+QueryStatsRegistry 在进程内按 endpoint 汇总每个请求的查询次数和耗时分布。
+"""
+from collections import Counter
+import heapq
+import threading
+
+__all__ = ['QueryStats', 'Histogram', 'QueryStatsRegistry']
+
+# 每个请求的查询次数
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+# 每个请求的查询总耗时（毫秒）
+TIME_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class QueryStats(object):
+    """ 一个 appctx 内的查询统计
+    """
+
+    def __init__(self, slowest=5):
+        """
+        :param slowest: 每个 bind 保留的最慢语句条数
+        """
+        self.slowest = slowest
+        self.binds = {}
+        self.shapes = Counter()
+
+    def record(self, bind, statement, elapsed):
+        stats = self.binds.get(bind)
+        if stats is None:
+            stats = self.binds[bind] = {'count': 0, 'time': 0.0, 'slowest': []}
+        stats['count'] += 1
+        stats['time'] += elapsed
+        if len(stats['slowest']) < self.slowest:
+            heapq.heappush(stats['slowest'], (elapsed, statement))
+        elif self.slowest and elapsed > stats['slowest'][0][0]:
+            heapq.heapreplace(stats['slowest'], (elapsed, statement))
+        self.shapes[(bind, statement)] += 1
+
+    @property
+    def count(self):
+        return sum(stats['count'] for stats in self.binds.values())
+
+    @property
+    def time(self):
+        return sum(stats['time'] for stats in self.binds.values())
+
+    def slowest_statements(self, bind):
+        """
+        :return: [(耗时秒数, 语句)]，由慢到快
+        """
+        stats = self.binds.get(bind)
+        return sorted(stats['slowest'], reverse=True) if stats else []
+
+    def nplusone(self, threshold):
+        """
+        :param threshold: 同一语句执行次数达到该值时视为疑似 N+1
+        :return: [(bind, 语句, 次数)]
+        """
+        return [(bind, statement, count)
+                for (bind, statement), count in self.shapes.most_common()
+                if count >= threshold]
+
+
+class Histogram(object):
+    """ 固定分桶的直方图，counts[i] 为不超过 bounds[i] 的观测数（不累计），
+    最后一个桶为 +inf
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.total = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            i = len(self.bounds)
+        self.counts[i] += 1
+        self.sum += value
+        self.total += 1
+
+    def export(self):
+        return {
+            'bounds': list(self.bounds),
+            'counts': list(self.counts),
+            'sum': self.sum,
+            'count': self.total,
+        }
+
+
+class QueryStatsRegistry(object):
+    """ 按 endpoint 汇总请求的查询统计，线程安全。
+    export() 的结果可以交给监控系统采集
+    """
+
+    def __init__(self, count_buckets=COUNT_BUCKETS, time_buckets=TIME_BUCKETS):
+        self.count_buckets = count_buckets
+        self.time_buckets = time_buckets
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, stats, nplusone=0):
+        """
+        :param endpoint:
+        :param stats: QueryStats
+        :param nplusone: 该请求中疑似 N+1 的语句数
+        """
+        with self._lock:
+            entry = self._endpoints.get(endpoint)
+            if entry is None:
+                entry = self._endpoints[endpoint] = {
+                    'queries': Histogram(self.count_buckets),
+                    'time_ms': Histogram(self.time_buckets),
+                    'nplusone': 0,
+                    'binds': Counter(),
+                }
+            entry['queries'].observe(stats.count)
+            entry['time_ms'].observe(stats.time * 1000)
+            entry['nplusone'] += nplusone
+            for bind, bind_stats in stats.binds.items():
+                entry['binds'][bind] += bind_stats['count']
+
+    def export(self):
+        """
+        :return: {endpoint: {'queries': ..., 'time_ms': ..., 'nplusone': ..., 'binds': ...}}
+        """
+        with self._lock:
+            return dict((endpoint, {
+                'queries': entry['queries'].export(),
+                'time_ms': entry['time_ms'].export(),
+                'nplusone': entry['nplusone'],
+                'binds': dict(entry['binds']),
+            }) for endpoint, entry in self._endpoints.items())
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+session 等数据的序列化
+
+数据格式为 `0xc1 + 格式字节 + 内容`。0xc1 是 msgpack 中唯一不会出现的首字节，
+因此不带格式头的旧数据（纯 msgpack）仍然可以正确解码。
+"""
+import datetime
+import decimal
+import uuid
+import zlib
+
+import msgpack
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+__all__ = ['MsgpackSerializer']
+
+MAGIC = b'\xc1'
+
+FORMAT_MSGPACK = b'\x01'
+FORMAT_MSGPACK_ZLIB = b'\x02'
+FORMAT_MSGPACK_LZ4 = b'\x03'
+
+EXT_DATETIME = 1
+EXT_DATE = 2
+EXT_DECIMAL = 3
+EXT_UUID = 4
+
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode('ascii'))
+    if isinstance(obj, datetime.date):
+        return msgpack.ExtType(EXT_DATE, obj.isoformat().encode('ascii'))
+    if isinstance(obj, decimal.Decimal):
+        return msgpack.ExtType(EXT_DECIMAL, str(obj).encode('ascii'))
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, obj.bytes)
+    raise TypeError('Cannot serialize %r' % (obj,))
+
+
+def _ext_hook(code, data):
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode('ascii'))
+    if code == EXT_DATE:
+        return datetime.date.fromisoformat(data.decode('ascii'))
+    if code == EXT_DECIMAL:
+        return decimal.Decimal(data.decode('ascii'))
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=data)
+    return msgpack.ExtType(code, data)
+
+
+class MsgpackSerializer(object):
+    """
+    msgpack 序列化，支持 datetime、date、Decimal、UUID，
+    超过 compress_threshold 字节的数据压缩保存（默认 zlib）。
+    lz4 需要显式指定 compression='lz4'：写入 lz4 数据之前，所有读取这些数据的
+    进程都必须已经安装 lz4
+
+    Usage::
+
+        RedisSessionInterface(redis, serializer=MsgpackSerializer(compress_threshold=512))
+    """
+
+    def __init__(self, compress_threshold=1024, compression='zlib'):
+        """
+        :param compress_threshold: 超过该字节数时压缩，None 表示不压缩
+        :param compression: 'zlib' 或 'lz4'
+        """
+        if compression == 'lz4' and lz4 is None:
+            raise ValueError('lz4 is not installed')
+        if compression not in ('lz4', 'zlib'):
+            raise ValueError('unknown compression: %r' % compression)
+        self.compress_threshold = compress_threshold
+        self.compression = compression
+
+    def dumps(self, value):
+        data = msgpack.dumps(value, use_bin_type=True, default=_default)
+        if self.compress_threshold is None or \
+                len(data) <= self.compress_threshold:
+            return MAGIC + FORMAT_MSGPACK + data
+        if self.compression == 'lz4':
+            compressed = lz4.block.compress(data)
+            fmt = FORMAT_MSGPACK_LZ4
+        else:
+            compressed = zlib.compress(data)
+            fmt = FORMAT_MSGPACK_ZLIB
+        if len(compressed) >= len(data):
+            return MAGIC + FORMAT_MSGPACK + data
+        return MAGIC + fmt + compressed
+
+    def loads(self, data):
+        if data[:1] != MAGIC:
+            # 不带格式头的旧数据
+            return self._unpack(data)
+        fmt = data[1:2]
+        if fmt == FORMAT_MSGPACK:
+            return self._unpack(data[2:])
+        if fmt == FORMAT_MSGPACK_ZLIB:
+            return self._unpack(zlib.decompress(data[2:]))
+        if fmt == FORMAT_MSGPACK_LZ4:
+            if lz4 is None:
+                raise ValueError('lz4 is not installed')
+            return self._unpack(lz4.block.decompress(data[2:]))
+        raise ValueError('unknown serializer format: %r' % fmt)
+
+    @staticmethod
+    def _unpack(data):
+        return msgpack.loads(data, raw=False, ext_hook=_ext_hook)
@@ -2,24 +2,119 @@
 """
 https://github.com/fengsp/flask-session
 """
+import base64
+import bisect
+from collections import OrderedDict
+import copy
+from datetime import datetime
 from flask.sessions import SessionMixin, SessionInterface
 import hashlib
-import msgpack
+import hmac
+import logging
+import threading
+import time
 from uuid import uuid4
 from werkzeug.datastructures import CallbackDict
 
+from .process import ProcessLocal
+from .serializers import MsgpackSerializer
+
+logger = logging.getLogger(__name__)
+
+
+class SessionUnavailable(Exception):
+    """
+    redis 不可用（熔断或调用失败），session 以降级模式运行
+    """
+
 
 class ServerSideSession(CallbackDict, SessionMixin):
     """Baseclass for server-side based sessions."""
 
     def __init__(self, initial=None, sid=None):
         def on_update(self):
-            self.modified = True
+            # 由字段改动触发，已记录在 changed_keys/deleted_keys 中
+            self._modified = True
         CallbackDict.__init__(self, initial, on_update)
         self.sid = sid
-        self.permanent = True
+        self.ttl = None
+        self.legacy_sid = False
+        self.degraded = False
+        # 初始值，不记为改动
+        dict.__setitem__(self, '_permanent', True)
         self.modified = False
         self.new = initial is None
+        self.reset_changes()
+
+    def reset_changes(self):
+        """
+        清空字段级改动记录，保存后调用。original 保存改动过的字段在改动前的值
+        """
+        self.changed_keys = set()
+        self.deleted_keys = set()
+        self.original = {}
+        self.force_replace = False
+
+    @property
+    def modified(self):
+        return self._modified
+
+    @modified.setter
+    def modified(self, value):
+        """
+        直接设置 session.modified = True 通常意味着就地修改了某个值
+        （如 session['cart'].append(...)），这种改动没有字段记录，保存时整体重写
+        """
+        self._modified = value
+        self.force_replace = bool(value)
+
+    def _mark_changed(self, key):
+        if key not in self.original:
+            self.original[key] = dict.get(self, key)
+        self.deleted_keys.discard(key)
+        self.changed_keys.add(key)
+
+    def _mark_deleted(self, key):
+        if key not in self.original:
+            self.original[key] = dict.get(self, key)
+        self.changed_keys.discard(key)
+        self.deleted_keys.add(key)
+
+    def __setitem__(self, key, value):
+        self._mark_changed(key)
+        super(ServerSideSession, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        if key in self:
+            self._mark_deleted(key)
+        super(ServerSideSession, self).__delitem__(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._mark_changed(key)
+        return super(ServerSideSession, self).setdefault(key, default)
+
+    def pop(self, key, *default):
+        if key in self:
+            self._mark_deleted(key)
+        return super(ServerSideSession, self).pop(key, *default)
+
+    def popitem(self):
+        item = super(ServerSideSession, self).popitem()
+        self.original.setdefault(item[0], item[1])
+        self._mark_deleted(item[0])
+        return item
+
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        for key in items:
+            self._mark_changed(key)
+        super(ServerSideSession, self).update(items)
+
+    def clear(self):
+        for key in self:
+            self._mark_deleted(key)
+        super(ServerSideSession, self).clear()
 
 
 class RedisSession(ServerSideSession):
@@ -29,24 +124,591 @@ class RedisSession(ServerSideSession):
     pass
 
 
+class LazyRedisSession(RedisSession):
+    """
+    延迟加载的 session，首次访问内容时才调用 loader 从 redis 读取数据；
+    从未访问过的 session 在保存时不会产生任何 redis 操作
+    """
+
+    loader = None
+    loaded = True
+
+    def __init__(self, initial=None, sid=None, loader=None):
+        super(LazyRedisSession, self).__init__(initial, sid)
+        if loader is not None:
+            self.loader = loader
+            self.loaded = False
+            self.new = False
+
+    def load(self):
+        """
+        读取 session 内容，loader 返回 None 时视为新 session
+        """
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            data, self.ttl = self.loader()
+        except SessionUnavailable:
+            self.degraded = True
+            data = None
+        self.loader = None
+        if data is None:
+            self.new = True
+            return
+        dict.update(self, data)
+
+
+def _lazy_method(name):
+    def method(self, *args, **kwargs):
+        self.load()
+        return getattr(super(LazyRedisSession, self), name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+for _name in ('__getitem__', '__setitem__', '__delitem__', '__contains__',
+              '__iter__', '__len__', '__eq__', '__ne__', '__repr__',
+              'get', 'keys', 'values', 'items', 'copy',
+              'setdefault', 'pop', 'popitem', 'update', 'clear'):
+    setattr(LazyRedisSession, _name, _lazy_method(_name))
+del _name
+
+
+class SessionCache(object):
+    """
+    进程内的 session 缓存（LRU + TTL），位于 RedisSessionInterface.redis 之前。
+
+    缓存的是 redis 返回的原始数据，每次命中时重新解码，避免请求之间共享
+    可变对象。通过 redis keyspace notifications 失效：后台线程订阅
+    `__keyspace@<db>__:<key_prefix>*`，收到事件即删除对应条目；
+    订阅未建立或连接断开期间不使用缓存，保证不会读到过期数据。
+
+    本进程写入 redis 时先用 expect() 登记写入的数据，写入产生的事件到达时
+    重新读取该 key，内容与登记的一致则保留缓存，写入后的读取可以直接命中。
+
+    redis 需要开启 keyspace notifications，例如::
+
+        CONFIG SET notify-keyspace-events Kgx$h
+
+    Usage::
+
+        RedisSessionInterface(redis, cache=SessionCache(maxsize=10000))
+    """
+
+    def __init__(self, maxsize=1024, ttl=5, listen=True, expect_timeout=2):
+        """
+        :param maxsize: 最多缓存的 session 数量，同时是记录最近失效的 key 的数量
+        :param ttl: 条目最长缓存秒数，同时限制了通知丢失时的最长不一致时间
+        :param listen: 是否订阅 keyspace notifications。为 False 时仅依赖 ttl
+                       失效，只适用于能够容忍 ttl 秒不一致的场景
+        :param expect_timeout: expect() 登记的有效秒数，之后到达的事件一律失效
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.listen = listen
+        self.expect_timeout = expect_timeout
+        self.hits = 0
+        self.misses = 0
+        # 每次失效递增；_invalidated 记录每个 key 最近一次失效时的 version，
+        # 超出 maxsize 后丢弃最早的记录并把 _floor 提高到它的 version
+        self.version = 0
+        self._floor = 0
+        self._invalidated = OrderedDict()
+        self._expected = OrderedDict()
+        self._fetch = None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._listeners = ProcessLocal(self._start_listeners)
+        self._subscriptions = []
+        self._listening = set()
+
+    def bind(self, nodes, key_prefix, fetch=None):
+        """
+        由 RedisSessionInterface 调用，指定需要订阅的 redis 节点及 key 前缀
+        :param nodes: redis 实例列表，每个节点各自订阅
+        :param key_prefix:
+        :param fetch: fetch(redis, key)，读取与 expect() 登记的数据可比较的原始数据；
+                      为 None 时不区分本进程的写入
+        """
+        self._fetch = fetch
+        self._subscriptions = []
+        for redis in nodes:
+            db = redis.connection_pool.connection_kwargs.get('db', 0)
+            channel_prefix = '__keyspace@%s__:' % db
+            self._subscriptions.append(
+                (redis, channel_prefix, channel_prefix + key_prefix + '*'))
+
+    @property
+    def listening(self):
+        """
+        所有节点的订阅均已建立
+        """
+        return len(self._listening) == len(self._subscriptions)
+
+    def _start_listeners(self):
+        with self._lock:
+            self._listening = set()
+            self._data.clear()
+        for index in range(len(self._subscriptions)):
+            thread = threading.Thread(target=self._listen, args=(index,),
+                                      name='session-cache-invalidator')
+            thread.daemon = True
+            thread.start()
+
+    def _listen(self, index):
+        redis, channel_prefix, pattern = self._subscriptions[index]
+        prefix_len = len(channel_prefix)
+        while True:
+            pubsub = redis.pubsub()
+            try:
+                pubsub.psubscribe(pattern)
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    if message['type'] == 'psubscribe':
+                        # 订阅建立之前缓存的数据可能已经过期
+                        self.clear()
+                        self._listening.add(index)
+                        logger.info('session cache: subscribed %s', pattern)
+                    elif message['type'] == 'pmessage':
+                        channel = message['channel']
+                        if isinstance(channel, bytes):
+                            channel = channel.decode('utf8')
+                        self.notify(redis, channel[prefix_len:])
+            except Exception as e:
+                logger.warning('session cache: %r', e)
+            finally:
+                self._listening.discard(index)
+                self.clear()
+                try:
+                    pubsub.close()
+                except Exception:
+                    pass
+            time.sleep(1)
+
+    def notify(self, redis, key):
+        """
+        收到 key 的 keyspace 事件。key 有未过期的 expect() 登记时重新读取，
+        与登记的数据一致说明是本进程的写入（或写入了相同内容），不失效
+        :param redis: 产生事件的节点
+        :param key:
+        """
+        with self._lock:
+            expected = self._expected.get(key)
+        if expected is not None and expected[0] >= time.time():
+            try:
+                if self._fetch(redis, key) == expected[1]:
+                    return
+            except Exception as e:
+                logger.warning('session cache: %r', e)
+        self.invalidate(key)
+
+    def expect(self, key, raw):
+        """
+        写入 redis 之前登记将要写入的原始数据
+        :param key:
+        :param raw: 写入完成后 fetch(redis, key) 应当返回的数据
+        """
+        if self._fetch is None or not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._expected.pop(key, None)
+            self._expected[key] = (now + self.expect_timeout, raw)
+            while self._expected:
+                first = next(iter(self._expected.values()))
+                if first[0] >= now and len(self._expected) <= self.maxsize:
+                    break
+                self._expected.popitem(last=False)
+
+    @property
+    def enabled(self):
+        if not self.listen:
+            return True
+        self._listeners.get()
+        return self.listening
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, version=None):
+        """
+        :param version: 读取或写入 redis 之前的 ``self.version``。
+                        期间该 key 失效过时不写入缓存，避免并发写入后缓存旧数据
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if version is not None and (
+                    version < self._floor or
+                    self._invalidated.get(key, version) > version):
+                return
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.version += 1
+            self._data.pop(key, None)
+            self._expected.pop(key, None)
+            self._invalidated.pop(key, None)
+            self._invalidated[key] = self.version
+            while len(self._invalidated) > self.maxsize:
+                _, version = self._invalidated.popitem(last=False)
+                self._floor = max(self._floor, version)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._floor = self.version
+            self._data.clear()
+            self._expected.clear()
+            self._invalidated.clear()
+
+
+class CircuitBreaker(object):
+    """
+    redis 调用的熔断器。
+
+    - closed: 正常调用。连续失败 failure_threshold 次后进入 open，
+      耗时超过 latency_budget 的调用也计为失败
+    - open: 直接拒绝调用（抛出 SessionUnavailable），reset_timeout 秒后进入 half_open
+    - half_open: 只放行一个探测调用，成功则恢复 closed，失败则回到 open
+
+    state 及各项计数可用于监控。latency_budget 只能在调用返回后判断是否超时，
+    真正限制单次调用耗时还需要为 redis 实例设置相同的 socket_timeout。
+
+    Usage::
+
+        RedisSessionInterface(
+            StrictRedis(socket_timeout=0.05, socket_connect_timeout=0.05),
+            breaker=CircuitBreaker(latency_budget=0.05))
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=10,
+                 latency_budget=None, name='default'):
+        """
+        :param failure_threshold: 连续失败多少次后熔断
+        :param reset_timeout: 熔断多少秒后尝试探测
+        :param latency_budget: 单次调用的耗时上限（秒）
+        :param name: 名称，用于日志及监控
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.latency_budget = latency_budget
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.total_failures = 0
+        self.rejected = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def __copy__(self):
+        return type(self)(self.failure_threshold, self.reset_timeout,
+                          self.latency_budget, self.name)
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning('circuit breaker %s: %s -> %s',
+                           self.name, self.state, state)
+            self.state = state
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and \
+                    time.time() - self.opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected += 1
+        raise SessionUnavailable('circuit breaker %s is %s'
+                                 % (self.name, self.state))
+
+    def _on_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._set_state(self.CLOSED)
+
+    def _on_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.total_failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                self._set_state(self.OPEN)
+
+    def call(self, func, *args, **kwargs):
+        self._before_call()
+        start = time.time()
+        try:
+            rv = func(*args, **kwargs)
+        except Exception:
+            self._on_failure()
+            raise
+        if self.latency_budget is not None and \
+                time.time() - start > self.latency_budget:
+            self._on_failure()
+        else:
+            self._on_success()
+        return rv
+
+
+class ConsistentHashRing(object):
+    """
+    一致性哈希，把 key 映射到多个 redis 节点之一，增减节点时只有约 1/N 的 key 需要迁移。
+    key 中包含 `{...}` 时只对花括号内的内容做哈希（与 Redis Cluster 的 hash tag 规则一致），
+    便于把相关的 key 放在同一个节点上
+    """
+
+    def __init__(self, nodes, replicas=160):
+        """
+        :param nodes: redis 实例列表，或 {节点名: redis 实例}。
+                      节点名决定 key 的分布，列表形式时使用 host:port/db
+        :param replicas: 每个节点的虚拟节点数
+        """
+        if isinstance(nodes, dict):
+            items = sorted(nodes.items())
+        else:
+            items = []
+            names = set()
+            for node in nodes:
+                name = self.node_name(node)
+                while name in names:
+                    name += '+'
+                names.add(name)
+                items.append((name, node))
+        self.names = [name for name, _ in items]
+        self.nodes = [node for _, node in items]
+
+        points = []
+        for name, node in items:
+            for i in range(replicas):
+                points.append((self._hash('%s#%d' % (name, i)), node))
+        points.sort(key=lambda point: point[0])
+        self._hashes = [point[0] for point in points]
+        self._points = [point[1] for point in points]
+
+    @staticmethod
+    def node_name(redis):
+        kwargs = redis.connection_pool.connection_kwargs
+        return '%s:%s/%s' % (kwargs.get('host'), kwargs.get('port'),
+                             kwargs.get('db', 0))
+
+    @staticmethod
+    def hash_tag(key):
+        start = key.find('{')
+        if start != -1:
+            end = key.find('}', start + 1)
+            if end > start + 1:
+                return key[start + 1:end]
+        return key
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(value.encode('utf8')).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        idx = bisect.bisect(self._hashes, self._hash(self.hash_tag(key)))
+        if idx == len(self._hashes):
+            idx = 0
+        return self._points[idx]
+
+
 class RedisSessionInterface(SessionInterface):
     """
-    使用服务端的 Redis 保存访问者 session，采用 msgpack 序列化数据
+    使用服务端的 Redis 保存访问者 session，默认采用 msgpack 序列化数据
     """
 
-    serializer = msgpack
+    serializer = MsgpackSerializer()
     session_class = RedisSession
+    lazy_session_class = LazyRedisSession
 
-    def __init__(self, redis=None, key_prefix='session:'):
+    def __init__(self, redis=None, key_prefix='session:', lazy=True,
+                 use_hash=False, refresh_threshold=None, cache=None,
+                 signed_sid=True, legacy_sid=True, serializer=None,
+                 breaker=None, user_key=None, user_index_prefix='session_user:'):
         """Uses the Redis key-value store as a session backend.
-        :param redis: A ``redis.StrictRedis`` instance.
+        :param redis: A ``redis.StrictRedis`` instance. 也可以是 redis 实例的列表或
+                      {节点名: redis 实例}，按 sid 一致性哈希分片保存；
+                      Redis Cluster 客户端直接作为单个实例传入即可
         :param key_prefix: A prefix that is added to all Redis store keys.
+        :param lazy: 首次访问 session 内容时才读取 redis
+        :param use_hash: 以 redis hash 保存 session，每个字段单独序列化，
+                         保存时只写入改动过的字段。与默认的整体存储格式不兼容，
+                         切换时应使用不同的 key_prefix
+        :param refresh_threshold: 滑动过期。读取 session 时一并读取剩余有效期，
+                                  低于 permanent_session_lifetime 的该比例
+                                  （例如 0.5）时，只发送 EXPIRE 并重新下发 cookie，
+                                  不重写 session 内容
+        :param cache: ``SessionCache`` 实例，进程内缓存 session，
+                      本进程的写入会同时更新缓存
+        :param signed_sid: cookie 使用带过期时间和完整 HMAC 的 sid 格式，
+                           过期或伪造的 cookie 在 open_session 里直接拒绝，不访问 redis
+        :param legacy_sid: 迁移期间继续接受旧格式（encode_sid）的 cookie，
+                           并在响应中换发新格式
+        :param serializer: 提供 dumps()/loads() 的序列化器，
+                           默认为 ``MsgpackSerializer``
+        :param breaker: ``CircuitBreaker`` 实例，每个 redis 节点使用一个副本。
+                        redis 不可用时请求得到空的、不会保存的 session，
+                        保存失败只记录日志
+        :param user_key: 保存用户编号的 session 字段名。设置后维护 用户 -> sid
+                         的索引（sorted set，score 为过期时间），与 session 的
+                         写入在同一个 pipeline 里完成，
+                         供 invalidate_user_sessions()/count_user_sessions() 使用
+        :param user_index_prefix: 用户索引 key 的前缀，不应以 key_prefix 开头
         """
         if redis is None:
             from redis import StrictRedis
-            redis = StrictRedis()
-        self.redis = redis
+            timeout = breaker.latency_budget if breaker is not None else None
+            redis = StrictRedis(socket_timeout=timeout,
+                                socket_connect_timeout=timeout)
+        if isinstance(redis, (list, tuple, dict)):
+            self.ring = ConsistentHashRing(redis)
+            self.redis = None
+            nodes = self.ring.nodes
+        else:
+            self.ring = None
+            self.redis = redis
+            nodes = [redis]
         self.key_prefix = key_prefix
+        self.lazy = lazy
+        self.use_hash = use_hash
+        self.refresh_threshold = refresh_threshold
+        self.cache = cache
+        self.signed_sid = signed_sid
+        self.legacy_sid = legacy_sid
+        self.user_key = user_key
+        self.user_index_prefix = user_index_prefix
+        if serializer is not None:
+            self.serializer = serializer
+        if cache is not None:
+            cache.bind(nodes, key_prefix, self.fetch_raw)
+
+        self.breakers = {}
+        self._node_breakers = {}
+        if breaker is not None:
+            names = self.ring.names if self.ring is not None else [breaker.name]
+            for name, node in zip(names, nodes):
+                node_breaker = breaker if self.ring is None else copy.copy(breaker)
+                node_breaker.name = name
+                self.breakers[name] = node_breaker
+                self._node_breakers[id(node)] = node_breaker
+
+    def get_redis(self, key):
+        """
+        :param key: redis key
+        :return: 保存该 key 的 redis 实例
+        """
+        if self.ring is None:
+            return self.redis
+        return self.ring.get_node(key)
+
+    def call_redis(self, key, func):
+        """
+        对保存 key 的 redis 实例执行 func(redis)，配置了 breaker 时受熔断器保护
+        """
+        redis = self.get_redis(key)
+        breaker = self._node_breakers.get(id(redis))
+        if breaker is None:
+            return func(redis)
+        return breaker.call(func, redis)
+
+    @staticmethod
+    def _execute(redis, commands):
+        # 单条命令直接执行，多条命令使用 pipeline
+        if len(commands) == 1:
+            name, args, kwargs = commands[0]
+            return getattr(redis, name)(*args, **kwargs)
+        pipe = redis.pipeline()
+        for name, args, kwargs in commands:
+            getattr(pipe, name)(*args, **kwargs)
+        return pipe.execute()
+
+    def execute_write(self, key, commands, index_commands=()):
+        """
+        在保存 key 的节点上执行 session 的写入命令。与 key 在同一节点上的用户索引命令
+        放进同一个 pipeline，分片时位于其他节点的索引命令在各自节点上执行
+        :param key: session key
+        :param commands: [(命令, args, kwargs)]
+        :param index_commands: [(索引 key, (命令, args, kwargs))]
+        """
+        node = self.get_redis(key)
+        commands = list(commands)
+        remote = {}
+        for index_key, command in index_commands:
+            index_node = self.get_redis(index_key)
+            if index_node is node:
+                commands.append(command)
+            else:
+                remote.setdefault(index_key, []).append(command)
+        self.call_redis(key, lambda redis: self._execute(redis, commands))
+        for index_key, index_commands in remote.items():
+            self.call_redis(index_key, lambda redis, c=index_commands:
+                            self._execute(redis, c))
+
+    def user_index_key(self, user_id):
+        return '%s%s' % (self.user_index_prefix, user_id)
+
+    def user_index_commands(self, app, session, removed=False):
+        """
+        维护用户索引的命令：当前用户的索引加入 sid 并清理过期的 sid，
+        用户变化（例如退出登录）时从原用户的索引中移除
+        :param app:
+        :param session:
+        :param removed: session 已被删除
+        :return: [(索引 key, (命令, args, kwargs))]
+        """
+        if self.user_key is None:
+            return []
+        user_id = None if removed else session.get(self.user_key)
+        original = session.original.get(self.user_key, user_id)
+        commands = []
+        if original is not None and original != user_id:
+            index_key = self.user_index_key(original)
+            commands.append((index_key, ('zrem', (index_key, session.sid), {})))
+        if user_id is not None:
+            index_key = self.user_index_key(user_id)
+            lifetime = int(app.permanent_session_lifetime.total_seconds())
+            now = time.time()
+            commands.extend([
+                (index_key, ('zadd', (index_key, {session.sid: now + lifetime}), {})),
+                (index_key, ('zremrangebyscore', (index_key, '-inf', now), {})),
+                (index_key, ('expire', (index_key, lifetime), {})),
+            ])
+        return commands
+
+    def dumps(self, value):
+        return self.serializer.dumps(value)
+
+    def loads(self, data):
+        return self.serializer.loads(data)
 
     @staticmethod
     def encode_sid(sid, salt):
@@ -77,6 +739,55 @@ class RedisSessionInterface(SessionInterface):
             return sid
         return None
 
+    @staticmethod
+    def _sid_signature(sid, expires, secret):
+        if not isinstance(secret, bytes):
+            secret = secret.encode('utf8')
+        msg = ('%s.%x' % (sid, expires)).encode('utf8')
+        digest = hmac.new(secret, msg, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+    @classmethod
+    def sign_sid(cls, sid, secret, expires):
+        """
+        编码 session_id，格式为 `{sid}.{过期时间}.{HMAC-SHA256}`
+        :param sid: 原始编号，服务端 redis 里使用的编号
+        :param secret: 共享密钥
+        :param expires: 过期时间，unix 时间戳
+        :return: 编码过的 sid
+        """
+        if not isinstance(sid, str):
+            return None
+        expires = int(expires)
+        return '%s.%x.%s' % (sid, expires,
+                             cls._sid_signature(sid, expires, secret))
+
+    @classmethod
+    def verify_sid(cls, data, secret, now=None):
+        """
+        解码并验证 sign_sid 编码的 session_id，只做本地计算
+        :param data: 编码过的 sid，客户端 cookie 里存放的编号
+        :param secret: 共享密钥
+        :param now: 当前时间，unix 时间戳
+        :return: 原始编号；如果已过期或验证错误，返回 None
+        """
+        if not isinstance(data, str):
+            return None
+        parts = data.split('.')
+        if len(parts) != 3:
+            return None
+        sid, expires, signature = parts
+        try:
+            expires = int(expires, 16)
+        except ValueError:
+            return None
+        if expires < (time.time() if now is None else now):
+            return None
+        if hmac.compare_digest(
+                cls._sid_signature(sid, expires, secret), signature):
+            return sid
+        return None
+
     def open_session(self, app, request):
         """
         从 redis 里获取 session 的内容
@@ -84,20 +795,167 @@ class RedisSessionInterface(SessionInterface):
         :param request:
         :return:
         """
-        sid = request.cookies.get(app.session_cookie_name)
-        sid = self.decode_sid(sid, app.secret_key)
+        data = request.cookies.get(app.session_cookie_name)
+        sid = None
+        legacy = False
+        if self.signed_sid:
+            sid = self.verify_sid(data, app.secret_key)
+        if not sid and (self.legacy_sid or not self.signed_sid) and \
+                data and '.' not in data:
+            # 旧格式的 sid 不包含 '.'
+            sid = self.decode_sid(data, app.secret_key)
+            legacy = self.signed_sid
         if not sid:
             sid = uuid4().hex
             return self.session_class(sid=sid)
-        val = self.redis.get(self.key_prefix + sid)
-        if val is not None:
+        if self.lazy:
+            session = self.lazy_session_class(
+                sid=sid, loader=lambda: self.load_session_data(app, sid))
+        else:
             try:
-                data = self.serializer.loads(val, encoding='utf8')
-                return self.session_class(data, sid=sid)
-            except Exception as e:
-                app.logger.warning(e)
-                return self.session_class(sid=sid)
-        return self.session_class(sid=sid)
+                data, ttl = self.load_session_data(app, sid)
+                session = self.session_class(data, sid=sid)
+                session.ttl = ttl
+            except SessionUnavailable:
+                session = self.session_class(sid=sid)
+                session.degraded = True
+        session.legacy_sid = legacy
+        return session
+
+    def load_session_data(self, app, sid):
+        """
+        从 redis 读取并解码 session 数据；开启滑动过期时在同一个 pipeline 里读取 TTL
+        :param app:
+        :param sid: 原始编号
+        :return: (session 数据, 剩余有效期秒数)；数据不存在或解码失败时为 None，
+                 未开启滑动过期时有效期为 None
+        :raise SessionUnavailable: 配置了 breaker 且 redis 不可用
+        """
+        key = self.key_prefix + sid
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            val, ttl, fetched = cached
+            if ttl is not None and ttl >= 0:
+                ttl -= int(time.time() - fetched)
+        elif self.cache is not None:
+            version = self.cache.version
+            val, ttl = self.fetch_session_data(app, key)
+            if val:
+                self.cache.set(key, (val, ttl, time.time()), version)
+        else:
+            val, ttl = self.fetch_session_data(app, key)
+        if not val:
+            return None, ttl
+        try:
+            return self.decode_session_data(val), ttl
+        except Exception as e:
+            app.logger.warning(e)
+            return None, ttl
+
+    def fetch_raw(self, redis, key):
+        """
+        读取 session 的原始数据，格式与缓存中的相同
+        :param redis:
+        :param key:
+        :return:
+        """
+        return redis.hgetall(key) if self.use_hash else redis.get(key)
+
+    def decode_session_data(self, val):
+        """
+        :param val: redis 返回的原始数据
+        :return: session 数据
+        """
+        if self.use_hash:
+            # 逐个字段解码
+            return dict((k.decode('utf8'), self.loads(v))
+                        for k, v in val.items())
+        return self.loads(val)
+
+    def fetch_session_data(self, app, key):
+        """
+        从 redis 读取 session 原始数据
+        :param app:
+        :param key:
+        :return: (原始数据, 剩余有效期秒数)
+        """
+        command = 'hgetall' if self.use_hash else 'get'
+
+        def fetch(redis):
+            if self.refresh_threshold is None:
+                return getattr(redis, command)(key), None
+            pipe = redis.pipeline(transaction=False)
+            getattr(pipe, command)(key)
+            pipe.ttl(key)
+            return tuple(pipe.execute())
+
+        try:
+            return self.call_redis(key, fetch)
+        except Exception as e:
+            if not self.breakers:
+                raise
+            if not isinstance(e, SessionUnavailable):
+                app.logger.warning('session load failed: %r', e)
+            raise SessionUnavailable(e)
+
+    def should_refresh(self, app, session):
+        """
+        滑动过期：剩余有效期低于阈值时需要刷新
+        :param app:
+        :param session:
+        :return:
+        """
+        if self.refresh_threshold is None or session.new or session.ttl is None:
+            return False
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        return session.ttl < lifetime * self.refresh_threshold
+
+    def save_session_fields(self, app, session):
+        """
+        以 redis hash 保存 session。新 session、未记录字段改动或直接设置过
+        session.modified 时整体重写，否则只写入改动和删除的字段
+        :param app:
+        :param session:
+        :return:
+        """
+        key = self.key_prefix + session.sid
+        lifetime = int(app.permanent_session_lifetime.total_seconds())
+        version = self.cache.version if self.cache is not None else None
+        replace = session.new or session.force_replace or \
+            not (session.changed_keys or session.deleted_keys)
+        if replace:
+            changed = dict(session)
+        else:
+            changed = dict((k, session[k]) for k in session.changed_keys)
+        fields = dict((k, self.dumps(v)) for k, v in changed.items())
+
+        commands = []
+        if replace:
+            commands.append(('delete', (key,), {}))
+        elif session.deleted_keys:
+            commands.append(('hdel', (key,) + tuple(session.deleted_keys), {}))
+        if fields:
+            commands.append(('hset', (key,), {'mapping': fields}))
+        commands.append(('expire', (key, lifetime), {}))
+
+        # 写入之后 redis 中的完整数据；只写部分字段且没有缓存时无法得知
+        val = None
+        if self.cache is not None:
+            cached = None if replace else self.cache.get(key)
+            if replace:
+                val = {}
+            elif cached is not None:
+                val = dict(cached[0])
+                for k in session.deleted_keys:
+                    val.pop(k.encode('utf8'), None)
+            if val is not None:
+                val.update((k.encode('utf8'), v) for k, v in fields.items())
+                self.cache.expect(key, val)
+
+        self.execute_write(key, commands,
+                           self.user_index_commands(app, session))
+        if val is not None:
+            self.cache.set(key, (val, lifetime, time.time()), version)
 
     def save_session(self, app, session, response):
         """
@@ -107,31 +965,190 @@ class RedisSessionInterface(SessionInterface):
         :param response:
         :return:
         """
-        domain = self.get_cookie_domain(app)
-        path = self.get_cookie_path(app)
+        if session.degraded:
+            # redis 不可用时的 session 不保存，也不改动 cookie
+            return
+
+        if not getattr(session, 'loaded', True):
+            # 未访问过的 session，无需任何 redis 操作
+            if session.legacy_sid:
+                self.set_session_cookie(app, session, response)
+            return
+
+        try:
+            refresh = self.write_session(app, session, response)
+        except Exception as e:
+            if not self.breakers:
+                raise
+            if not isinstance(e, SessionUnavailable):
+                app.logger.warning('session save failed: %r', e)
+            return
+        if refresh is None:
+            return
+
+        if not session.new and not refresh and not session.legacy_sid:
+            return
+
+        # 新 session、需要续期或旧格式 sid 的 session 设置 sid 至 cookie
+        self.set_session_cookie(app, session, response)
+
+    def write_session(self, app, session, response):
+        """
+        把 session 的改动写入 redis
+        :param app:
+        :param session:
+        :param response:
+        :return: 是否做了滑动过期续期；session 已删除时返回 None
+        """
+        key = self.key_prefix + session.sid
+        lifetime = int(app.permanent_session_lifetime.total_seconds())
         if not session:
             # 删除 session
             if session.modified:
-                self.redis.delete(self.key_prefix + session.sid)
+                self.execute_write(
+                    key, [('delete', (key,), {})],
+                    self.user_index_commands(app, session, removed=True))
+                if self.cache is not None:
+                    self.cache.invalidate(key)
                 response.delete_cookie(app.session_cookie_name,
-                                       domain=domain, path=path)
-            return
+                                       domain=self.get_cookie_domain(app),
+                                       path=self.get_cookie_path(app))
+            return None
 
+        refresh = self.should_refresh(app, session)
         if session.modified:
             # 保存改动过的 session
-            val = self.serializer.dumps(dict(session), use_bin_type=True, encoding='utf8')
-            self.redis.setex(self.key_prefix + session.sid,
-                             int(app.permanent_session_lifetime.total_seconds()),
-                             val)
+            if self.use_hash:
+                self.save_session_fields(app, session)
+            else:
+                val = self.dumps(dict(session))
+                version = self.cache.version if self.cache is not None else None
+                if self.cache is not None:
+                    self.cache.expect(key, val)
+                self.execute_write(key, [('setex', (key, lifetime, val), {})],
+                                   self.user_index_commands(app, session))
+                if self.cache is not None:
+                    self.cache.set(key, (val, lifetime, time.time()), version)
+            session.reset_changes()
+        elif refresh:
+            # 只读的 session 仅延长有效期，数据不变，缓存只需更新有效期
+            cached = None
+            if self.cache is not None:
+                version = self.cache.version
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self.cache.expect(key, cached[0])
+            self.execute_write(key, [('expire', (key, lifetime), {})],
+                               self.user_index_commands(app, session))
+            if cached is not None:
+                self.cache.set(key, (cached[0], lifetime, time.time()), version)
+        return refresh
 
-        if not session.new:
-            return
+    def count_user_sessions(self, user_id):
+        """
+        用户当前有效的 session 数量，需要设置 user_key
+        :param user_id:
+        :return:
+        """
+        index_key = self.user_index_key(user_id)
+        return self.call_redis(
+            index_key,
+            lambda redis: redis.zcount(index_key, '(%f' % time.time(), '+inf'))
+
+    def invalidate_user_sessions(self, user_id):
+        """
+        删除用户的所有 session（例如所有设备退出登录、修改密码后），需要设置 user_key
+        :param user_id:
+        :return: 删除的 session 数量
+        """
+        index_key = self.user_index_key(user_id)
+        sids = self.call_redis(
+            index_key, lambda redis: redis.zrange(index_key, 0, -1))
+        keys = [self.key_prefix + (sid.decode('utf8')
+                                   if isinstance(sid, bytes) else sid)
+                for sid in sids]
+        by_node = {}
+        for key in keys:
+            by_node.setdefault(id(self.get_redis(key)), []).append(key)
+        deleted = 0
+        for node_keys in by_node.values():
+            deleted += self.call_redis(
+                node_keys[0], lambda redis, k=node_keys: redis.delete(*k))
+        self.call_redis(index_key, lambda redis: redis.delete(index_key))
+        if self.cache is not None:
+            for key in keys:
+                self.cache.invalidate(key)
+        return deleted
 
-        # 新 session 设置 sid 至 cookie
+    def iter_sessions(self, batch_size=100, pause=0, with_data=True):
+        """
+        以 SCAN 分批遍历所有 session，供离线维护使用，不会长时间阻塞 redis
+        :param batch_size: 每批的数量（SCAN 的 COUNT）
+        :param pause: 每批之间暂停的秒数，用于限制对 redis 的压力
+        :param with_data: 是否同时读取并解码 session 数据（每批一个 pipeline）
+        :return: 逐批产出 [(sid, data)] 列表，不读取数据时 data 为 None
+        """
+        nodes = self.ring.nodes if self.ring is not None else [self.redis]
+        prefix_len = len(self.key_prefix)
+        for redis in nodes:
+            cursor = 0
+            while True:
+                cursor, keys = redis.scan(cursor, match=self.key_prefix + '*',
+                                          count=batch_size)
+                keys = [key.decode('utf8') if isinstance(key, bytes) else key
+                        for key in keys]
+                if keys:
+                    yield self._load_batch(redis, keys, prefix_len, with_data)
+                if not cursor:
+                    break
+                if pause:
+                    time.sleep(pause)
+
+    def _load_batch(self, redis, keys, prefix_len, with_data):
+        if not with_data:
+            return [(key[prefix_len:], None) for key in keys]
+        pipe = redis.pipeline(transaction=False)
+        for key in keys:
+            if self.use_hash:
+                pipe.hgetall(key)
+            else:
+                pipe.get(key)
+        batch = []
+        for key, val in zip(keys, pipe.execute()):
+            if not val:
+                # 已过期
+                continue
+            try:
+                data = self.decode_session_data(val)
+            except Exception as e:
+                logger.warning('session %s: %r', key, e)
+                continue
+            batch.append((key[prefix_len:], data))
+        return batch
+
+    def set_session_cookie(self, app, session, response):
+        """
+        下发 sid 至 cookie
+        :param app:
+        :param session:
+        :param response:
+        :return:
+        """
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
         httponly = self.get_cookie_httponly(app)
         secure = self.get_cookie_secure(app)
-        expires = self.get_expiration_time(app, session)
-        sid = self.encode_sid(session.sid, app.secret_key)
+        if getattr(session, 'loaded', True):
+            expires = self.get_expiration_time(app, session)
+        else:
+            # 未加载的 session 不知道 permanent，按 permanent 处理，避免为此读取 redis
+            expires = datetime.utcnow() + app.permanent_session_lifetime
+        if self.signed_sid:
+            lifetime = app.permanent_session_lifetime.total_seconds()
+            sid = self.sign_sid(session.sid, app.secret_key,
+                                time.time() + lifetime)
+        else:
+            sid = self.encode_sid(session.sid, app.secret_key)
         response.set_cookie(app.session_cookie_name, sid,
                             expires=expires, httponly=httponly,
                             domain=domain, path=path, secure=secure)
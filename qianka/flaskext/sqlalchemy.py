@@ -1,15 +1,238 @@
 # -*- coding: utf-8 -*-
+import bisect
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+import csv
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import operator
+import os
+import threading
+import time
 
+from flask import Response, request
+import msgpack
 from flask.globals import _app_ctx_stack
+from sqlalchemy import and_, bindparam, event, inspect, text
+from sqlalchemy.orm import Query, Session, object_mapper, scoped_session, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList, Grouping
+from sqlalchemy.sql.expression import Select
+from sqlalchemy.sql.util import find_tables
 
 from qianka.sqlalchemy import QKSession as SessionBase
 from qianka.sqlalchemy import QKSQLAlchemy
 
+from .process import ProcessLocal
+from .querystats import QueryStats, QueryStatsRegistry
+from .serializers import _default as _msgpack_default
 
-__all__ = ['QKFlaskSQLAlchemy', 'QKSession', 'QKShardSession']
+
+__all__ = ['QKFlaskSQLAlchemy', 'QKSession', 'QKShardSession', 'ShardRoutingError',
+           'WriteBufferError', 'modulo_shard', 'range_shard', 'lookup_shard']
 
 _CTX_ATTR = '_sqlalchemy_e7c4ed555c3ad9d68c4f4054efd80a40'  # md5(_sqlalchemy_use_bind_stack)
+_CTX_STICKY_ATTR = '_sqlalchemy_4422345eb105da33772be2c2270df268'  # md5(_sqlalchemy_sticky_until)
+_CTX_SHARD_ATTR = '_sqlalchemy_2b721f8521e081ee022c62079a2e4903'  # md5(_sqlalchemy_use_shard_stack)
+_CTX_QUERY_CACHE_ATTR = '_sqlalchemy_6aa6b40f26ce75d7580b7c1dc3040579'  # md5(_sqlalchemy_query_cache)
+_CTX_QUERY_STATS_ATTR = '_sqlalchemy_0a418a988907bdf03b3565cbb8c68f18'  # md5(_sqlalchemy_query_stats)
+_CTX_WRITE_BUFFER_ATTR = '_sqlalchemy_077e4e7813478770d54620e96cd9cd22'  # md5(_sqlalchemy_write_buffer)
+
+
+class ShardRoutingError(Exception):
+    """ 无法确定分片查询应发往哪个分片
+    """
+
+
+class WriteBufferError(Exception):
+    """ 写缓冲落库失败。failures 为失败的分组：
+    [{'bind': bind_key, 'table': 表名, 'kind': 'insert'/'update', 'rows': [...], 'error': 异常}]，
+    同一个 bind 的写入在一个事务中，失败时该 bind 的所有分组都不会写入
+    """
+    def __init__(self, failures):
+        super(WriteBufferError, self).__init__(
+            'write buffer flush failed: %s' % ', '.join(
+                '%s.%s (%d rows): %r' % (f['bind'] or 'default', f['table'],
+                                         len(f['rows']), f['error'])
+                for f in failures))
+        self.failures = failures
+
+
+def modulo_shard(bind_keys):
+    """ 按 shard_key 对分片数取模
+    :param bind_keys: 分片的 bind_key 列表
+    :return: shard_function
+    """
+    bind_keys = list(bind_keys)
+
+    def shard_function(shard_key):
+        return bind_keys[int(shard_key) % len(bind_keys)]
+    return shard_function
+
+
+def range_shard(ranges):
+    """ 按 shard_key 所在区间分片
+    :param ranges: [(上界（不含）, bind_key)]，上界为 None 表示无穷大
+    :return: shard_function
+    """
+    ranges = sorted(ranges, key=lambda r: float('inf') if r[0] is None else r[0])
+    bounds = [float('inf') if r[0] is None else r[0] for r in ranges]
+
+    def shard_function(shard_key):
+        idx = bisect.bisect_right(bounds, shard_key)
+        if idx == len(ranges):
+            raise ShardRoutingError('shard_key out of range: %r' % shard_key)
+        return ranges[idx][1]
+    return shard_function
+
+
+def lookup_shard(table, default=None):
+    """ 按对照表分片
+    :param table: {shard_key: bind_key}
+    :param default: 不在对照表中时使用的 bind_key
+    :return: shard_function
+    """
+    def shard_function(shard_key):
+        bind_key = table.get(shard_key, default)
+        if bind_key is None:
+            raise ShardRoutingError('unknown shard_key: %r' % shard_key)
+        return bind_key
+    return shard_function
+
+
+def default_probe(engine):
+    """ 默认的从库探测：执行 SELECT 1 检查连通性，复制延迟视为 0。
+    适用于 SQLite 等没有复制状态的数据库
+    :return: 复制延迟（秒）
+    """
+    with engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+    return 0
+
+
+def mysql_probe(engine):
+    """ MySQL 从库探测，读取 SHOW SLAVE STATUS 的 Seconds_Behind_Master
+    :return: 复制延迟（秒）；复制线程停止时为 inf
+    """
+    with engine.connect() as conn:
+        row = conn.execute(text('SHOW SLAVE STATUS')).first()
+    if row is None:
+        return 0
+    lag = getattr(row, '_mapping', row)['Seconds_Behind_Master']
+    return float('inf') if lag is None else lag
+
+
+class ReplicaHealthMonitor(object):
+    """ 从库健康检查
+
+    每个进程一个后台线程，每隔 interval 秒用 probe 探测各个从库的连通性和复制延迟，
+    不可达或延迟超过 max_lag 的从库暂时移出轮询，没有可用从库时回退到主库。
+    status 可用于监控
+    """
+    def __init__(self, db, bind_keys, probe=None, interval=5, max_lag=10):
+        """
+        :param db:
+        :param bind_keys: 需要探测的从库
+        :param probe: probe(engine) -> 复制延迟秒数，失败时抛出异常；默认为 default_probe
+        :param interval: 探测间隔（秒）
+        :param max_lag: 允许的最大复制延迟（秒）
+        """
+        self.db = db
+        self.bind_keys = list(bind_keys)
+        self.probe = probe or default_probe
+        self.interval = interval
+        self.max_lag = max_lag
+        self.status = {}
+        self._thread = ProcessLocal(self._start_thread)
+
+    def _start_thread(self):
+        thread = threading.Thread(target=self._run,
+                                  name='sqlalchemy-replica-monitor')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+    def check(self):
+        """ 探测所有从库一次
+        """
+        for bind_key in self.bind_keys:
+            start = time.time()
+            try:
+                lag = self.probe(self.db.get_engine(bind_key))
+                error = None
+            except Exception as e:
+                lag = None
+                error = repr(e)
+            healthy = error is None and lag <= self.max_lag
+            previous = self.status.get(bind_key)
+            self.status[bind_key] = {
+                'healthy': healthy,
+                'lag': lag,
+                'latency': time.time() - start,
+                'error': error,
+                'checked_at': time.time(),
+            }
+            if previous is None or previous['healthy'] != healthy:
+                log = self.db.app.logger.info if healthy else \
+                    self.db.app.logger.warning
+                log('sqlalchemy_replica: %s healthy=%s lag=%s error=%s'
+                    % (bind_key, healthy, lag, error))
+
+    def is_healthy(self, bind_key):
+        """ 未探测过的从库以及不在探测范围内的 bind 均视为正常
+        """
+        self._thread.get()
+        status = self.status.get(bind_key)
+        return status is None or status['healthy']
+
+
+class ReplicaPool(object):
+    """ 从库选择，供自动读写分离使用
+
+    - round_robin: 轮询
+    - least_in_flight: 选择连接池中已借出连接最少的从库
+    """
+    def __init__(self, db, bind_keys, strategy='round_robin', monitor=None):
+        if strategy not in ('round_robin', 'least_in_flight'):
+            raise ValueError('unknown replica strategy: %r' % strategy)
+        self.db = db
+        self.bind_keys = list(bind_keys)
+        self.strategy = strategy
+        self.monitor = monitor
+        self._counter = itertools.count()
+
+    def available(self):
+        if self.monitor is None:
+            return self.bind_keys
+        return [k for k in self.bind_keys if self.monitor.is_healthy(k)]
+
+    def choose(self):
+        """
+        :return: 从库的 bind_key；没有可用从库时返回 None
+        """
+        bind_keys = self.available()
+        if not bind_keys:
+            return None
+        if self.strategy == 'least_in_flight':
+            return min(bind_keys, key=self._in_flight)
+        return bind_keys[next(self._counter) % len(bind_keys)]
+
+    def _in_flight(self, bind_key):
+        pool = self.db.get_engine(bind_key).pool
+        checkedout = getattr(pool, 'checkedout', None)
+        return checkedout() if checkedout is not None else 0
 
 
 class QKSession(SessionBase):
@@ -18,19 +241,561 @@ class QKSession(SessionBase):
     def __init__(self, db, **kwargs):
         super(QKSession, self).__init__(db, **kwargs)
         self.app = db.app
+        # 本事务中写过的表，提交后使查询缓存失效
+        self.cache_dirty_tables = set()
+        # 本事务是否在主库上写过，提交时才需要重新开始 read-your-writes 窗口
+        self.wrote_primary = False
 
-    def get_bind(self, *args, **kwargs):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
         """ Customize database query routing (master/salve or sharding) here
         """
         ctx = _app_ctx_stack.top
-        stack = hasattr(ctx, _CTX_ATTR) and getattr(ctx, _CTX_ATTR, None)
-        if isinstance(stack, list) and len(stack) > 0:
+        stack = getattr(ctx, _CTX_ATTR, None)
+        if stack:
             bind_key = stack[-1]
-            engine = self.db.get_engine(bind_key)
-            self.app.logger.debug('sqlalchemy_use_bind: %s' % bind_key)
-            return engine
+            monitor = getattr(self.db, 'replica_monitor', None)
+            if monitor is None or monitor.is_healthy(bind_key):
+                engine = self.db.get_engine(bind_key)
+                self.app.logger.debug('sqlalchemy_use_bind: %s', bind_key)
+                return engine
+            # 指定的从库不可用，回退到主库
+            return super(QKSession, self).get_bind(mapper, clause, **kwargs)
+
+        replica_pool = getattr(self.db, 'replica_pool', None)
+        if replica_pool is not None and ctx is not None:
+            bind_key = self._route_replica(ctx, replica_pool, clause)
+            if bind_key is not None:
+                self.app.logger.debug('sqlalchemy_auto_bind: %s', bind_key)
+                return self.db.get_engine(bind_key)
+
+        return super(QKSession, self).get_bind(mapper, clause, **kwargs)
+
+    def _route_replica(self, ctx, replica_pool, clause):
+        """ 自动读写分离：不在 flush 中的 SELECT（非 FOR UPDATE）走从库，
+        其余走主库并开始 read-your-writes 窗口，窗口内的读也走主库
+        """
+        if not self._flushing and isinstance(clause, Select) and \
+                getattr(clause, '_for_update_arg', None) is None:
+            sticky_until = getattr(ctx, _CTX_STICKY_ATTR, None)
+            if sticky_until is None or sticky_until < time.time():
+                return replica_pool.choose()
+            return None
+
+        self._start_sticky(ctx)
+        self.wrote_primary = True
+        return None
+
+    def _start_sticky(self, ctx):
+        window = self.app.config['SQLALCHEMY_STICKY_SECONDS']
+        setattr(ctx, _CTX_STICKY_ATTR,
+                float('inf') if window is None else time.time() + window)
+
+    def execute(self, clause, *args, **kwargs):
+        if isinstance(clause, UpdateBase) and \
+                getattr(self.db, 'query_cache', None) is not None:
+            engine = kwargs.get('bind') or self.get_bind(kwargs.get('mapper'), clause)
+            self.cache_dirty_tables.add('%s.%s' % (
+                _cache_namespace(self.db, engine), clause.table.fullname))
+        return super(QKSession, self).execute(clause, *args, **kwargs)
+
+    def _flush_bind(self, mapper, instance):
+        """ flush 时对象写入的 engine，用于查询缓存失效
+        """
+        return self.get_bind(mapper)
+
+    def commit(self):
+        ctx = _app_ctx_stack.top
+        if self.wrote_primary:
+            # 只读事务的提交不影响后续读的路由
+            self.wrote_primary = False
+            if ctx is not None:
+                self._start_sticky(ctx)
+        rv = super(QKSession, self).commit()
+        if self.cache_dirty_tables:
+            tables, self.cache_dirty_tables = self.cache_dirty_tables, set()
+            self.db.query_cache.invalidate(sorted(tables))
+            if ctx is not None and hasattr(ctx, _CTX_QUERY_CACHE_ATTR):
+                delattr(ctx, _CTX_QUERY_CACHE_ATTR)
+        return rv
+
+    def rollback(self):
+        self.cache_dirty_tables.clear()
+        self.wrote_primary = False
+        return super(QKSession, self).rollback()
+
+
+_mapper_tables_memo = {}
+
+
+def _mapper_tables(mapper):
+    # 对象写入时涉及的表：继承链上的表以及多对多关系的关联表
+    tables = _mapper_tables_memo.get(mapper)
+    if tables is None:
+        tables = set(t.fullname for t in mapper.tables)
+        for rel in mapper.relationships:
+            if rel.secondary is not None:
+                tables.update(t.fullname for t in find_tables(rel.secondary))
+        _mapper_tables_memo[mapper] = tables
+    return tables
+
+
+def _cache_namespace(db, engine):
+    # 查询缓存按数据库区分：bind_key，默认数据库为 default。缓存键及表名都带上该前缀。
+    # 从库与默认数据库是同一份数据，主库的写入需要使从库查询的缓存失效
+    namespaces = db.query_cache_namespaces
+    namespace = namespaces.get(engine)
+    if namespace is None:
+        app = db.app
+        replicas = set(app.config['SQLALCHEMY_REPLICA_BINDS'])
+        for bind_key in _configured_bind_keys(app):
+            namespaces.setdefault(
+                db.get_engine(bind_key),
+                'default' if bind_key is None or bind_key in replicas else bind_key)
+        # 不在配置中的 engine（如直接传入的 bind）
+        namespace = namespaces.setdefault(engine, repr(engine.url))
+    return namespace
+
+
+@event.listens_for(QKSession, 'after_flush')
+def _record_flushed_tables(session, flush_context):
+    if getattr(session.db, 'query_cache', None) is None:
+        return
+    for instance in itertools.chain(session.new, session.dirty, session.deleted):
+        mapper = object_mapper(instance)
+        namespace = _cache_namespace(session.db, session._flush_bind(mapper, instance))
+        session.cache_dirty_tables.update(
+            '%s.%s' % (namespace, table) for table in _mapper_tables(mapper))
+
+
+def _and_conditions(where):
+    # 顶层 AND 连接的各个条件（展开嵌套的 AND 和括号）；OR、NOT 等整体作为一个条件，
+    # 其中的等式不能用于路由
+    if isinstance(where, Grouping):
+        where = where.element
+    if isinstance(where, BooleanClauseList) and where.operator is operators.and_:
+        for clause in where.clauses:
+            for condition in _and_conditions(clause):
+                yield condition
+    else:
+        yield where
+
+
+class ShardQuery(Query):
+    """ QKShardSession 的 Query：分片模型的查询把所在分片记录为结果对象的
+    identity token，并直接使用该分片的连接
+    """
+    def _get_bind_args(self, querycontext, fn, **kwargs):
+        if not isinstance(self.session, QKShardSession):
+            # scatter() 在各分片的独立 session 中执行
+            return super(ShardQuery, self)._get_bind_args(querycontext, fn, **kwargs)
+        mapper = self._bind_mapper()
+        if querycontext.identity_token is None:
+            # 刷新已加载的对象时 identity token 已经确定
+            querycontext.identity_token = self.session.shard_id_for(
+                mapper, querycontext.statement)
+        if querycontext.identity_token is not None:
+            kwargs['shard_id'] = querycontext.identity_token
+        return fn(mapper=mapper, clause=querycontext.statement, **kwargs)
+
+    def _get_impl(self, primary_key_identity, db_load_fn, identity_token=None):
+        # get() 只在 db.use_shard() 指定的分片中查找
+        if identity_token is None and isinstance(self.session, QKShardSession) and \
+                self.session._shard_key_name(self._only_full_mapper_zero('get')):
+            stack = self.session._shard_stack()
+            if stack:
+                identity_token = stack[-1]
+        return super(ShardQuery, self)._get_impl(
+            primary_key_identity, db_load_fn, identity_token=identity_token)
+
+
+class QKShardSession(QKSession):
+    """ 分片 session
+
+    模型通过 `__shard_key__` 声明分片字段，shard_function(shard_key) 返回 bind_key：
+
+    - flush 时按对象的分片字段写入对应分片
+    - 查询按 WHERE 中顶层 AND 条件里的 `分片字段 == 值` 路由；也可以用
+      db.use_shard() 指定。OR 等其他条件无法确定分片，抛出 ShardRoutingError
+    - 跨分片查询使用 scatter()，在线程池中并行执行并合并结果
+    - 对象的 identity key 包含所在分片的 bind_key（identity token），
+      不同分片中主键相同的行是不同的对象。query.get() 需要在 db.use_shard() 中调用
+
+    未声明 `__shard_key__` 的模型与 QKSession 相同
+    """
+    def __init__(self, db, **kwargs):
+        kwargs.setdefault('query_cls', ShardQuery)
+        super(QKShardSession, self).__init__(db, **kwargs)
+        self.connection_callable = self._connection_for_instance
+
+    def _connection_for_instance(self, mapper=None, instance=None, **kwargs):
+        # flush 时为每个对象选择连接。已持久化的对象写回加载时的分片，
+        # 新对象按分片字段选择分片并记录为 identity token
+        shard_key = self._shard_key_name(mapper)
+        if shard_key is not None and instance is not None:
+            state = inspect(instance)
+            if state.key is not None and state.key[2] is not None:
+                bind_key = state.key[2]
+            else:
+                bind_key = self.db.shard_function(getattr(instance, shard_key))
+                state.identity_token = bind_key
+            return self.connection(mapper, shard_id=bind_key, **kwargs)
+        return self.connection(mapper, **kwargs)
+
+    @staticmethod
+    def _shard_key_name(mapper):
+        if mapper is None:
+            return None
+        return getattr(mapper.class_, '__shard_key__', None)
+
+    def _flush_bind(self, mapper, instance):
+        state = inspect(instance)
+        if state.key is not None and state.key[2] is not None:
+            return self.db.get_engine(state.key[2])
+        return super(QKShardSession, self)._flush_bind(mapper, instance)
+
+    def get_bind(self, mapper=None, clause=None, shard_id=None, **kwargs):
+        if shard_id is not None:
+            return self.db.get_engine(shard_id)
+
+        shard_id = self.shard_id_for(mapper, clause)
+        if shard_id is None:
+            return super(QKShardSession, self).get_bind(mapper, clause, **kwargs)
+        return self.db.get_engine(shard_id)
+
+    def shard_id_for(self, mapper, clause):
+        """ 分片模型的查询应发往的分片
+
+        :return: bind_key；mapper 不是分片模型时返回 None
+        :raise ShardRoutingError: 无法确定分片
+        """
+        shard_key = self._shard_key_name(mapper)
+        if shard_key is None:
+            return None
+
+        stack = self._shard_stack()
+        if stack:
+            return stack[-1]
+
+        value = self._shard_value_from_clause(mapper, shard_key, clause)
+        if value is None:
+            raise ShardRoutingError(
+                '%s: cannot find "%s == ?" in the top-level AND conditions of the '
+                'query, use db.use_shard() or scatter()' % (mapper.class_.__name__, shard_key))
+        return self.db.shard_function(value)
+
+    @staticmethod
+    def _shard_stack():
+        ctx = _app_ctx_stack.top
+        return getattr(ctx, _CTX_SHARD_ATTR, None) if ctx is not None else None
+
+    @staticmethod
+    def _shard_value_from_clause(mapper, shard_key, clause):
+        if clause is None:
+            return None
+        where = getattr(clause, 'whereclause', None)
+        if where is None:
+            where = getattr(clause, '_whereclause', None)
+        if where is None:
+            return None
+        column = mapper.get_property(shard_key).columns[0]
+        for element in _and_conditions(where):
+            if isinstance(element, BinaryExpression) and \
+                    element.operator is operators.eq:
+                left, right = element.left, element.right
+                if isinstance(left, BindParameter):
+                    left, right = right, left
+                if isinstance(right, BindParameter) and \
+                        hasattr(left, 'shares_lineage') and \
+                        left.shares_lineage(column):
+                    return right.effective_value
+        return None
+
+    def scatter(self, query, order_by=None, reverse=False, limit=None,
+                bind_keys=None):
+        """ 在所有分片上并行执行查询并合并结果
+
+        :param query: ORM Query 或 Core Select。ORM 查询返回的对象已与 session 分离
+        :param order_by: 合并时的排序，字段名、字段名列表或 key 函数
+        :param reverse: 倒序
+        :param limit: 合并后最多返回的条数。同时作用于每个分片的查询，
+                      指定 order_by 时 query 自身应带有一致的 ORDER BY
+        :param bind_keys: 只查询这些分片，默认为 SQLALCHEMY_SHARD_BINDS
+        :return: list
+        """
+        if bind_keys is None:
+            bind_keys = self.db.shard_binds
+        if limit is not None:
+            query = query.limit(limit)
+        futures = [_shard_executor(self.app).submit(
+            _execute_on_shard, self.db.get_engine(bind_key), query)
+            for bind_key in bind_keys]
+        results = [future.result() for future in futures]
+
+        if order_by is None:
+            rows = list(itertools.chain.from_iterable(results))
+            return rows if limit is None else rows[:limit]
+        if callable(order_by):
+            key = order_by
+        elif isinstance(order_by, (list, tuple)):
+            key = operator.attrgetter(*order_by)
+        else:
+            key = operator.attrgetter(order_by)
+        if limit is not None:
+            nbest = heapq.nlargest if reverse else heapq.nsmallest
+            return nbest(limit, itertools.chain.from_iterable(results), key=key)
+        return sorted(itertools.chain.from_iterable(results), key=key,
+                      reverse=reverse)
+
+
+_shard_executor_pool = ProcessLocal(ThreadPoolExecutor)
+
+
+def _shard_executor(app):
+    return _shard_executor_pool.get(app.config['SQLALCHEMY_SHARD_WORKERS'])
+
+
+def _execute_on_shard(engine, query):
+    # 在工作线程中执行，使用独立的连接和 session
+    if isinstance(query, Query):
+        session = Session(bind=engine)
+        try:
+            rows = query.with_session(session).all()
+            session.expunge_all()
+            return rows
+        finally:
+            session.close()
+    with engine.connect() as conn:
+        return conn.execute(query).fetchall()
+
+
+def _query_cache_key(engine, stmt, namespace):
+    compiled = stmt.compile(dialect=engine.dialect)
+    params = sorted(compiled.params.items(), key=operator.itemgetter(0))
+    raw = '%s\n%s\n%s\n%r' % (namespace, engine.dialect.name, compiled.string, params)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def _entity_mapper(query):
+    # 只查询单个模型（非别名）时返回其 mapper，结果可以还原为对象
+    descriptions = query.column_descriptions
+    if len(descriptions) == 1 and isinstance(descriptions[0]['type'], type) and \
+            descriptions[0]['expr'] is descriptions[0]['type']:
+        return inspect(descriptions[0]['type'])
+    return None
+
+
+def _restore_instances(mapper, keys, rows):
+    columns = [(prop.key, prop.columns[0].name) for prop in mapper.column_attrs]
+    instances = []
+    for row in rows:
+        data = dict(zip(keys, row))
+        instance = mapper.class_manager.new_instance()
+        for attr, name in columns:
+            if name in data:
+                set_committed_value(instance, attr, data[name])
+        make_transient_to_detached(instance)
+        instances.append(instance)
+    return instances
+
+
+_row_classes = {}
+
+
+def _row_class(keys):
+    # 缓存结果的行类型，同一组列名共用一个 namedtuple；不能作为属性名的列名按位置重命名
+    keys = tuple(keys)
+    row_class = _row_classes.get(keys)
+    if row_class is None:
+        row_class = _row_classes[keys] = namedtuple('Row', keys, rename=True)
+    return row_class
+
+
+class WriteBuffer(object):
+    """ appctx 内的写缓冲，按 (bind_key, insert/update, 表) 分组保存待写入的行
+    """
+    def __init__(self):
+        self.groups = OrderedDict()
+        self.size = 0
+
+    def add(self, bind_key, kind, mapper, table, row):
+        self.groups.setdefault((bind_key, kind, mapper, table), []).append(row)
+        self.size += 1
+
+
+def _buffer_target(target):
+    # 模型类或 Table -> (mapper, table)
+    if hasattr(target, 'insert') and hasattr(target, 'primary_key'):
+        return None, target
+    mapper = inspect(target)
+    if len(mapper.tables) != 1:
+        raise ValueError('%s: models mapped to multiple tables cannot be buffered'
+                         % mapper.class_.__name__)
+    return mapper, mapper.local_table
+
 
-        return super(QKSession, self).get_bind(*args, **kwargs)
+def _buffer_row(mapper, table, values):
+    # 属性名 -> 列名
+    if mapper is None:
+        row = dict(values)
+    else:
+        row = dict((mapper.get_property(key).columns[0].key, value)
+                   for key, value in values.items())
+    unknown = set(row) - set(table.c.keys())
+    if unknown:
+        raise ValueError('%s: unknown columns %s' % (table.name, ', '.join(sorted(unknown))))
+    return row
+
+
+def _buffer_statements(kind, table, rows):
+    # 生成 [(语句, executemany 参数)]。executemany 的每组参数必须包含相同的列，
+    # 按列集合分组，未给出的列在 INSERT 中使用默认值
+    shapes = OrderedDict()
+    for row in rows:
+        shapes.setdefault(tuple(sorted(row)), []).append(row)
+    if kind == 'insert':
+        return [(table.insert(), shape_rows) for shape_rows in shapes.values()]
+    pk_keys = [c.key for c in table.primary_key.columns]
+    statements = []
+    for keys, shape_rows in shapes.items():
+        stmt = table.update().where(and_(*[
+            table.c[k] == bindparam('pk_' + k) for k in pk_keys])).values(dict(
+                (k, bindparam('v_' + k)) for k in keys if k not in pk_keys))
+        statements.append((stmt, [dict(
+            (('pk_' if k in pk_keys else 'v_') + k, v) for k, v in row.items())
+            for row in shape_rows]))
+    return statements
+
+
+class _RowStream(object):
+    """ 流式响应的 body：逐批读取服务端游标并编码。
+    迭代结束、客户端断开（WSGI 服务器调用 close()）或响应未被迭代时都会释放连接
+    """
+    def __init__(self, conn, result, encoder, batch_size):
+        self.conn = conn
+        self.result = result
+        self.encoder = encoder
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        try:
+            keys = list(self.result.keys())
+            head = self.encoder.head(keys)
+            if head:
+                yield head
+            while True:
+                rows = self.result.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                yield self.encoder.rows(keys, rows)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            try:
+                self.result.close()
+            finally:
+                conn.close()
+
+
+class _CSVEncoder(object):
+    mimetype = 'text/csv'
+
+    def head(self, keys):
+        return self.rows(None, [keys])
+
+    def rows(self, keys, rows):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerows(rows)
+        return buf.getvalue().encode('utf-8')
+
+
+class _NDJSONEncoder(object):
+    mimetype = 'application/x-ndjson'
+
+    def head(self, keys):
+        return None
+
+    def rows(self, keys, rows):
+        return ''.join(json.dumps(dict(zip(keys, row)), ensure_ascii=False,
+                                  default=str) + '\n'
+                       for row in rows).encode('utf-8')
+
+
+class _MsgpackEncoder(object):
+    """ 第一个对象为列名数组，之后每行一个数组 """
+    mimetype = 'application/x-msgpack'
+
+    def __init__(self):
+        self.packer = msgpack.Packer(use_bin_type=True, default=_msgpack_default)
+
+    def head(self, keys):
+        return self.packer.pack(keys)
+
+    def rows(self, keys, rows):
+        return b''.join(self.packer.pack(list(row)) for row in rows)
+
+
+_STREAM_ENCODERS = {
+    'csv': _CSVEncoder,
+    'ndjson': _NDJSONEncoder,
+    'msgpack': _MsgpackEncoder,
+}
+
+
+def _configured_bind_keys(app):
+    # 默认数据库（None）以及 SQLALCHEMY_BINDS 中的所有 bind
+    bind_keys = list(app.config.get('SQLALCHEMY_BINDS') or ())
+    if app.config.get('SQLALCHEMY_DATABASE_URI'):
+        bind_keys.insert(0, None)
+    return bind_keys
+
+
+def _recreate_pool(engine):
+    # 丢弃从父进程继承的连接池，但不关闭其中的连接：
+    # 连接的 socket 与父进程共享，关闭会影响父进程
+    try:
+        engine.dispose(close=False)
+    except TypeError:
+        # SQLAlchemy < 1.4.33
+        engine.pool = engine.pool.recreate()
+
+
+def _connect(engine):
+    # 预热用，失败时返回异常对象
+    try:
+        return engine.connect()
+    except Exception as e:
+        return e
+
+
+def _record_queries(engine, bind, slowest):
+    # 记录 engine 上执行的每条语句到当前 appctx 的 QueryStats
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('query_start_time', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        elapsed = time.time() - conn.info['query_start_time'].pop()
+        ctx = _app_ctx_stack.top
+        if ctx is None:
+            return
+        stats = getattr(ctx, _CTX_QUERY_STATS_ATTR, None)
+        if stats is None:
+            stats = QueryStats(slowest)
+            setattr(ctx, _CTX_QUERY_STATS_ATTR, stats)
+        stats.record(bind, statement, elapsed)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('query_start_time'):
+            conn.info['query_start_time'].pop()
 
 
 class QKFlaskSQLAlchemy(object):
@@ -44,11 +809,56 @@ class QKFlaskSQLAlchemy(object):
         db.session.query(...)
     - 支持多 session 用法：
         db.get_session('master').query(...)
+    - 自动读写分离（SQLALCHEMY_AUTO_ROUTING = True）：
+        SELECT 查询轮流发往 SQLALCHEMY_REPLICA_BINDS 中的从库，写入走主库；
+        同一 appctx 内 flush/commit 之后的 SQLALCHEMY_STICKY_SECONDS 秒内
+        （None 表示直到 appctx 结束）读也走主库。db.use_bind() 优先
+    - 从库健康检查（SQLALCHEMY_REPLICA_HEALTH_CHECK = True）：
+        后台探测 SQLALCHEMY_REPLICA_BINDS 中各从库，不可达或复制延迟超过
+        SQLALCHEMY_REPLICA_MAX_LAG 秒的从库不再使用（包括 use_bind 指定的），
+        回退到主库。探测函数由 SQLALCHEMY_REPLICA_PROBE 指定，
+        状态见 db.replica_monitor.status
+    - 分片（QKShardSession）：
+        db.shard_session 按模型的 `__shard_key__` 路由到 SQLALCHEMY_SHARD_BINDS
+        中的分片，分片函数为 SQLALCHEMY_SHARD_FUNCTION（默认取模，另有
+        range_shard/lookup_shard）。跨分片查询使用 db.scatter()，
+        在最多 SQLALCHEMY_SHARD_WORKERS 个线程中并行执行
+    - 查询结果缓存（SQLALCHEMY_QUERY_CACHE = MemoryQueryCache() 或 RedisQueryCache()）：
+        db.cache_query() 缓存查询结果，默认 SQLALCHEMY_QUERY_CACHE_TTL 秒；
+        session 提交对某张表的写入后，依赖该表的缓存全部失效
+    - SQL 统计（SQLALCHEMY_RECORD_QUERIES = True）：
+        按 bind 记录每个 appctx 的查询次数、总耗时和最慢的
+        SQLALCHEMY_RECORD_SLOWEST 条语句（db.get_query_stats()）；同一语句
+        重复 SQLALCHEMY_NPLUSONE_THRESHOLD 次以上记为疑似 N+1 并打印警告。
+        SQLALCHEMY_QUERY_HEADERS（None 表示跟随 app.debug）打开时在响应头中
+        输出统计；各 endpoint 的分布见 db.query_stats_registry.export()
+    - 连接池预热：
+        db.warm_up() 为每个 bind 预先建立 SQLALCHEMY_WARMUP_CONNECTIONS 个连接
+        （SQLALCHEMY_WARMUP_PARALLEL 为 True 时并行建立）。预先加载应用再 fork
+        的服务器应在 worker 进程中调用 db.post_fork()（如 gunicorn 的 post_fork
+        钩子），丢弃继承的连接池并重新预热。
+        SQLALCHEMY_WARMUP_AFTER_FORK = True 时通过 os.register_at_fork 在每次
+        fork 出的子进程中丢弃继承的连接池，但不预热：ProcessPoolExecutor 等
+        fork 出的子进程也会触发，预热只应在服务器 worker 中进行。
+        SQLALCHEMY_WARMUP_ON_INIT = True 时 init_app 中直接预热
+    - 当前线程的 db.session（以及 db.shard_session）中没有 session 时
+        teardown 不调用 db.reset()。SQLALCHEMY_SKIP_IDLE_TEARDOWN = False
+        时总是调用
+    - 写缓冲：
+        db.buffer_insert()/db.buffer_update() 把单行写入暂存在 appctx 中，
+        在 db.flush_writes()、累计 SQLALCHEMY_WRITE_BUFFER_THRESHOLD 行或
+        appctx 结束时按表批量写入（executemany），每个 bind 一个独立事务。
+        appctx 因异常结束时丢弃缓冲；teardown 中的失败记录日志并交给
+        SQLALCHEMY_WRITE_BUFFER_ERROR_HANDLER(WriteBufferError)
+    - 大结果集导出：
+        db.stream_query() 用服务端游标（stream_results）逐批读取，
+        以 CSV/NDJSON/msgpack 流式输出
     """
     def __init__(self, db, app=None):
         # if isinstance(db, QKSQLAlchemy):
         #     raise ValueError("db shoud be instance of %r" % type(QKSQLAlchemy))
         self.db = db
+        self._shard_session = None
         if app:
             self.init_app(app)
 
@@ -57,16 +867,204 @@ class QKFlaskSQLAlchemy(object):
         :param app:
         :return:
         """
+        app.config.setdefault('SQLALCHEMY_AUTO_ROUTING', False)
+        app.config.setdefault('SQLALCHEMY_REPLICA_BINDS', [])
+        app.config.setdefault('SQLALCHEMY_REPLICA_STRATEGY', 'round_robin')
+        app.config.setdefault('SQLALCHEMY_STICKY_SECONDS', None)
+        app.config.setdefault('SQLALCHEMY_REPLICA_HEALTH_CHECK', False)
+        app.config.setdefault('SQLALCHEMY_REPLICA_HEALTH_INTERVAL', 5)
+        app.config.setdefault('SQLALCHEMY_REPLICA_MAX_LAG', 10)
+        app.config.setdefault('SQLALCHEMY_REPLICA_PROBE', None)
+        app.config.setdefault('SQLALCHEMY_SHARD_BINDS', [])
+        app.config.setdefault('SQLALCHEMY_SHARD_FUNCTION', None)
+        app.config.setdefault('SQLALCHEMY_SHARD_WORKERS', 8)
+        app.config.setdefault('SQLALCHEMY_QUERY_CACHE', None)
+        app.config.setdefault('SQLALCHEMY_QUERY_CACHE_TTL', 60)
+        app.config.setdefault('SQLALCHEMY_RECORD_QUERIES', False)
+        app.config.setdefault('SQLALCHEMY_RECORD_SLOWEST', 5)
+        app.config.setdefault('SQLALCHEMY_NPLUSONE_THRESHOLD', 5)
+        app.config.setdefault('SQLALCHEMY_QUERY_HEADERS', None)
+        app.config.setdefault('SQLALCHEMY_WARMUP_CONNECTIONS', 1)
+        app.config.setdefault('SQLALCHEMY_WARMUP_PARALLEL', False)
+        app.config.setdefault('SQLALCHEMY_WARMUP_ON_INIT', False)
+        app.config.setdefault('SQLALCHEMY_WARMUP_AFTER_FORK', False)
+        app.config.setdefault('SQLALCHEMY_SKIP_IDLE_TEARDOWN', True)
+        app.config.setdefault('SQLALCHEMY_WRITE_BUFFER_THRESHOLD', 1000)
+        app.config.setdefault('SQLALCHEMY_WRITE_BUFFER_ERROR_HANDLER', None)
+
         self.db.app = app
         self.db.configure(self.db.app.config)
 
+        self.db.replica_monitor = None
+        if app.config['SQLALCHEMY_REPLICA_HEALTH_CHECK'] and \
+                app.config['SQLALCHEMY_REPLICA_BINDS']:
+            self.db.replica_monitor = ReplicaHealthMonitor(
+                self.db, app.config['SQLALCHEMY_REPLICA_BINDS'],
+                probe=app.config['SQLALCHEMY_REPLICA_PROBE'],
+                interval=app.config['SQLALCHEMY_REPLICA_HEALTH_INTERVAL'],
+                max_lag=app.config['SQLALCHEMY_REPLICA_MAX_LAG'])
+
+        self.db.replica_pool = None
+        if app.config['SQLALCHEMY_AUTO_ROUTING'] and \
+                app.config['SQLALCHEMY_REPLICA_BINDS']:
+            self.db.replica_pool = ReplicaPool(
+                self.db, app.config['SQLALCHEMY_REPLICA_BINDS'],
+                app.config['SQLALCHEMY_REPLICA_STRATEGY'],
+                monitor=self.db.replica_monitor)
+
+        self.db.shard_binds = list(app.config['SQLALCHEMY_SHARD_BINDS'])
+        self.db.shard_function = app.config['SQLALCHEMY_SHARD_FUNCTION'] or \
+            modulo_shard(self.db.shard_binds)
+
+        self.db.query_cache = app.config['SQLALCHEMY_QUERY_CACHE']
+        self.db.query_cache_namespaces = {}
+
+        self.db.query_stats_registry = None
+        if app.config['SQLALCHEMY_RECORD_QUERIES']:
+            self.db.query_stats_registry = QueryStatsRegistry()
+            self.init_query_stats(app)
+
+        if app.config['SQLALCHEMY_WARMUP_AFTER_FORK'] and \
+                hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.discard_inherited_pools)
+        if app.config['SQLALCHEMY_WARMUP_ON_INIT']:
+            self.warm_up()
+
         self.db.scopefunc = _app_ctx_stack.__ident_func__
 
         @app.teardown_appcontext
         def shutdown_session(response_or_exc):
+            if getattr(_app_ctx_stack.top, _CTX_WRITE_BUFFER_ATTR, None) is not None:
+                self._flush_writes_on_teardown(response_or_exc)
+            if app.config['SQLALCHEMY_SKIP_IDLE_TEARDOWN'] and \
+                    not self._has_session():
+                return response_or_exc
             self.db.reset()
+            if self._shard_session is not None:
+                self._shard_session.remove()
             return response_or_exc
 
+    def _has_session(self):
+        # scoped_session 按线程保存 session，appctx 之外创建的 session 也能查到
+        if self._shard_session is not None and \
+                self._shard_session.registry.has():
+            return True
+        return self.db.session.registry.has()
+
+    def init_query_stats(self, app):
+        """ 在各个 bind 的 engine 上注册统计事件，并在请求结束时汇总
+        """
+        engines = set()
+        for bind_key in _configured_bind_keys(app):
+            engine = self.db.get_engine(bind_key)
+            if engine not in engines:
+                engines.add(engine)
+                _record_queries(engine, bind_key or 'default',
+                                app.config['SQLALCHEMY_RECORD_SLOWEST'])
+
+        @app.after_request
+        def query_stats_headers(response):
+            enabled = app.config['SQLALCHEMY_QUERY_HEADERS']
+            if enabled is None:
+                enabled = app.debug
+            stats = self.get_query_stats()
+            if enabled and stats is not None:
+                response.headers['X-SQL-Query-Count'] = str(stats.count)
+                response.headers['X-SQL-Query-Time'] = '%.2f' % (stats.time * 1000)
+                response.headers['X-SQL-NPlusOne'] = str(len(stats.nplusone(
+                    app.config['SQLALCHEMY_NPLUSONE_THRESHOLD'])))
+                response.headers.add('Server-Timing', ', '.join(
+                    'sql-%s;dur=%.2f;desc="%d queries"'
+                    % (bind, bind_stats['time'] * 1000, bind_stats['count'])
+                    for bind, bind_stats in sorted(stats.binds.items())))
+            return response
+
+        @app.teardown_request
+        def query_stats_observe(exc):
+            stats = self.get_query_stats() or QueryStats()
+            endpoint = request.endpoint or '<unmatched>'
+            flagged = stats.nplusone(app.config['SQLALCHEMY_NPLUSONE_THRESHOLD'])
+            for bind, statement, count in flagged:
+                app.logger.warning('sqlalchemy_nplusone: %s %s x%d: %s'
+                                   % (endpoint, bind, count, statement))
+            self.db.query_stats_registry.observe(endpoint, stats, len(flagged))
+
+    def warm_up(self, connections=None, parallel=None, bind_keys=None):
+        """ 预先建立连接并放回连接池，避免首批请求承担建连耗时
+
+        :param connections: 每个 bind 的连接数，默认为 SQLALCHEMY_WARMUP_CONNECTIONS，
+                            不超过连接池的 pool_size
+        :param parallel: 是否并行建立，默认为 SQLALCHEMY_WARMUP_PARALLEL
+        :param bind_keys: 默认为所有配置的 bind（None 表示默认数据库）
+        :return: {bind_key: 建立的连接数}，失败的 bind 为异常对象
+        """
+        app = self.db.app
+        if connections is None:
+            connections = app.config['SQLALCHEMY_WARMUP_CONNECTIONS']
+        if parallel is None:
+            parallel = app.config['SQLALCHEMY_WARMUP_PARALLEL']
+        if bind_keys is None:
+            bind_keys = _configured_bind_keys(app)
+
+        jobs = []
+        for bind_key in bind_keys:
+            engine = self.db.get_engine(bind_key)
+            size = getattr(engine.pool, 'size', None)
+            count = min(connections, size()) if size is not None else connections
+            jobs.extend((bind_key, engine) for _ in range(count))
+
+        start = time.time()
+        if parallel and len(jobs) > 1:
+            with ThreadPoolExecutor(min(len(jobs), 32)) as executor:
+                results = list(executor.map(_connect, [engine for _, engine in jobs]))
+        else:
+            results = [_connect(engine) for _, engine in jobs]
+
+        report = dict((bind_key, 0) for bind_key in bind_keys)
+        for (bind_key, _), result in zip(jobs, results):
+            if isinstance(result, Exception):
+                report[bind_key] = result
+                continue
+            result.close()
+            if not isinstance(report[bind_key], Exception):
+                report[bind_key] += 1
+        for bind_key, result in report.items():
+            if isinstance(result, Exception):
+                app.logger.warning('sqlalchemy_warm_up: %s failed: %r'
+                                   % (bind_key or 'default', result))
+        app.logger.info('sqlalchemy_warm_up: %d connections in %.3fs'
+                        % (sum(r for r in report.values() if not isinstance(r, Exception)),
+                           time.time() - start))
+        return report
+
+    def post_fork(self):
+        """ 在 fork 出的子进程中调用：丢弃继承的连接池并重新预热
+
+        Usage (gunicorn.conf.py)::
+
+            def post_fork(server, worker):
+                db.post_fork()
+        """
+        self.discard_inherited_pools()
+        if self.db.app.config['SQLALCHEMY_WARMUP_CONNECTIONS']:
+            self.warm_up()
+
+    def discard_inherited_pools(self):
+        """ 在 fork 出的子进程中丢弃从父进程继承的连接池，不建立新连接
+        """
+        for bind_key in _configured_bind_keys(self.db.app):
+            _recreate_pool(self.db.get_engine(bind_key))
+
+    def get_query_stats(self):
+        """ 当前 appctx 的 SQL 统计（QueryStats），未执行过查询时为 None
+        """
+        ctx = _app_ctx_stack.top
+        return getattr(ctx, _CTX_QUERY_STATS_ATTR, None) if ctx is not None else None
+
+    @property
+    def query_stats_registry(self):
+        return self.db.query_stats_registry
+
     @contextmanager
     def use_bind(self, bind_key):
         """Specify bind(engine/connection) for the current session
@@ -78,9 +1076,9 @@ class QKFlaskSQLAlchemy(object):
                 User.query.filter(...)
         """
         ctx = _app_ctx_stack.top
-        stack = hasattr(ctx, _CTX_ATTR) and getattr(ctx, _CTX_ATTR, None)
+        stack = getattr(ctx, _CTX_ATTR, None)
         try:
-            if not isinstance(stack, list):
+            if stack is None:
                 stack = []
                 setattr(ctx, _CTX_ATTR, stack)
             stack.append(bind_key)
@@ -88,6 +1086,258 @@ class QKFlaskSQLAlchemy(object):
         finally:
             stack.pop()
 
+    @contextmanager
+    def use_shard(self, shard_key):
+        """Specify the shard for sharded models in db.shard_session
+        :param shard_key: 分片字段的值，由 shard_function 换算为 bind_key
+
+        Usage::
+
+            with db.use_shard(user_id):
+                db.shard_session.query(Order).filter(...)
+        """
+        ctx = _app_ctx_stack.top
+        stack = getattr(ctx, _CTX_SHARD_ATTR, None)
+        if not isinstance(stack, list):
+            stack = []
+            setattr(ctx, _CTX_SHARD_ATTR, stack)
+        stack.append(self.db.shard_function(shard_key))
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    @property
+    def shard_session(self):
+        if self._shard_session is None:
+            self._shard_session = self.create_session(shard=True)
+        return self._shard_session
+
+    def buffer_insert(self, target, values=None, **kwargs):
+        """ 缓冲一行 INSERT
+
+        :param target: 模型类或 Table
+        :param values: {属性名: 值}，也可以用关键字参数
+        Usage::
+
+            db.buffer_insert(EventLog, user_id=user.id, event='click')
+        """
+        self._buffer_write('insert', target, values, kwargs)
+
+    def buffer_update(self, target, values=None, **kwargs):
+        """ 缓冲一行按主键的 UPDATE，values 中必须包含全部主键
+
+        :param target: 模型类或 Table
+        :param values: {属性名: 值}，也可以用关键字参数
+        """
+        self._buffer_write('update', target, values, kwargs)
+
+    def _buffer_write(self, kind, target, values, kwargs):
+        mapper, table = _buffer_target(target)
+        values = dict(values or (), **kwargs)
+        row = _buffer_row(mapper, table, values)
+        if kind == 'update':
+            missing = [c.key for c in table.primary_key.columns if c.key not in row]
+            if missing or len(row) == len(table.primary_key.columns):
+                raise ValueError('%s: update needs the primary key (%s) and at '
+                                 'least one other column' % (table.name, ', '.join(
+                                     c.key for c in table.primary_key.columns)))
+
+        ctx = _app_ctx_stack.top
+        stack = getattr(ctx, _CTX_ATTR, None)
+        bind_key = stack[-1] if stack else None
+        buffer = WriteBuffer() if ctx is None else getattr(ctx, _CTX_WRITE_BUFFER_ATTR, None)
+        if buffer is None:
+            buffer = WriteBuffer()
+            setattr(ctx, _CTX_WRITE_BUFFER_ATTR, buffer)
+        buffer.add(bind_key, kind, mapper, table, row)
+        if ctx is None:
+            # 没有 appctx 时直接写入
+            self._flush_buffer(buffer)
+        elif buffer.size >= self.db.app.config['SQLALCHEMY_WRITE_BUFFER_THRESHOLD']:
+            self.flush_writes()
+
+    def flush_writes(self):
+        """ 写入当前 appctx 缓冲的所有行
+
+        :return: 写入的行数
+        :raise WriteBufferError: 部分 bind 写入失败，其余 bind 已经提交
+        """
+        ctx = _app_ctx_stack.top
+        buffer = getattr(ctx, _CTX_WRITE_BUFFER_ATTR, None)
+        if buffer is None:
+            return 0
+        # 先移除缓冲，失败的行由 WriteBufferError 带回，不会被重复写入
+        delattr(ctx, _CTX_WRITE_BUFFER_ATTR)
+        return self._flush_buffer(buffer)
+
+    def _flush_buffer(self, buffer):
+        by_engine = OrderedDict()
+        for (bind_key, kind, mapper, table), rows in buffer.groups.items():
+            statements = _buffer_statements(kind, table, rows)
+            if bind_key is not None:
+                engine = self.db.get_engine(bind_key)
+            else:
+                engine = self.db.session().get_bind(mapper, clause=statements[0][0])
+            by_engine.setdefault(engine, []).append(
+                (bind_key, kind, table, rows, statements))
+
+        failures = []
+        for engine, groups in by_engine.items():
+            try:
+                with engine.begin() as conn:
+                    for _, _, _, _, statements in groups:
+                        for stmt, params in statements:
+                            conn.execute(stmt, params)
+            except Exception as e:
+                failures.extend({'bind': bind_key, 'table': table.name, 'kind': kind,
+                                 'rows': rows, 'error': e}
+                                for bind_key, kind, table, rows, _ in groups)
+        if failures:
+            raise WriteBufferError(failures)
+        return buffer.size
+
+    def _flush_writes_on_teardown(self, exc):
+        app = self.db.app
+        if exc is not None:
+            buffer = getattr(_app_ctx_stack.top, _CTX_WRITE_BUFFER_ATTR)
+            delattr(_app_ctx_stack.top, _CTX_WRITE_BUFFER_ATTR)
+            app.logger.warning('sqlalchemy_write_buffer: discard %d rows after %r'
+                               % (buffer.size, exc))
+            return
+        try:
+            self.flush_writes()
+        except WriteBufferError as e:
+            app.logger.error('sqlalchemy_write_buffer: %s' % e)
+            handler = app.config['SQLALCHEMY_WRITE_BUFFER_ERROR_HANDLER']
+            if handler is not None:
+                handler(e)
+
+    def stream_query(self, query, format='ndjson', bind_key=None, batch_size=1000,
+                     filename=None):
+        """ 用服务端游标执行查询，返回逐批编码的流式响应，内存占用与结果行数无关
+
+        查询在独立的连接上执行，不受 appctx 结束时 session reset 的影响；
+        连接在输出完毕或客户端断开时归还连接池。ORM 查询只输出列值，不构造对象
+
+        :param query: ORM Query 或 Core Select
+        :param format: 'csv'（首行为列名）、'ndjson' 或 'msgpack'（首个对象为列名数组）
+        :param bind_key: 默认与 session 相同：use_bind() 指定的 bind，其次是自动读写分离
+        :param batch_size: 每次从游标读取并输出的行数
+        :param filename: 指定时以附件形式下载
+        :return: flask.Response
+
+        Usage::
+
+            @app.route('/export.csv')
+            def export():
+                with db.use_bind('slave'):
+                    return db.stream_query(db.session.query(Order.id, Order.amount),
+                                           format='csv', filename='orders.csv')
+        """
+        encoder_class = _STREAM_ENCODERS.get(format)
+        if encoder_class is None:
+            raise ValueError('unknown stream format: %r' % format)
+
+        mapper = None
+        if isinstance(query, Query):
+            entity = query.column_descriptions[0]['entity'] \
+                if query.column_descriptions else None
+            mapper = getattr(inspect(entity), 'mapper', None) if entity is not None else None
+            query = query.statement
+        if bind_key is None:
+            stack = getattr(_app_ctx_stack.top, _CTX_ATTR, None)
+            bind_key = stack[-1] if stack else None
+        if bind_key is not None:
+            engine = self.db.get_engine(bind_key)
+        else:
+            engine = self.db.session().get_bind(mapper, clause=query)
+
+        conn = engine.connect()
+        try:
+            result = conn.execution_options(stream_results=True).execute(query)
+        except Exception:
+            conn.close()
+            raise
+        encoder = encoder_class()
+        response = Response(_RowStream(conn, result, encoder, batch_size),
+                            mimetype=encoder.mimetype)
+        # 不让 nginx 缓冲整个响应
+        response.headers['X-Accel-Buffering'] = 'no'
+        if filename is not None:
+            response.headers['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        return response
+
+    def scatter(self, query, **kwargs):
+        """ 跨分片并行查询，参数见 QKShardSession.scatter()
+        """
+        return self.shard_session().scatter(query, **kwargs)
+
+    def cache_query(self, query, ttl=None):
+        """ 执行查询并缓存结果
+
+        先查 appctx 内的缓存，再查 SQLALCHEMY_QUERY_CACHE。缓存键由所在数据库、
+        编译后的 SQL 和参数生成，表的版本号也按数据库区分（从库视为默认数据库）；
+        当前事务中写过（已 flush 但未提交）的表不使用缓存。
+        只有 session.flush()/commit() 以及 session.execute() 执行的
+        insert()/update()/delete() 能被感知，text() 写入不会使缓存失效
+
+        :param query: ORM Query 或 Core Select。只查询单个模型时返回与 session
+                      分离的对象，只加载列属性；其余查询返回行（namedtuple）
+        :param ttl: 缓存秒数，默认为 SQLALCHEMY_QUERY_CACHE_TTL
+        :return: list
+
+        Usage::
+
+            categories = db.cache_query(db.session.query(Category).filter_by(enabled=1))
+        """
+        if isinstance(query, Query):
+            session, stmt, mapper = query.session, query.statement, _entity_mapper(query)
+            bind_mapper = mapper
+            if bind_mapper is None and query.column_descriptions:
+                entity = query.column_descriptions[0]['entity']
+                bind_mapper = getattr(inspect(entity), 'mapper', None) \
+                    if entity is not None else None
+        else:
+            session, stmt, mapper, bind_mapper = self.db.session(), query, None, None
+
+        cache = self.db.query_cache
+        if cache is not None:
+            engine = session.get_bind(bind_mapper, clause=stmt)
+            namespace = _cache_namespace(self.db, engine)
+            tables = sorted(set('%s.%s' % (namespace, t.fullname)
+                                for t in find_tables(stmt, check_columns=True)))
+            dirty = getattr(session, 'cache_dirty_tables', None)
+        if cache is None or (dirty and not dirty.isdisjoint(tables)):
+            return query.all() if isinstance(query, Query) else \
+                session.execute(stmt, mapper=bind_mapper).fetchall()
+
+        ctx = _app_ctx_stack.top
+        # 同一语句在不同数据库（use_bind、分片）上的结果分别缓存
+        key = _query_cache_key(engine, stmt, namespace)
+
+        local = getattr(ctx, _CTX_QUERY_CACHE_ATTR, None) if ctx is not None else None
+        value = local.get(key) if local is not None else None
+        if value is None:
+            value, versions = cache.get(key, tables)
+            if value is None:
+                result = session.execute(stmt, bind=engine)
+                value = [list(result.keys()), [list(row) for row in result]]
+                cache.set(key, tables, value,
+                          self.db.app.config['SQLALCHEMY_QUERY_CACHE_TTL']
+                          if ttl is None else ttl, versions)
+            if ctx is not None:
+                if local is None:
+                    local = {}
+                    setattr(ctx, _CTX_QUERY_CACHE_ATTR, local)
+                local[key] = value
+
+        keys, rows = value
+        if mapper is not None:
+            return _restore_instances(mapper, keys, rows)
+        row_class = _row_class(keys)
+        return [row_class(*row) for row in rows]
+
     ###
 
     @property
@@ -101,6 +1351,10 @@ class QKFlaskSQLAlchemy(object):
         return self.db.reset()
 
     def create_session(self, engine=None, shard=False):
+        if shard:
+            return scoped_session(
+                sessionmaker(class_=QKShardSession, db=self.db, bind=engine),
+                scopefunc=self.db.scopefunc)
         return self.db.create_session(engine, shard)
 
     def get_session(self, bind_key=None):
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+预压缩的静态文件
+
+- precompress(): 为目录中的文本文件生成 .gz 和 .br（安装了 brotli 时）
+- PrecompressedFiles: 按 Accept-Encoding 返回预压缩文件，基于内容哈希的强 ETag，
+  文件名带内容哈希时使用 immutable 长期缓存，小文件可缓存在内存中
+- fingerprint_directory(): 计算目录中文件的内容哈希，用于 `url_for('static')` 的 `?v=`
+"""
+from collections import OrderedDict
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+import stat as stat_module
+import threading
+
+from flask import Response, abort, request
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+__all__ = ['precompress', 'PrecompressedFiles', 'fingerprint_directory',
+           'load_fingerprints', 'write_fingerprints']
+
+COMPRESSIBLE_EXTENSIONS = ('.js', '.css', '.svg', '.json', '.map', '.html', '.txt',
+                           '.xml', '.ttf', '.eot', '.otf', '.ico')
+
+# webassets 输出的 `{name}.{hash}.ext`
+_HASHED_RE = re.compile(r'\.[0-9a-f]{8,}\.[^.]+$')
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def _gzip(data):
+    buf = io.BytesIO()
+    # mtime=0 保证相同内容的输出相同
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def precompress(directory, extensions=COMPRESSIBLE_EXTENSIONS, log=None):
+    """ 为 directory 中的文件生成 .gz/.br，已是最新或压缩后不更小的跳过
+
+    :param directory:
+    :param extensions: 需要压缩的扩展名
+    :param log: logger
+    :return: 写入的文件数
+    """
+    codecs = [('.gz', _gzip)]
+    if brotli is not None:
+        codecs.append(('.br', lambda data: brotli.compress(data, quality=11)))
+    elif log:
+        log.warning('brotli is not installed, skip .br')
+
+    written = 0
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for filename in files:
+            if filename.startswith('.') or not filename.endswith(extensions):
+                continue
+            path = os.path.join(root, filename)
+            mtime = os.path.getmtime(path)
+            data = None
+            for suffix, compress in codecs:
+                target = path + suffix
+                if os.path.exists(target) and os.path.getmtime(target) >= mtime:
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                compressed = compress(data)
+                if len(compressed) >= len(data):
+                    if os.path.exists(target):
+                        os.remove(target)
+                    continue
+                with open(target, 'wb') as f:
+                    f.write(compressed)
+                written += 1
+    if log:
+        log.info('precompressed %d files in %s' % (written, directory))
+    return written
+
+
+def _file_digest(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint_directory(directory, length=12):
+    """ 计算 directory 中所有文件的内容哈希，跳过以 . 开头的文件和目录以及 .gz/.br
+
+    :param directory:
+    :param length: 哈希的长度
+    :return: {相对路径（以 / 分隔）: 哈希}
+    """
+    fingerprints = {}
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for filename in files:
+            if filename.startswith('.') or filename.endswith(('.gz', '.br')):
+                continue
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, directory).replace(os.sep, '/')
+            fingerprints[name] = _file_digest(path)[:length]
+    return fingerprints
+
+
+def load_fingerprints(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _dump_json(path, data):
+    # 先写临时文件再 rename，读取方不会读到写了一半的文件
+    tmp = '%s.%d' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def write_fingerprints(path, fingerprints):
+    _dump_json(path, fingerprints)
+
+
+class PrecompressedFiles(object):
+    """ 返回 directory 中的文件，用作 view function 的实现
+
+    Usage::
+
+        files = PrecompressedFiles(app.webassets.directory)
+        app.add_url_rule('/assets/<path:filename>', 'assets', files.send)
+    """
+
+    def __init__(self, directory, max_age=None, memory_cache_size=0,
+                 memory_cache_max_file=64 * 1024):
+        """
+        :param directory:
+        :param max_age: 文件名不带哈希时的缓存秒数，可以是 max_age(filename) 函数
+        :param memory_cache_size: 内存中最多缓存的文件数，0 表示不缓存
+        :param memory_cache_max_file: 超过该字节数的文件不缓存在内存中
+        """
+        self.directory = directory
+        self.max_age = max_age
+        self.memory_cache_size = memory_cache_size
+        self.memory_cache_max_file = memory_cache_max_file
+        self._memory = OrderedDict()
+        self._etags = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_hashed(filename):
+        return _HASHED_RE.search(filename) is not None
+
+    def _accepted_encodings(self):
+        accept = request.accept_encodings
+        return [(encoding, suffix) for encoding, suffix in (('br', '.br'), ('gzip', '.gz'))
+                if accept[encoding]] + [(None, '')]
+
+    def send(self, filename):
+        path = safe_join(self.directory, filename)
+        if path is None:
+            abort(404)
+        hashed = self.is_hashed(filename)
+
+        for encoding, suffix in self._accepted_encodings():
+            try:
+                stat = os.stat(path + suffix)
+            except OSError:
+                continue
+            if not stat_module.S_ISREG(stat.st_mode):
+                continue
+            response = self._response(path + suffix, stat)
+            if encoding is not None:
+                response.headers['Content-Encoding'] = encoding
+            break
+        else:
+            abort(404)
+
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        response.set_etag(self._etag(path + suffix, stat))
+        if hashed:
+            response.headers['Cache-Control'] = \
+                'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        else:
+            max_age = self.max_age(filename) if callable(self.max_age) else self.max_age
+            if max_age is not None:
+                response.cache_control.public = True
+                response.cache_control.max_age = max_age
+        return response.make_conditional(request)
+
+    def _response(self, path, stat):
+        if self.memory_cache_size and stat.st_size <= self.memory_cache_max_file:
+            data = self._cached(path, stat)
+            return Response(data)
+        response = Response(wrap_file(request.environ, open(path, 'rb')),
+                            direct_passthrough=True)
+        response.content_length = stat.st_size
+        return response
+
+    def _etag(self, path, stat):
+        # 内容哈希，每个 (path, mtime, size) 只计算一次。
+        # .gz/.br 的内容不同，ETag 也不同；部署到多台机器时 mtime 不同也不影响 ETag
+        key = (stat.st_mtime, stat.st_size)
+        entry = self._etags.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        etag = _file_digest(path)
+        with self._lock:
+            self._etags[path] = (key, etag)
+        return etag
+
+    def _cached(self, path, stat):
+        key = (path, stat.st_mtime, stat.st_size)
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+        with open(path, 'rb') as f:
+            data = f.read()
+        with self._lock:
+            self._memory[key] = data
+            while len(self._memory) > self.memory_cache_size:
+                self._memory.popitem(last=False)
+        return data
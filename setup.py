@@ -10,12 +10,16 @@ setup(
     install_requires=[
         'Flask',
         'Flask-Assets',
-        'redis',
+        'redis>=3.5',
         'msgpack-python',
         'qianka-sqlalchemy',
     ],
+    extras_require={
+        'lz4': ['lz4'],
+        'brotli': ['brotli'],
+    },
     setup_requires=[],
-    tests_require=[],
+    tests_require=['pytest', 'fakeredis'],
 
     author="Qianka Inc.",
     description="",
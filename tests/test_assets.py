@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+from webassets import Bundle, Environment
+from webassets.filter import Filter
+
+from qianka.flaskext.assets import build_bundles, write_manifest
+
+
+class FailingFilter(Filter):
+    name = 'failing'
+
+    def output(self, _in, out, **kwargs):
+        raise ValueError('broken')
+
+
+@pytest.fixture
+def assets(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (tmp_path / 'out').mkdir()
+    for name in 'abc':
+        (src / ('%s.txt' % name)).write_text(name * 3)
+    env = Environment(str(tmp_path / 'out'), '/assets')
+    env.append_path(str(src))
+    env.register('one.txt', Bundle('a.txt', 'b.txt'), output='one.%(version)s.txt')
+    env.register('two.txt', Bundle('c.txt'), output='two.%(version)s.txt')
+    return env, tmp_path
+
+
+def build(env, tmp_path, workers=1):
+    report = build_bundles(env, workers, str(tmp_path / 'cache.json'), str(tmp_path))
+    return dict((r['name'], r) for r in report)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_build_bundles_skips_unchanged_bundles(assets, workers):
+    env, tmp_path = assets
+    report = build(env, tmp_path, workers)
+    assert [report[name]['status'] for name in ('one.txt', 'two.txt')] == ['built', 'built']
+    with open(report['one.txt']['output']) as f:
+        assert f.read() == 'aaa\nbbb'
+
+    cached = build(env, tmp_path, workers)
+    assert [cached[name]['status'] for name in ('one.txt', 'two.txt')] == ['cached', 'cached']
+    assert cached['one.txt']['version'] == report['one.txt']['version']
+
+    (tmp_path / 'src' / 'c.txt').write_text('changed')
+    rebuilt = build(env, tmp_path, workers)
+    assert rebuilt['one.txt']['status'] == 'cached'
+    assert rebuilt['two.txt']['status'] == 'built'
+    assert rebuilt['two.txt']['version'] != report['two.txt']['version']
+
+
+def test_build_bundles_rebuilds_missing_output(assets):
+    env, tmp_path = assets
+    report = build(env, tmp_path)
+    os.remove(report['two.txt']['output'])
+    assert build(env, tmp_path)['two.txt']['status'] == 'built'
+
+
+def test_build_bundles_same_versions_in_parallel(assets):
+    env, tmp_path = assets
+    serial = build(env, tmp_path)
+    os.remove(str(tmp_path / 'cache.json'))
+    parallel = build(env, tmp_path, 2)
+    assert [parallel[name]['version'] for name in ('one.txt', 'two.txt')] == \
+        [serial[name]['version'] for name in ('one.txt', 'two.txt')]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_build_bundles_reports_failed_bundle(assets, workers):
+    env, tmp_path = assets
+    env.register('bad.txt', Bundle('c.txt', filters=(FailingFilter(),)),
+                 output='bad.%(version)s.txt')
+    report = build(env, tmp_path, workers)
+    assert report['bad.txt']['status'] == 'failed'
+    assert 'broken' in repr(report['bad.txt']['error'])
+    assert report['one.txt']['status'] == 'built'
+    # 失败的 bundle 不写入构建缓存，下次重新构建
+    assert build(env, tmp_path, workers)['bad.txt']['status'] == 'failed'
+
+
+
+def test_write_manifest_relative_urls(assets):
+    env, tmp_path = assets
+    report = build(env, tmp_path)
+    manifest = write_manifest(env, str(tmp_path / 'manifest.json'))
+    assert manifest == {
+        'one.txt': ['one.%s.txt' % report['one.txt']['version']],
+        'two.txt': ['two.%s.txt' % report['two.txt']['version']],
+    }
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+from jinja2 import Environment
+from jinja2.exceptions import TemplateRuntimeError
+
+from qianka.flaskext.assetsmanifest import AssetsManifest, ManifestAssetsExtension
+
+MANIFEST = {
+    'app.js': ['app.0123abcd.js'],
+    'vendor.js': ['//cdn.example.com/vendor.js'],
+    'ab.%(version)s.js': ['ab.4567cdef.js'],
+}
+
+
+@pytest.fixture
+def manifest():
+    return AssetsManifest(MANIFEST, '//static.example.com/assets/')
+
+
+def test_manifest_urls(manifest, tmp_path):
+    assert manifest.get('app.js') == ['//static.example.com/assets/app.0123abcd.js']
+    assert manifest.get('vendor.js') == ['//cdn.example.com/vendor.js']
+    assert manifest.get('missing.js') is None
+    assert 'app.js' in manifest
+
+    path = tmp_path / 'manifest.json'
+    path.write_text(json.dumps(MANIFEST))
+    assert AssetsManifest.load(str(path), '/assets/').get('app.js') == \
+        ['/assets/app.0123abcd.js']
+
+
+def test_manifest_resolve(manifest):
+    assert manifest.resolve(['app.js', 'vendor.js']) == [
+        '//static.example.com/assets/app.0123abcd.js', '//cdn.example.com/vendor.js']
+    assert manifest.resolve(['a.js', 'b.js'], 'ab.%(version)s.js') == \
+        ['//static.example.com/assets/ab.4567cdef.js']
+    with pytest.raises(TemplateRuntimeError):
+        manifest.resolve(['missing.js'])
+    with pytest.raises(TemplateRuntimeError):
+        manifest.resolve(['a.js'], 'missing.js')
+
+
+def test_assets_tag(manifest):
+    env = Environment(extensions=[ManifestAssetsExtension])
+    env.assets_manifest = manifest
+    tmpl = env.from_string(
+        '{% assets "app.js", "vendor.js" %}<script src="{{ ASSET_URL }}"></script>'
+        '{% endassets %}'
+        '{% assets "a.js", "b.js", filters="uglifyjs", output="ab.%(version)s.js" %}'
+        '[{{ ASSET_URL }}]{% endassets %}')
+    assert tmpl.render() == (
+        '<script src="//static.example.com/assets/app.0123abcd.js"></script>'
+        '<script src="//cdn.example.com/vendor.js"></script>'
+        '[//static.example.com/assets/ab.4567cdef.js]')
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import shutil
+
+import pytest
+from flask import render_template, render_template_string
+
+from qianka.flaskext.flask import QKFlask
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_app(tmp_path, **config):
+    app = QKFlask(__name__, template_folder=str(tmp_path / 'templates'),
+                  static_folder=str(tmp_path / 'static'), instance_path=here)
+    app.config.update(config)
+    return app
+
+
+# assets manifest mode
+
+@pytest.fixture
+def manifest_app(tmp_path):
+    directory = tmp_path / 'assets'
+    directory.mkdir()
+    (directory / 'app.0123abcd.js').write_text('var a;')
+    (directory / 'manifest.json').write_text(json.dumps({
+        'app.js': ['app.0123abcd.js'],
+        'site.css': ['site.89abcdef.css', 'print.89abcdef.css'],
+    }))
+    app = make_app(tmp_path, ASSETS_MANIFEST_MODE=True, ASSETS_DIRECTORY=str(directory),
+                   CDN_URL_PREFIX_ASSETS='//cdn.example.com')
+    app.prepare_templates()
+    app.prepare_webassets()
+    return app
+
+
+def test_manifest_mode_renders_assets_tag(manifest_app):
+    assert manifest_app.webassets is None
+    # manifest 模式下不需要 webassets
+    manifest_app.register_asset('app.js', 'app.coffee')
+    with manifest_app.test_request_context():
+        rendered = render_template_string(
+            '{% assets "app.js" %}<script src="{{ ASSET_URL }}"></script>{% endassets %}')
+        assert rendered == '<script src="//cdn.example.com/assets/app.0123abcd.js"></script>'
+
+
+def test_manifest_mode_url_for(manifest_app):
+    with manifest_app.test_request_context():
+        assert render_template_string("{{ url_for('assets', filename='app.js') }}") == \
+            '//cdn.example.com/assets/app.0123abcd.js'
+        # 多个文件的 bundle 和未知的文件名按路径生成 URL
+        assert render_template_string("{{ url_for('assets', filename='site.css') }}") == '/assets/site.css'
+        assert render_template_string("{{ url_for('assets', filename='other.js') }}") == '/assets/other.js'
+
+
+def test_manifest_mode_serves_built_files(manifest_app):
+    rv = manifest_app.test_client().get('/assets/app.0123abcd.js')
+    assert rv.data == b'var a;'
+    assert 'immutable' in rv.headers['Cache-Control']
+
+
+def test_manifest_mode_requires_directory(tmp_path):
+    app = make_app(tmp_path, ASSETS_MANIFEST_MODE=True)
+    with pytest.raises(Exception):
+        app.prepare_webassets()
+
+
+# static fingerprints
+
+@pytest.fixture
+def static_dir(tmp_path):
+    static = tmp_path / 'static'
+    (static / 'js').mkdir(parents=True)
+    (static / 'js' / 'app.js').write_bytes(b'var a;')
+    return static
+
+
+def fingerprint(data):
+    return hashlib.md5(data).hexdigest()[:12]
+
+
+def test_static_url_for_fingerprint(tmp_path, static_dir):
+    app = make_app(tmp_path, STATIC_FINGERPRINT=True,
+                   CDN_URL_PREFIX_STATIC='//cdn.example.com')
+    app.prepare_templates()
+    url = '/static/js/app.js?v=%s' % fingerprint(b'var a;')
+    with app.test_request_context():
+        assert render_template_string(
+            "{{ url_for('static', filename='js/app.js') }}") == '//cdn.example.com' + url
+        assert render_template_string(
+            "{{ url_for('static', filename='missing.js') }}") == \
+            '//cdn.example.com/static/missing.js'
+        assert render_template_string(
+            "{{ url_for('static', filename='js/app.js', _external=True) }}") == \
+            'http://localhost' + url
+    with app.test_request_context(base_url='http://example.com/sub/'):
+        assert render_template_string(
+            "{{ url_for('static', filename='js/app.js') }}") == '//cdn.example.com/sub' + url
+        assert render_template_string(
+            "{{ url_for('static', filename='js/app.js', _external=True) }}") == \
+            'http://example.com/sub' + url
+
+
+def test_static_fingerprinted_request_is_immutable(tmp_path, static_dir):
+    app = make_app(tmp_path, STATIC_FINGERPRINT=True)
+    app.prepare_templates()
+    client = app.test_client()
+    rv = client.get('/static/js/app.js?v=%s' % fingerprint(b'var a;'))
+    assert rv.data == b'var a;'
+    assert 'immutable' in rv.headers['Cache-Control']
+    rv = client.get('/static/js/app.js?v=outdated')
+    assert 'immutable' not in rv.headers.get('Cache-Control', '')
+    rv.close()
+
+
+def test_static_manifest_file(tmp_path, static_dir):
+    path = str(tmp_path / 'static.json')
+    app = make_app(tmp_path, STATIC_FINGERPRINT=True, STATIC_MANIFEST_FILE=path)
+    assert app.build_static_manifest() == {'js/app.js': fingerprint(b'var a;')}
+
+    # worker 启动时读取 manifest，不再扫描目录
+    (static_dir / 'js' / 'app.js').write_bytes(b'var b;')
+    app = make_app(tmp_path, STATIC_FINGERPRINT=True, STATIC_MANIFEST_FILE=path)
+    app.prepare_templates()
+    assert app.static_fingerprints == {'js/app.js': fingerprint(b'var a;')}
+
+
+def test_static_url_for_without_fingerprint(tmp_path, static_dir):
+    app = make_app(tmp_path, CDN_URL_PREFIX_STATIC='//cdn.example.com')
+    app.prepare_templates()
+    with app.test_request_context():
+        for _ in range(2):
+            assert render_template_string(
+                "{{ url_for('static', filename='js/app.js') }}") == \
+                '//cdn.example.com/static/js/app.js'
+    with app.test_request_context(base_url='http://example.com/sub/'):
+        assert render_template_string(
+            "{{ url_for('static', filename='js/app.js') }}") == \
+            '//cdn.example.com/sub/static/js/app.js'
+
+
+# template bytecode cache
+
+@pytest.fixture
+def templates(tmp_path):
+    folder = tmp_path / 'templates'
+    folder.mkdir()
+    (folder / 'page.html').write_text('{% strip %}<p>  {{ value }}  </p>{% endstrip %}')
+    (folder / 'notes.md').write_text('{{ value }}')
+    return folder
+
+
+def cached_app(tmp_path, template_folder, **config):
+    app = QKFlask(__name__, template_folder=str(template_folder), instance_path=here)
+    app.config.update(TEMPLATE_BYTECODE_CACHE=str(tmp_path / 'bytecode'), **config)
+    app.prepare_templates()
+    return app
+
+
+def forbid_compile(app):
+    def compile(*args, **kwargs):
+        raise AssertionError('template compiled')
+    app.jinja_env.compile = compile
+
+
+def test_compile_templates_fills_bytecode_cache(tmp_path, templates):
+    (templates / 'broken.html').write_text('{% if %}')
+    app = cached_app(tmp_path, templates)
+    failed = app.compile_templates()
+    assert list(failed) == ['broken.html']
+    assert len(os.listdir(str(tmp_path / 'bytecode'))) == 1
+
+    app = cached_app(tmp_path, templates)
+    forbid_compile(app)
+    with app.test_request_context():
+        assert render_template('page.html', value=1) == '<p>  1  </p>'
+
+
+def test_bytecode_cache_survives_moving_templates(tmp_path, templates):
+    cached_app(tmp_path, templates).compile_templates()
+    moved = tmp_path / 'deploy' / 'templates'
+    shutil.copytree(str(templates), str(moved))
+
+    app = cached_app(tmp_path, moved)
+    forbid_compile(app)
+    with app.test_request_context():
+        assert render_template('page.html', value=1) == '<p>  1  </p>'
+
+
+def test_bytecode_cache_keyed_by_compress_config(tmp_path, templates):
+    cached_app(tmp_path, templates).compile_templates()
+    app = cached_app(tmp_path, templates, HTML_COMPRESS=True)
+    with app.test_request_context():
+        assert render_template('page.html', value=1) == '<p>1</p>'
+
+
+def test_compile_templates_requires_directory(tmp_path, templates):
+    app = QKFlask(__name__, template_folder=str(templates), instance_path=here)
+    app.prepare_templates()
+    with pytest.raises(Exception):
+        app.compile_templates()
+    assert app.compile_templates(str(tmp_path / 'bytecode')) == {}
+    assert app.jinja_env.bytecode_cache is None
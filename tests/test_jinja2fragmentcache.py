@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import fakeredis
+import pytest
+from jinja2 import Environment
+
+from qianka.flaskext.jinja2fragmentcache import (
+    FragmentCache, FragmentCacheExtension, MemoryFragmentCache,
+    RedisFragmentCache)
+
+
+class SlowRender(object):
+    """ 渲染函数：计数，并可以阻塞到 release() """
+
+    def __init__(self, value='fresh', blocked=False):
+        self.value = value
+        self.calls = 0
+        self.started = threading.Event()
+        self._release = threading.Event()
+        if not blocked:
+            self._release.set()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self._release.wait(5)
+        return self.value
+
+    def release(self):
+        self._release.set()
+
+
+def in_thread(func, *args):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func(*args)))
+    thread.start()
+    return thread, result
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def make_redis_cache(server, **kwargs):
+    cache = RedisFragmentCache(fakeredis.FakeStrictRedis(server=server), **kwargs)
+    cache.wait_interval = 0.01
+    return cache
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def caches(request, server):
+    """ 共享同一份缓存的两个实例（redis 时代表两个进程） """
+    if request.param == 'memory':
+        cache = MemoryFragmentCache()
+        return cache, cache
+    return make_redis_cache(server), make_redis_cache(server)
+
+
+def test_fragment_cache_is_abstract():
+    with pytest.raises(TypeError):
+        FragmentCache()
+
+
+def test_only_one_request_renders_missing_fragment(caches):
+    one, two = caches
+    render = SlowRender(blocked=True)
+    first, first_result = in_thread(one.render, 'nav', 60, render)
+    assert render.started.wait(5)
+
+    second, second_result = in_thread(two.render, 'nav', 60, render)
+    time.sleep(0.1)
+    render.release()
+    first.join(5)
+    second.join(5)
+
+    assert render.calls == 1
+    assert first_result == second_result == ['fresh']
+    assert two.hits == 1
+
+
+def test_expired_fragment_served_stale_while_revalidating(caches):
+    one, two = caches
+    one.render('nav', 0.05, lambda: 'stale')
+    time.sleep(0.1)
+
+    render = SlowRender(blocked=True)
+    thread, result = in_thread(one.render, 'nav', 60, render)
+    assert render.started.wait(5)
+    # 另一个请求正在重新渲染，直接返回旧内容
+    assert two.render('nav', 60, SlowRender('other')) == 'stale'
+    assert two.stale_hits == 1
+
+    render.release()
+    thread.join(5)
+    assert result == ['fresh']
+    assert two.render('nav', 60, SlowRender('other')) == 'fresh'
+
+
+def test_expired_fragment_beyond_grace_is_rendered():
+    cache = MemoryFragmentCache(grace=0)
+    cache.render('nav', 0.05, lambda: 'old')
+    time.sleep(0.1)
+    assert cache.render('nav', 60, lambda: 'new') == 'new'
+    assert cache.misses == 2
+
+
+def test_redis_fragment_cache_undecodable_entry_is_miss(server):
+    cache = make_redis_cache(server)
+    cache.redis.set(cache.key_prefix + 'nav', b'\xc1garbage')
+    assert cache.render('nav', 60, lambda: 'fresh') == 'fresh'
+    assert cache.render('nav', 60, lambda: 'other') == 'fresh'
+
+
+def test_redis_fragment_cache_renders_when_redis_unavailable(server):
+    cache = make_redis_cache(server)
+    server.connected = False
+    assert cache.render('nav', 60, lambda: 'fresh') == 'fresh'
+    assert cache.misses == 1
+
+
+def test_redis_fragment_cache_release_keeps_other_lock(server):
+    cache = make_redis_cache(server, lock_timeout=0.05)
+    render = SlowRender(blocked=True)
+    thread, result = in_thread(cache.render, 'nav', 60, render)
+    assert render.started.wait(5)
+    # 渲染超过 lock_timeout，锁已被其他进程取得
+    time.sleep(0.1)
+    other = make_redis_cache(server)
+    assert other._acquire('nav')
+    render.release()
+    thread.join(5)
+    assert cache.redis.get(cache._lock_key('nav')) is not None
+
+
+def test_cache_tag():
+    env = Environment(extensions=[FragmentCacheExtension], autoescape=True)
+    env.fragment_cache = MemoryFragmentCache()
+    calls = []
+
+    def counter():
+        calls.append(1)
+        return '<b>%d</b>' % len(calls)
+
+    tmpl = env.from_string(
+        "{% cache ['nav', user], 60 %}{{ counter() }}{% endcache %}")
+    assert tmpl.render(counter=counter, user=1) == '&lt;b&gt;1&lt;/b&gt;'
+    assert tmpl.render(counter=counter, user=1) == '&lt;b&gt;1&lt;/b&gt;'
+    assert tmpl.render(counter=counter, user=2) == '&lt;b&gt;2&lt;/b&gt;'
+    assert len(calls) == 2
+
+
+def test_cache_tag_without_backend_renders():
+    env = Environment(extensions=[FragmentCacheExtension])
+    tmpl = env.from_string("{% cache 'nav' %}{{ value }}{% endcache %}")
+    assert tmpl.render(value=1) == '1'
+    assert tmpl.render(value=2) == '2'
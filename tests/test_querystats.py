@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from qianka.flaskext.querystats import Histogram, QueryStats
+
+
+def test_query_stats_keeps_slowest_statements():
+    stats = QueryStats(slowest=2)
+    for elapsed, statement in ((0.1, 'a'), (0.3, 'b'), (0.2, 'c'), (0.05, 'd')):
+        stats.record('default', statement, elapsed)
+    assert stats.slowest_statements('default') == [(0.3, 'b'), (0.2, 'c')]
+    assert stats.slowest_statements('replica') == []
+    assert stats.count == 4
+    assert abs(stats.time - 0.65) < 1e-9
+
+
+def test_query_stats_nplusone_by_bind_and_statement():
+    stats = QueryStats()
+    for _ in range(3):
+        stats.record('default', 'SELECT ? FROM t', 0)
+        stats.record('replica', 'SELECT ? FROM t', 0)
+    stats.record('replica', 'SELECT ? FROM t', 0)
+    assert stats.nplusone(4) == [('replica', 'SELECT ? FROM t', 4)]
+    assert len(stats.nplusone(3)) == 2
+
+
+def test_histogram_buckets():
+    histogram = Histogram([1, 10])
+    for value in (0, 1, 5, 100):
+        histogram.observe(value)
+    assert histogram.export() == {
+        'bounds': [1, 10], 'counts': [2, 1, 1], 'sum': 106, 'count': 4}
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import datetime
+import decimal
+import os
+import uuid
+
+import msgpack
+import pytest
+
+from qianka.flaskext import serializers
+from qianka.flaskext.serializers import MsgpackSerializer
+
+VALUE = {
+    'text': u'中文',
+    'bytes': b'\x00\x01',
+    'datetime': datetime.datetime(2016, 1, 2, 3, 4, 5, 6),
+    'date': datetime.date(2016, 1, 2),
+    'decimal': decimal.Decimal('1.10'),
+    'uuid': uuid.UUID('12345678123456781234567812345678'),
+    'list': [1, 2.5, None, True],
+}
+
+
+def test_roundtrip_extension_types():
+    serializer = MsgpackSerializer()
+    data = serializer.dumps(VALUE)
+    assert data[:2] == serializers.MAGIC + serializers.FORMAT_MSGPACK
+    assert serializer.loads(data) == VALUE
+
+
+@pytest.mark.parametrize('compression, fmt', [
+    ('zlib', serializers.FORMAT_MSGPACK_ZLIB),
+    pytest.param('lz4', serializers.FORMAT_MSGPACK_LZ4, marks=pytest.mark.skipif(
+        serializers.lz4 is None, reason='lz4 is not installed')),
+])
+def test_compress_above_threshold(compression, fmt):
+    serializer = MsgpackSerializer(compress_threshold=64, compression=compression)
+    value = {'text': 'x' * 1000}
+    data = serializer.dumps(value)
+    assert data[:2] == serializers.MAGIC + fmt
+    assert len(data) < 1000
+    assert serializer.loads(data) == value
+    # 读取方不需要知道写入时的配置
+    assert MsgpackSerializer().loads(data) == value
+
+
+def test_incompressible_data_not_compressed():
+    serializer = MsgpackSerializer(compress_threshold=16)
+    data = serializer.dumps(os.urandom(64))
+    assert data[:2] == serializers.MAGIC + serializers.FORMAT_MSGPACK
+
+
+def test_loads_legacy_and_unknown_format():
+    serializer = MsgpackSerializer()
+    assert serializer.loads(msgpack.dumps({'a': 1}, use_bin_type=True)) == {'a': 1}
+    with pytest.raises(ValueError):
+        serializer.loads(serializers.MAGIC + b'\x09')
+
+
+def test_unknown_compression():
+    with pytest.raises(ValueError):
+        MsgpackSerializer(compression='snappy')
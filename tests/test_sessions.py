@@ -0,0 +1,604 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+import os
+import time
+
+import fakeredis
+import pytest
+from flask import Flask, session
+
+from qianka.flaskext.sessions import (
+    CircuitBreaker, ConsistentHashRing, RedisSessionInterface, SessionCache,
+    SessionUnavailable)
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeStrictRedis()
+
+
+def make_app(interface):
+    here = os.path.dirname(os.path.abspath(__file__))
+    app = Flask(__name__, root_path=here, instance_path=here)
+    app.secret_key = 'secret'
+    app.session_interface = interface
+    return app
+
+
+def session_hash(interface, redis):
+    keys = redis.keys(interface.key_prefix + '*')
+    assert len(keys) == 1
+    data = dict((k.decode('utf8'), interface.loads(v))
+                for k, v in redis.hgetall(keys[0]).items())
+    data.pop('_permanent', None)
+    return data
+
+
+def test_hash_explicit_modified_rewrites_in_place_mutation(redis):
+    interface = RedisSessionInterface(redis, use_hash=True)
+    app = make_app(interface)
+
+    @app.route('/init')
+    def init():
+        session['cart'] = [1]
+        return ''
+
+    @app.route('/mutate')
+    def mutate():
+        session['cart'].append(2)
+        session.modified = True
+        session['seen'] = 1
+        return ''
+
+    client = app.test_client()
+    client.get('/init')
+    client.get('/mutate')
+    assert session_hash(interface, redis) == {'cart': [1, 2], 'seen': 1}
+
+
+def test_hash_tracked_changes_write_only_changed_fields(redis):
+    interface = RedisSessionInterface(redis, use_hash=True)
+    app = make_app(interface)
+
+    @app.route('/init')
+    def init():
+        session['a'] = 1
+        session['b'] = 2
+        return ''
+
+    @app.route('/change')
+    def change():
+        session['a'] = 3
+        session.pop('b')
+        return ''
+
+    client = app.test_client()
+    client.get('/init')
+    key = redis.keys(interface.key_prefix + '*')[0]
+    redis.hset(key, 'other', interface.dumps('kept'))
+    client.get('/change')
+    assert session_hash(interface, redis) == {'a': 3, 'other': 'kept'}
+
+
+# lazy loading
+
+def spy_loads(interface):
+    loads = []
+    load = interface.load_session_data
+    interface.load_session_data = lambda *args: loads.append(args) or load(*args)
+    return loads
+
+
+def test_lazy_session_not_loaded_or_saved_when_untouched(redis):
+    interface = RedisSessionInterface(redis, lazy=True)
+    app = make_app(interface)
+
+    @app.route('/init')
+    def init():
+        session['a'] = 1
+        return ''
+
+    @app.route('/noop')
+    def noop():
+        return ''
+
+    @app.route('/get')
+    def get():
+        return str(session.get('a'))
+
+    client = app.test_client()
+    client.get('/noop')
+    # 新访客没有访问 session，不写 redis
+    assert redis.keys('*') == []
+
+    client.get('/init')
+    loads = spy_loads(interface)
+    rv = client.get('/noop')
+    assert loads == []
+    assert 'Set-Cookie' not in rv.headers
+    assert client.get('/get').data == b'1'
+    assert len(loads) == 1
+
+
+def test_lazy_session_missing_data_is_new(redis):
+    interface = RedisSessionInterface(redis, lazy=True)
+    app = make_app(interface)
+
+    @app.route('/init')
+    def init():
+        session['a'] = 1
+        return ''
+
+    @app.route('/new')
+    def new():
+        return '%s %s' % (session.get('a'), session.new)
+
+    client = app.test_client()
+    client.get('/init')
+    redis.flushall()
+    assert client.get('/new').data == b'None True'
+
+
+# sliding expiry
+
+@pytest.mark.parametrize('use_hash', [False, True])
+def test_sliding_expiry_refreshes_ttl_without_rewrite(redis, use_hash):
+    interface = RedisSessionInterface(redis, use_hash=use_hash,
+                                      refresh_threshold=0.5)
+    app = make_app(interface)
+    app.permanent_session_lifetime = timedelta(seconds=100)
+
+    @app.route('/init')
+    def init():
+        session['a'] = 1
+        return ''
+
+    @app.route('/get')
+    def get():
+        return str(session['a'])
+
+    client = app.test_client()
+    client.get('/init')
+    key = redis.keys(interface.key_prefix + '*')[0]
+    dump = redis.dump(key)
+
+    # 剩余有效期高于阈值，不续期
+    redis.expire(key, 80)
+    rv = client.get('/get')
+    assert 'Set-Cookie' not in rv.headers
+    assert redis.ttl(key) <= 80
+
+    redis.expire(key, 10)
+    rv = client.get('/get')
+    assert rv.data == b'1'
+    assert 'Set-Cookie' in rv.headers
+    assert redis.ttl(key) > 90
+    assert redis.dump(key) == dump
+
+
+# user index
+
+@pytest.fixture
+def indexed(redis):
+    interface = RedisSessionInterface(redis, user_key='uid')
+    app = make_app(interface)
+
+    @app.route('/login/<int:uid>')
+    def login(uid):
+        session['uid'] = uid
+        return ''
+
+    @app.route('/logout')
+    def logout():
+        session.pop('uid')
+        return ''
+
+    @app.route('/whoami')
+    def whoami():
+        return str(session.get('uid'))
+
+    return interface, app
+
+
+def test_user_index_tracks_logins(indexed):
+    interface, app = indexed
+    one, two = app.test_client(), app.test_client()
+    one.get('/login/1')
+    two.get('/login/1')
+    assert interface.count_user_sessions(1) == 2
+
+    two.get('/logout')
+    assert interface.count_user_sessions(1) == 1
+    two.get('/login/2')
+    assert interface.count_user_sessions(2) == 1
+
+
+def test_invalidate_user_sessions(indexed):
+    interface, app = indexed
+    one, two, other = app.test_client(), app.test_client(), app.test_client()
+    one.get('/login/1')
+    two.get('/login/1')
+    other.get('/login/2')
+
+    assert interface.invalidate_user_sessions(1) == 2
+    assert interface.count_user_sessions(1) == 0
+    assert one.get('/whoami').data == b'None'
+    assert two.get('/whoami').data == b'None'
+    assert other.get('/whoami').data == b'2'
+
+
+def test_iter_sessions_in_batches(indexed):
+    interface, app = indexed
+    for uid in range(5):
+        app.test_client().get('/login/%d' % uid)
+    batches = list(interface.iter_sessions(batch_size=2))
+    assert sorted(data['uid'] for batch in batches for sid, data in batch) == \
+        list(range(5))
+    sids = [sid for batch in interface.iter_sessions(with_data=False)
+            for sid, data in batch]
+    assert len(sids) == 5
+
+
+# SessionCache
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+@pytest.fixture
+def server():
+    server = fakeredis.FakeServer()
+    fakeredis.FakeStrictRedis(server=server).config_set(
+        'notify-keyspace-events', 'Kgx$h')
+    return server
+
+
+def make_cached_interface(server):
+    """ 一个 interface 代表一个进程：各自的 redis 连接和 SessionCache """
+    cache = SessionCache(maxsize=16, ttl=60)
+    interface = RedisSessionInterface(
+        fakeredis.FakeStrictRedis(server=server), cache=cache)
+    assert wait_until(lambda: cache.enabled)
+    return interface, cache
+
+
+@pytest.fixture
+def two_processes(server):
+    one, cache_one = make_cached_interface(server)
+    two, cache_two = make_cached_interface(server)
+    app = make_app(one)
+
+    @app.route('/set/<value>')
+    def set_value(value):
+        session['value'] = value
+        return ''
+
+    @app.route('/get')
+    def get_value():
+        return session.get('value', '')
+
+    client = app.test_client()
+
+    def request(interface, path):
+        previous, app.session_interface = app.session_interface, interface
+        other = cache_two if interface is one else cache_one
+        version = other.version
+        try:
+            rv = client.get(path).data.decode('utf8')
+        finally:
+            app.session_interface = previous
+        if path.startswith('/set/'):
+            # 等待另一个进程收到这次写入的通知
+            assert wait_until(lambda: other.version != version)
+        return rv
+
+    return request, (one, cache_one), (two, cache_two)
+
+
+def test_session_cache_write_invalidates_other_process(two_processes):
+    request, (one, cache_one), (two, cache_two) = two_processes
+    request(one, '/set/a')
+    assert request(two, '/get') == 'a'
+    assert request(two, '/get') == 'a'
+    assert cache_two.hits == 1
+
+    request(one, '/set/b')
+    assert request(two, '/get') == 'b'
+
+
+def test_session_cache_read_after_local_write_hits(two_processes):
+    request, (one, cache_one), (two, cache_two) = two_processes
+    request(one, '/set/a')
+    # 本进程写入产生的通知也已到达
+    time.sleep(0.2)
+
+    def fetch(app, key):
+        raise AssertionError('cache miss')
+
+    one.fetch_session_data = fetch
+    assert request(one, '/get') == 'a'
+    request(one, '/set/b')
+    time.sleep(0.2)
+    assert request(one, '/get') == 'b'
+    assert cache_one.hits == 3
+
+
+def test_session_cache_skips_read_that_raced_invalidation(two_processes):
+    request, (one, cache_one), (two, cache_two) = two_processes
+    request(one, '/set/a')
+
+    fetch = two.fetch_session_data
+
+    def racing_fetch(app, key):
+        rv = fetch(app, key)
+        # 读取之后、写入缓存之前，另一个进程修改了 session
+        request(one, '/set/b')
+        return rv
+
+    two.fetch_session_data = racing_fetch
+    assert request(two, '/get') == 'a'
+    del two.fetch_session_data
+    assert request(two, '/get') == 'b'
+
+
+def test_session_cache_set_with_stale_version_is_ignored():
+    cache = SessionCache(listen=False)
+    version = cache.version
+    cache.invalidate('session:x')
+    cache.set('session:x', 'old', version)
+    assert cache.get('session:x') is None
+    cache.set('session:x', 'new', cache.version)
+    assert cache.get('session:x') == 'new'
+
+
+def test_session_cache_invalidation_of_other_key_keeps_set():
+    cache = SessionCache(listen=False)
+    version = cache.version
+    cache.invalidate('session:y')
+    cache.set('session:x', 'value', version)
+    assert cache.get('session:x') == 'value'
+
+
+def test_session_cache_disabled_while_disconnected(server):
+    interface, cache = make_cached_interface(server)
+    cache.set('session:x', 'value', cache.version)
+    assert cache.get('session:x') == 'value'
+
+    server.connected = False
+    assert wait_until(lambda: not cache.enabled)
+    # 断开期间收不到通知，不能使用缓存，已缓存的条目也已清空
+    assert cache.get('session:x') is None
+    cache.set('session:x', 'value', cache.version)
+    assert cache.get('session:x') is None
+
+    server.connected = True
+    assert wait_until(lambda: cache.enabled)
+    assert cache.get('session:x') is None
+
+
+# ConsistentHashRing
+
+def test_hash_ring_adding_node_moves_keys_only_to_new_node():
+    keys = ['session:%d' % i for i in range(4000)]
+    before = ConsistentHashRing({'a': 'a', 'b': 'b', 'c': 'c'})
+    after = ConsistentHashRing({'a': 'a', 'b': 'b', 'c': 'c', 'd': 'd'})
+    moved = [key for key in keys if before.get_node(key) != after.get_node(key)]
+    assert all(after.get_node(key) == 'd' for key in moved)
+    # 约 1/4 的 key 迁移到新节点
+    assert 0.15 < len(moved) / float(len(keys)) < 0.35
+
+
+def test_hash_ring_node_order_does_not_matter():
+    one = ConsistentHashRing({'a': 'a', 'b': 'b', 'c': 'c'})
+    two = ConsistentHashRing(dict([('c', 'c'), ('a', 'a'), ('b', 'b')]))
+    keys = ['session:%d' % i for i in range(200)]
+    assert [one.get_node(k) for k in keys] == [two.get_node(k) for k in keys]
+
+
+def test_hash_ring_same_hash_tag_same_node():
+    ring = ConsistentHashRing({'a': 'a', 'b': 'b', 'c': 'c'})
+    for user in range(50):
+        nodes = set(ring.get_node('%s:{user:%d}' % (prefix, user))
+                    for prefix in ('session', 'cart', 'profile'))
+        assert len(nodes) == 1
+
+
+@pytest.mark.parametrize('key, tag', [
+    ('session:{user:1}', 'user:1'),
+    ('{user:1}:session', 'user:1'),
+    ('a{b}{c}', 'b'),
+    ('a{}b', 'a{}b'),
+    ('a{b', 'a{b'),
+    ('a}b{c}', 'c'),
+    ('plain', 'plain'),
+])
+def test_hash_tag(key, tag):
+    assert ConsistentHashRing.hash_tag(key) == tag
+
+
+def test_sharded_sessions_spread_over_nodes():
+    nodes = dict((name, fakeredis.FakeStrictRedis()) for name in ('a', 'b'))
+    interface = RedisSessionInterface(nodes, user_key='uid')
+    app = make_app(interface)
+
+    @app.route('/login/<int:uid>')
+    def login(uid):
+        session['uid'] = uid
+        return ''
+
+    @app.route('/whoami')
+    def whoami():
+        return str(session.get('uid'))
+
+    clients = [app.test_client() for _ in range(20)]
+    for client in clients:
+        client.get('/login/1')
+    assert all(node.keys(interface.key_prefix + '*') for node in nodes.values())
+    assert [client.get('/whoami').data for client in clients] == [b'1'] * 20
+    # 用户索引与 session 不在同一节点时也能维护
+    assert interface.count_user_sessions(1) == 20
+    assert interface.invalidate_user_sessions(1) == 20
+    assert clients[0].get('/whoami').data == b'None'
+
+
+# CircuitBreaker
+
+def fail():
+    raise ConnectionError('down')
+
+
+def test_circuit_breaker_state_transitions():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    assert breaker.call(lambda: 1) == 1
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(SessionUnavailable):
+        breaker.call(lambda: 1)
+    assert breaker.rejected == 1
+
+    # half_open 的探测失败，回到 open
+    time.sleep(0.06)
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(SessionUnavailable):
+        breaker.call(lambda: 1)
+
+    # 探测成功，恢复 closed
+    time.sleep(0.06)
+    assert breaker.call(lambda: 2) == 2
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+
+
+def test_circuit_breaker_half_open_allows_single_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    time.sleep(0.06)
+
+    def probe():
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        # 探测调用返回之前，其他调用仍被拒绝
+        with pytest.raises(SessionUnavailable):
+            breaker.call(lambda: 1)
+        return 'ok'
+
+    assert breaker.call(probe) == 'ok'
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_slow_calls_count_as_failures():
+    breaker = CircuitBreaker(failure_threshold=1, latency_budget=0.01)
+    assert breaker.call(lambda: time.sleep(0.02) or 'slow') == 'slow'
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_degraded_session_while_redis_down():
+    server = fakeredis.FakeServer()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    interface = RedisSessionInterface(fakeredis.FakeStrictRedis(server=server),
+                                      breaker=breaker)
+    app = make_app(interface)
+
+    @app.route('/set/<value>')
+    def set_value(value):
+        session['value'] = value
+        return ''
+
+    @app.route('/get')
+    def get_value():
+        return '%s %s' % (session.get('value'), session.degraded)
+
+    client = app.test_client()
+    client.get('/set/a')
+    server.connected = False
+    # redis 不可用：空的、不保存的 session，也不改动 cookie
+    assert client.get('/get').data == b'None True'
+    assert breaker.state == CircuitBreaker.OPEN
+    rv = client.get('/set/b')
+    assert rv.status_code == 200
+    assert 'Set-Cookie' not in rv.headers
+
+    server.connected = True
+    time.sleep(0.06)
+    assert client.get('/get').data == b'a False'
+    assert breaker.state == CircuitBreaker.CLOSED
+
+# signed sid
+
+def test_sign_and_verify_sid():
+    data = RedisSessionInterface.sign_sid('abc', 'secret', 2000)
+    assert RedisSessionInterface.verify_sid(data, 'secret', now=1000) == 'abc'
+    assert RedisSessionInterface.verify_sid(data, b'secret', now=1000) == 'abc'
+    # 过期
+    assert RedisSessionInterface.verify_sid(data, 'secret', now=2001) is None
+    # 密钥不同、篡改过期时间或签名
+    assert RedisSessionInterface.verify_sid(data, 'other', now=1000) is None
+    sid, expires, signature = data.split('.')
+    assert RedisSessionInterface.verify_sid(
+        '%s.%x.%s' % (sid, 3000, signature), 'secret', now=1000) is None
+    assert RedisSessionInterface.verify_sid(
+        'abd.%s.%s' % (expires, signature), 'secret', now=1000) is None
+    for bad in (None, '', 'abc', 'abc.zz.sig', 'a.b.c.d'):
+        assert RedisSessionInterface.verify_sid(bad, 'secret') is None
+
+
+def test_invalid_cookie_rejected_without_redis(redis):
+    interface = RedisSessionInterface(redis, legacy_sid=False)
+    app = make_app(interface)
+
+    @app.route('/get')
+    def get():
+        return '%s %s' % (session.get('a'), session.new)
+
+    loads = spy_loads(interface)
+    client = app.test_client()
+    expired = interface.sign_sid('abc', app.secret_key, time.time() - 1)
+    for cookie in (expired, expired + 'x',
+                   interface.encode_sid('abc', app.secret_key)):
+        client.set_cookie('localhost', app.session_cookie_name, cookie)
+        assert client.get('/get').data == b'None True'
+    assert loads == []
+
+
+# legacy sid
+
+def test_legacy_sid_migration_does_not_load_lazy_session(redis):
+    interface = RedisSessionInterface(redis, lazy=True)
+    app = make_app(interface)
+
+    @app.route('/init')
+    def init():
+        session['a'] = 1
+        return ''
+
+    @app.route('/noop')
+    def noop():
+        return ''
+
+    client = app.test_client()
+    client.get('/init')
+    key = redis.keys(interface.key_prefix + '*')[0].decode('utf8')
+    sid = key[len(interface.key_prefix):]
+    client.set_cookie('localhost', app.session_cookie_name,
+                      interface.encode_sid(sid, app.secret_key))
+
+    loads = []
+    load = interface.load_session_data
+    interface.load_session_data = lambda *args: loads.append(args) or load(*args)
+    rv = client.get('/noop')
+    assert loads == []
+    cookie = rv.headers['Set-Cookie']
+    assert 'Expires=' in cookie
+    assert interface.verify_sid(
+        cookie.split(';')[0].split('=', 1)[1], app.secret_key) == sid
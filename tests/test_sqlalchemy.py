@@ -0,0 +1,644 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+
+import fakeredis
+import msgpack
+import pytest
+from flask import Flask
+from sqlalchemy import Column, Integer, String, event, or_, select
+from sqlalchemy.ext.declarative import declarative_base
+
+from qianka.sqlalchemy import QKSQLAlchemy
+from qianka.flaskext.querycache import MemoryQueryCache, RedisQueryCache
+from qianka.flaskext.sqlalchemy import (
+    QKFlaskSQLAlchemy, QKSession, ShardRoutingError)
+
+Base = declarative_base()
+
+
+class Event(Base):
+    __tablename__ = 'event'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(20))
+    note = Column(String(20), default='-')
+
+
+class Order(Base):
+    __tablename__ = 'orders'
+    __shard_key__ = 'user_id'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer)
+    amount = Column(Integer)
+
+
+def make_db(tmp_path, binds=(), session_class=QKSession, **config):
+    here = os.path.dirname(os.path.abspath(__file__))
+    app = Flask(__name__, root_path=here, instance_path=here)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///%s' % (tmp_path / 'default.db')
+    app.config['SQLALCHEMY_BINDS'] = dict(
+        (key, 'sqlite:///%s' % (tmp_path / ('%s.db' % key))) for key in binds)
+    app.config.update(config)
+    db = QKSQLAlchemy(session_class=session_class)
+    ext = QKFlaskSQLAlchemy(db, app)
+    for bind_key in (None,) + tuple(binds):
+        Base.metadata.create_all(db.get_engine(bind_key))
+    return app, db, ext
+
+
+def rows(db, sql, bind_key=None):
+    return [tuple(row) for row in db.get_engine(bind_key).execute(sql)]
+
+
+# write buffer
+
+def test_buffer_insert_rows_with_different_columns(tmp_path):
+    app, db, ext = make_db(tmp_path)
+    with app.app_context():
+        ext.buffer_insert(Event, name='a', note='x')
+        ext.buffer_insert(Event, name='b')
+        ext.buffer_insert(Event.__table__, {'name': 'c', 'note': 'z'})
+    assert rows(db, 'select name, note from event order by id') == \
+        [('a', 'x'), ('b', '-'), ('c', 'z')]
+
+
+def test_buffer_update_rows_with_different_columns(tmp_path):
+    app, db, ext = make_db(tmp_path)
+    with app.app_context():
+        for name in ('a', 'b', 'c'):
+            ext.buffer_insert(Event, name=name)
+    with app.app_context():
+        ext.buffer_update(Event, id=1, name='A')
+        ext.buffer_update(Event, id=2, note='B')
+        ext.buffer_update(Event, id=3, name='C', note='C')
+    assert rows(db, 'select name, note from event order by id') == \
+        [('A', '-'), ('b', 'B'), ('C', 'C')]
+
+
+def test_buffer_discarded_when_appctx_fails(tmp_path):
+    app, db, ext = make_db(tmp_path)
+    with pytest.raises(RuntimeError):
+        with app.app_context():
+            ext.buffer_insert(Event, name='lost')
+            raise RuntimeError('boom')
+    assert rows(db, 'select count(*) from event') == [(0,)]
+
+
+# sharding
+
+SHARDS = ('s0', 's1', 's2')
+
+
+@pytest.fixture
+def sharded(tmp_path):
+    app, db, ext = make_db(tmp_path, binds=SHARDS, SQLALCHEMY_SHARD_BINDS=list(SHARDS))
+    with app.app_context():
+        session = ext.shard_session
+        for user_id in range(6):
+            session.add(Order(id=user_id + 1, user_id=user_id, amount=user_id * 10))
+        session.commit()
+    return app, db, ext
+
+
+def test_shard_flush_writes_by_shard_key(sharded):
+    app, db, ext = sharded
+    # 默认取模：user_id % 3
+    assert [rows(db, 'select user_id from orders order by user_id', key)
+            for key in SHARDS] == [[(0,), (3,)], [(1,), (4,)], [(2,), (5,)]]
+
+
+def test_shard_query_routes_by_top_level_equality(sharded):
+    app, db, ext = sharded
+    with app.app_context():
+        session = ext.shard_session
+        orders = session.query(Order).filter(Order.user_id == 4, Order.amount > 0).all()
+        assert [o.amount for o in orders] == [40]
+        with ext.use_shard(5):
+            assert session.query(Order).count() == 2
+
+
+@pytest.mark.parametrize('criterion', [
+    lambda: or_(Order.user_id == 2, Order.user_id == 3),
+    lambda: ~(Order.user_id == 2),
+    lambda: Order.amount > 0,
+])
+def test_shard_query_without_routable_condition_raises(sharded, criterion):
+    app, db, ext = sharded
+    with app.app_context():
+        with pytest.raises(ShardRoutingError):
+            ext.shard_session.query(Order).filter(criterion()).all()
+
+
+def test_shard_same_primary_key_on_different_shards(sharded):
+    app, db, ext = sharded
+    # s1 和 s2 中各有一行 id = 100
+    db.get_engine('s1').execute('insert into orders values (100, 7, 70)')
+    db.get_engine('s2').execute('insert into orders values (100, 8, 80)')
+    with app.app_context():
+        session = ext.shard_session
+        first = session.query(Order).filter(Order.user_id == 7).one()
+        second = session.query(Order).filter(Order.user_id == 8).one()
+        assert first is not second
+        assert (first.user_id, second.user_id) == (7, 8)
+
+        # 修改写回各自的分片；提交后过期的属性从各自的分片重新加载
+        first.amount, second.amount = 71, 81
+        session.commit()
+        assert (first.amount, second.amount) == (71, 81)
+        with ext.use_shard(8):
+            assert session.query(Order).get(100) is second
+    assert rows(db, 'select amount from orders where id = 100', 's1') == [(71,)]
+    assert rows(db, 'select amount from orders where id = 100', 's2') == [(81,)]
+
+
+def test_shard_scatter_merges_all_shards(sharded):
+    app, db, ext = sharded
+    with app.app_context():
+        query = ext.shard_session.query(Order).order_by(Order.amount.desc())
+        orders = ext.scatter(query, order_by='amount', reverse=True, limit=4)
+        assert [o.amount for o in orders] == [50, 40, 30, 20]
+        amounts = sorted(row.amount for row in ext.scatter(select([Order.__table__])))
+        assert amounts == [0, 10, 20, 30, 40, 50]
+
+
+# query cache
+
+@pytest.fixture(params=['memory', 'redis'])
+def cached(request, tmp_path):
+    if request.param == 'memory':
+        cache = MemoryQueryCache()
+    else:
+        cache = RedisQueryCache(fakeredis.FakeStrictRedis())
+    app, db, ext = make_db(tmp_path, binds=('tenant_b',),
+                           SQLALCHEMY_QUERY_CACHE=cache)
+    db.get_engine(None).execute("insert into event (name) values ('default')")
+    db.get_engine('tenant_b').execute("insert into event (name) values ('tenant_b')")
+    return app, db, ext
+
+
+def cached_names(db, ext):
+    return [e.name for e in ext.cache_query(db.session.query(Event))]
+
+
+def test_query_cache_hit_and_invalidate_on_commit(cached):
+    app, db, ext = cached
+    cache = db.query_cache
+    with app.app_context():
+        assert cached_names(db, ext) == ['default']
+    with app.app_context():
+        assert cached_names(db, ext) == ['default']
+        assert (cache.hits, cache.misses) == (1, 1)
+        db.session.add(Event(name='new'))
+        db.session.commit()
+    with app.app_context():
+        assert cached_names(db, ext) == ['default', 'new']
+
+
+def test_query_cache_rows_are_namedtuples(cached):
+    app, db, ext = cached
+    with app.app_context():
+        rows = ext.cache_query(db.session.query(Event.id, Event.name))
+        assert rows[0].name == 'default'
+        assert tuple(rows[0]) == (1, 'default')
+
+
+def test_query_cache_separates_binds(cached):
+    app, db, ext = cached
+    with app.app_context():
+        assert cached_names(db, ext) == ['default']
+        with ext.use_bind('tenant_b'):
+            assert cached_names(db, ext) == ['tenant_b']
+    with app.app_context():
+        with ext.use_bind('tenant_b'):
+            assert cached_names(db, ext) == ['tenant_b']
+        assert cached_names(db, ext) == ['default']
+
+
+def test_query_cache_invalidates_only_the_written_bind(cached):
+    app, db, ext = cached
+    cache = db.query_cache
+    with app.app_context():
+        cached_names(db, ext)
+        with ext.use_bind('tenant_b'):
+            cached_names(db, ext)
+            db.session.execute(Event.__table__.insert().values(name='b2'))
+            db.session.commit()
+    with app.app_context():
+        misses = cache.misses
+        assert cached_names(db, ext) == ['default']
+        assert cache.misses == misses
+        with ext.use_bind('tenant_b'):
+            assert cached_names(db, ext) == ['tenant_b', 'b2']
+        assert cache.misses == misses + 1
+
+
+def test_query_cache_ignores_result_of_query_that_raced_a_write(cached):
+    app, db, ext = cached
+    cache = db.query_cache
+    get = cache.get
+
+    def racing_get(key, tables):
+        rv = get(key, tables)
+        # 读取版本号之后、查询执行之前，其他进程提交了写入
+        cache.invalidate(tables)
+        return rv
+
+    with app.app_context():
+        cache.get = racing_get
+        cached_names(db, ext)
+        del cache.get
+    with app.app_context():
+        cached_names(db, ext)
+        assert cache.hits == 0
+
+
+def test_query_cache_primary_write_invalidates_replica_reads(tmp_path):
+    app, db, ext = make_db(tmp_path, binds=('r1',), SQLALCHEMY_AUTO_ROUTING=True,
+                           SQLALCHEMY_REPLICA_BINDS=['r1'],
+                           SQLALCHEMY_QUERY_CACHE=MemoryQueryCache())
+    db.get_engine('r1').execute("insert into event (name) values ('replica')")
+    cache = db.query_cache
+    with app.app_context():
+        assert cached_names(db, ext) == ['replica']
+    with app.app_context():
+        db.session.add(Event(name='new'))
+        db.session.commit()
+    with app.app_context():
+        assert cached_names(db, ext) == ['replica']
+        assert (cache.hits, cache.misses) == (0, 2)
+
+
+# replica routing
+
+REPLICAS = ['replica1', 'replica2']
+
+
+def make_replicated(tmp_path, **config):
+    """ 每个库的 event 表中有一行，name 为库名，用于判断查询走了哪个库 """
+    config.setdefault('SQLALCHEMY_AUTO_ROUTING', True)
+    config.setdefault('SQLALCHEMY_REPLICA_BINDS', REPLICAS)
+    app, db, ext = make_db(tmp_path, REPLICAS, **config)
+    for bind_key in [None] + REPLICAS:
+        db.get_engine(bind_key).execute(Event.__table__.insert().values(
+            id=1, name=bind_key or 'primary'))
+    return app, db, ext
+
+
+def read_from(db):
+    return db.session.query(Event.name).filter(Event.id == 1).scalar()
+
+
+def test_auto_routing_reads_from_replicas_in_turn(tmp_path):
+    app, db, ext = make_replicated(tmp_path)
+    with app.app_context():
+        assert [read_from(db) for _ in range(4)] == REPLICAS * 2
+
+
+def test_auto_routing_reads_primary_after_write(tmp_path):
+    app, db, ext = make_replicated(tmp_path)
+    with app.app_context():
+        assert read_from(db) == 'replica1'
+        db.session.add(Event(id=2, name='new'))
+        db.session.commit()
+        assert read_from(db) == 'primary'
+        assert read_from(db) == 'primary'
+    with app.app_context():
+        # 窗口只在当前 appctx 内有效
+        assert read_from(db) == 'replica2'
+
+
+def test_auto_routing_sticky_window_expires(tmp_path):
+    app, db, ext = make_replicated(tmp_path, SQLALCHEMY_STICKY_SECONDS=0.1)
+    with app.app_context():
+        db.session.add(Event(id=2, name='new'))
+        db.session.commit()
+        assert read_from(db) == 'primary'
+        time.sleep(0.2)
+        assert read_from(db) == 'replica1'
+
+
+def test_auto_routing_read_only_commit_keeps_replicas(tmp_path):
+    app, db, ext = make_replicated(tmp_path)
+    with app.app_context():
+        assert read_from(db) == 'replica1'
+        db.session.commit()
+        assert read_from(db) == 'replica2'
+        db.session.add(Event(id=2, name='new'))
+        db.session.rollback()
+        assert read_from(db) == 'replica1'
+
+
+def test_auto_routing_use_bind_takes_precedence(tmp_path):
+    app, db, ext = make_replicated(tmp_path)
+    with app.app_context():
+        with ext.use_bind('replica2'):
+            assert read_from(db) == 'replica2'
+            assert read_from(db) == 'replica2'
+
+
+def test_auto_routing_disabled_reads_primary(tmp_path):
+    app, db, ext = make_replicated(tmp_path, SQLALCHEMY_AUTO_ROUTING=False)
+    with app.app_context():
+        assert read_from(db) == 'primary'
+
+
+# replica health check
+
+@pytest.fixture
+def monitored(tmp_path):
+    lags = {}
+
+    def probe(engine):
+        lag = lags.get(engine, 0)
+        if isinstance(lag, Exception):
+            raise lag
+        return lag
+
+    app, db, ext = make_replicated(
+        tmp_path, SQLALCHEMY_REPLICA_HEALTH_CHECK=True,
+        SQLALCHEMY_REPLICA_PROBE=probe, SQLALCHEMY_REPLICA_MAX_LAG=10,
+        SQLALCHEMY_REPLICA_HEALTH_INTERVAL=3600)
+    monitor = db.replica_monitor
+    # 等待后台线程完成第一次探测
+    monitor.is_healthy('replica1')
+    deadline = time.time() + 5
+    while len(monitor.status) < len(REPLICAS) and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(monitor.status) == len(REPLICAS)
+
+    def set_lag(bind_key, lag):
+        lags[db.get_engine(bind_key)] = lag
+        monitor.check()
+
+    return app, db, ext, set_lag
+
+
+def test_health_check_drops_lagging_replica(monitored):
+    app, db, ext, set_lag = monitored
+    set_lag('replica1', 100)
+    assert db.replica_monitor.status['replica1']['lag'] == 100
+    assert not db.replica_monitor.status['replica1']['healthy']
+    with app.app_context():
+        assert [read_from(db) for _ in range(3)] == ['replica2'] * 3
+
+    set_lag('replica1', 0)
+    with app.app_context():
+        assert sorted(read_from(db) for _ in range(2)) == REPLICAS
+
+
+def test_health_check_drops_unreachable_replica(monitored):
+    app, db, ext, set_lag = monitored
+    set_lag('replica2', RuntimeError('down'))
+    assert 'down' in db.replica_monitor.status['replica2']['error']
+    with app.app_context():
+        assert [read_from(db) for _ in range(2)] == ['replica1'] * 2
+
+
+def test_health_check_falls_back_to_primary(monitored):
+    app, db, ext, set_lag = monitored
+    set_lag('replica1', 100)
+    set_lag('replica2', RuntimeError('down'))
+    with app.app_context():
+        assert read_from(db) == 'primary'
+        with ext.use_bind('replica2'):
+            assert read_from(db) == 'primary'
+        with ext.use_bind(None):
+            assert read_from(db) == 'primary'
+
+
+def test_health_check_thread_started_once_per_process(monitored):
+    app, db, ext, set_lag = monitored
+    monitor = db.replica_monitor
+    thread = monitor._thread.get()
+    assert thread.is_alive()
+    monitor.is_healthy('replica2')
+    assert monitor._thread.get() is thread
+
+
+# query stats
+
+def test_query_stats_headers_and_registry(tmp_path):
+    app, db, ext = make_db(
+        tmp_path, ['replica1'], SQLALCHEMY_RECORD_QUERIES=True,
+        SQLALCHEMY_QUERY_HEADERS=True, SQLALCHEMY_NPLUSONE_THRESHOLD=3)
+
+    @app.route('/events')
+    def events():
+        db.session.query(Event).all()
+        for i in range(4):
+            db.session.query(Event).get(i + 1)
+        with ext.use_bind('replica1'):
+            db.session.query(Event).count()
+        return ''
+
+    @app.route('/idle')
+    def idle():
+        return ''
+
+    client = app.test_client()
+    rv = client.get('/events')
+    assert rv.headers['X-SQL-Query-Count'] == '6'
+    assert rv.headers['X-SQL-NPlusOne'] == '1'
+    assert 'sql-default;' in rv.headers['Server-Timing']
+    assert 'desc="1 queries"' in rv.headers['Server-Timing']
+    client.get('/events')
+
+    rv = client.get('/idle')
+    assert 'X-SQL-Query-Count' not in rv.headers
+
+    exported = ext.query_stats_registry.export()
+    assert exported['events']['queries']['count'] == 2
+    assert exported['events']['nplusone'] == 2
+    assert exported['events']['binds'] == {'default': 10, 'replica1': 2}
+    assert exported['idle']['queries']['counts'][0] == 1
+
+
+def test_query_stats_headers_off_outside_debug(tmp_path):
+    app, db, ext = make_db(tmp_path, SQLALCHEMY_RECORD_QUERIES=True)
+
+    @app.route('/events')
+    def events():
+        db.session.query(Event).all()
+        return ''
+
+    assert 'X-SQL-Query-Count' not in app.test_client().get('/events').headers
+    assert ext.get_query_stats() is None
+
+
+# connection pool warm-up
+
+def count_connects(engine):
+    connects = []
+    event.listen(engine, 'connect', lambda dbapi_conn, record: connects.append(1))
+    return connects
+
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_warm_up_connects_every_bind(tmp_path, parallel):
+    app, db, ext = make_db(tmp_path, ['replica1'],
+                           SQLALCHEMY_WARMUP_CONNECTIONS=2,
+                           SQLALCHEMY_WARMUP_PARALLEL=parallel)
+    connects = count_connects(db.get_engine('replica1'))
+    assert ext.warm_up() == {None: 2, 'replica1': 2}
+    assert len(connects) == 2
+    assert ext.warm_up(connections=1, bind_keys=['replica1']) == {'replica1': 1}
+
+
+def test_warm_up_reports_failed_bind(tmp_path):
+    app, db, ext = make_db(tmp_path, SQLALCHEMY_BINDS={
+        'broken': 'sqlite:///%s' % (tmp_path / 'missing' / 'broken.db')})
+    report = ext.warm_up()
+    assert report[None] == 1
+    assert isinstance(report['broken'], Exception)
+
+
+def test_discard_inherited_pools_replaces_pools(tmp_path):
+    app, db, ext = make_db(tmp_path, ['replica1'])
+    pools = [db.get_engine(k).pool for k in (None, 'replica1')]
+    ext.discard_inherited_pools()
+    for bind_key, pool in zip((None, 'replica1'), pools):
+        assert db.get_engine(bind_key).pool is not pool
+    assert rows(db, 'select count(*) from event') == [(0,)]
+
+
+def test_post_fork_warms_up_new_pool(tmp_path):
+    app, db, ext = make_db(tmp_path)
+    connects = count_connects(db.get_engine())
+    ext.post_fork()
+    assert len(connects) == 1
+
+
+@pytest.mark.skipif(not hasattr(os, 'register_at_fork'), reason='os.register_at_fork')
+def test_forked_child_does_not_reuse_parent_pool(tmp_path):
+    app, db, ext = make_db(tmp_path, SQLALCHEMY_WARMUP_AFTER_FORK=True)
+    pool = db.get_engine().pool
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.write(write, b'1' if db.get_engine().pool is not pool else b'0')
+        finally:
+            os._exit(0)
+    os.close(write)
+    os.waitpid(pid, 0)
+    assert os.read(read, 1) == b'1'
+    os.close(read)
+    assert db.get_engine().pool is pool
+
+
+# appctx teardown
+
+def count_resets(monkeypatch, db):
+    resets = []
+    reset = db.reset
+    monkeypatch.setattr(db, 'reset', lambda: resets.append(1) or reset())
+    return resets
+
+
+def test_teardown_skips_idle_appctx(tmp_path, monkeypatch):
+    app, db, ext = make_db(tmp_path)
+    resets = count_resets(monkeypatch, db)
+    with app.app_context():
+        pass
+    assert resets == []
+
+    with app.app_context():
+        db.session.query(Event).all()
+    assert resets == [1]
+    assert not db.session.registry.has()
+
+
+def test_teardown_removes_shard_session(tmp_path, monkeypatch):
+    app, db, ext = make_db(tmp_path, ['s0'], SQLALCHEMY_SHARD_BINDS=['s0'])
+    resets = count_resets(monkeypatch, db)
+    with app.app_context():
+        ext.shard_session.query(Order).filter(Order.user_id == 1).all()
+    assert resets == [1]
+    assert not ext._shard_session.registry.has()
+
+
+def test_teardown_always_resets_when_skip_disabled(tmp_path, monkeypatch):
+    app, db, ext = make_db(tmp_path, SQLALCHEMY_SKIP_IDLE_TEARDOWN=False)
+    resets = count_resets(monkeypatch, db)
+    with app.app_context():
+        pass
+    assert resets == [1]
+
+
+# stream_query
+
+@pytest.fixture
+def streamed(tmp_path):
+    app, db, ext = make_db(tmp_path, ['replica1'])
+    for bind_key in (None, 'replica1'):
+        db.get_engine(bind_key).execute(Event.__table__.insert(), [
+            {'id': i + 1, 'name': '%s%d' % (bind_key or 'e', i)} for i in range(5)])
+    return app, db, ext
+
+
+def checked_out(engine):
+    """ 借出未归还的连接 """
+    connections = set()
+    event.listen(engine, 'checkout', lambda dbapi_conn, record, proxy:
+                 connections.add(id(record)))
+    event.listen(engine, 'checkin', lambda dbapi_conn, record:
+                 connections.discard(id(record)))
+    return connections
+
+
+def test_stream_query_formats(streamed):
+    app, db, ext = streamed
+    with app.test_request_context():
+        query = db.session.query(Event.id, Event.name).order_by(Event.id)
+        rv = ext.stream_query(query, format='csv', batch_size=2,
+                              filename='events.csv')
+        assert rv.mimetype == 'text/csv'
+        assert rv.headers['Content-Disposition'] == 'attachment; filename="events.csv"'
+        chunks = list(rv.response)
+        # 列名 + 3 批
+        assert len(chunks) == 4
+        assert b''.join(chunks).decode('utf8').splitlines()[:2] == ['id,name', '1,e0']
+
+        rv = ext.stream_query(query.limit(2))
+        assert [json.loads(line) for line in rv.get_data().splitlines()] == \
+            [{'id': 1, 'name': 'e0'}, {'id': 2, 'name': 'e1'}]
+
+        rv = ext.stream_query(select([Event.id]).where(Event.id < 3),
+                              format='msgpack')
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(rv.get_data())
+        assert list(unpacker) == [['id'], [1], [2]]
+
+        with pytest.raises(ValueError):
+            ext.stream_query(query, format='xml')
+
+
+def test_stream_query_uses_bind(streamed):
+    app, db, ext = streamed
+    with app.test_request_context():
+        query = db.session.query(Event.name).filter(Event.id == 1)
+        with ext.use_bind('replica1'):
+            rv = ext.stream_query(query)
+        assert rv.get_data() == b'{"name": "replica10"}\n'
+        rv = ext.stream_query(query, bind_key='replica1')
+        assert rv.get_data() == b'{"name": "replica10"}\n'
+
+
+def test_stream_query_releases_connection(streamed):
+    app, db, ext = streamed
+    connections = checked_out(db.get_engine())
+    with app.test_request_context():
+        query = db.session.query(Event.id)
+        rv = ext.stream_query(query, batch_size=1)
+        assert len(connections) == 1
+        # 客户端断开：只读了一部分
+        iterator = iter(rv.response)
+        next(iterator)
+        rv.close()
+        assert not connections
+
+        # 响应未被迭代
+        rv = ext.stream_query(query)
+        rv.close()
+        assert not connections
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import os
+
+import pytest
+from flask import Flask
+
+from qianka.flaskext.staticfiles import (
+    PrecompressedFiles, fingerprint_directory, load_fingerprints, precompress,
+    write_fingerprints)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SCRIPT = b'function hello() { return "hello world"; }\n' * 20
+
+
+@pytest.fixture
+def directory(tmp_path):
+    (tmp_path / 'app.0123abcd.js').write_bytes(SCRIPT)
+    (tmp_path / 'plain.js').write_bytes(SCRIPT)
+    (tmp_path / 'tiny.css').write_bytes(b'a{}')
+    (tmp_path / 'logo.png').write_bytes(b'\x89PNG' + b'\0' * 100)
+    return tmp_path
+
+
+def make_client(directory, **kwargs):
+    here = os.path.dirname(os.path.abspath(__file__))
+    app = Flask(__name__, root_path=here, instance_path=here)
+    files = PrecompressedFiles(str(directory), **kwargs)
+    app.add_url_rule('/assets/<path:filename>', 'assets', files.send)
+    return app.test_client()
+
+
+def test_precompress_writes_smaller_text_files(directory):
+    written = precompress(str(directory))
+    names = set(os.listdir(str(directory)))
+    assert 'app.0123abcd.js.gz' in names and 'plain.js.gz' in names
+    # 压缩后不更小的文件和非文本文件不压缩
+    assert 'tiny.css.gz' not in names
+    assert 'logo.png.gz' not in names
+    assert written == (4 if brotli is not None else 2)
+    with gzip.open(str(directory / 'plain.js.gz')) as f:
+        assert f.read() == SCRIPT
+    # 已是最新的跳过
+    assert precompress(str(directory)) == 0
+
+
+def test_send_prefers_precompressed_file(directory):
+    precompress(str(directory))
+    client = make_client(directory)
+    rv = client.get('/assets/plain.js', headers={'Accept-Encoding': 'gzip'})
+    assert rv.headers['Content-Encoding'] == 'gzip'
+    assert rv.headers['Vary'] == 'Accept-Encoding'
+    assert rv.mimetype.endswith('javascript')
+    assert gzip.decompress(rv.data) == SCRIPT
+
+    rv = client.get('/assets/plain.js')
+    assert 'Content-Encoding' not in rv.headers
+    assert rv.data == SCRIPT
+
+    if brotli is not None:
+        rv = client.get('/assets/plain.js', headers={'Accept-Encoding': 'gzip, br'})
+        assert rv.headers['Content-Encoding'] == 'br'
+        assert brotli.decompress(rv.data) == SCRIPT
+
+
+@pytest.mark.parametrize('memory_cache_size', [0, 8])
+def test_send_etag_from_content(directory, memory_cache_size):
+    precompress(str(directory))
+    client = make_client(directory, memory_cache_size=memory_cache_size)
+    rv = client.get('/assets/plain.js')
+    etag = rv.headers['ETag'].strip('"')
+    assert etag == hashlib.md5(SCRIPT).hexdigest()
+    gzipped = client.get('/assets/plain.js', headers={'Accept-Encoding': 'gzip'})
+    assert gzipped.headers['ETag'] != rv.headers['ETag']
+
+    # mtime 变化但内容不变（如部署到另一台机器），ETag 不变
+    os.utime(str(directory / 'plain.js'), (1, 1))
+    rv = client.get('/assets/plain.js', headers={'If-None-Match': '"%s"' % etag})
+    assert rv.status_code == 304
+
+    (directory / 'plain.js').write_bytes(b'changed')
+    rv = client.get('/assets/plain.js', headers={'If-None-Match': '"%s"' % etag})
+    assert rv.status_code == 200
+    assert rv.data == b'changed'
+
+
+def test_send_cache_control(directory):
+    client = make_client(directory, max_age=lambda filename: 60)
+    rv = client.get('/assets/app.0123abcd.js')
+    assert rv.headers['Cache-Control'] == 'public, max-age=31536000, immutable'
+    rv = client.get('/assets/plain.js')
+    assert 'immutable' not in rv.headers['Cache-Control']
+    assert 'max-age=60' in rv.headers['Cache-Control']
+
+
+def test_send_missing_file(directory):
+    client = make_client(directory)
+    assert client.get('/assets/missing.js').status_code == 404
+    assert client.get('/assets/../secret').status_code == 404
+
+
+
+def test_fingerprints_roundtrip(directory):
+    precompress(str(directory))
+    (directory / 'css').mkdir()
+    (directory / 'css' / 'site.css').write_bytes(b'body{}')
+    (directory / '.hidden').write_bytes(b'x')
+    fingerprints = fingerprint_directory(str(directory), length=8)
+    assert sorted(fingerprints) == ['app.0123abcd.js', 'css/site.css', 'logo.png',
+                                    'plain.js', 'tiny.css']
+    assert fingerprints['css/site.css'] == hashlib.md5(b'body{}').hexdigest()[:8]
+
+    path = str(directory / 'fingerprints.json')
+    write_fingerprints(path, fingerprints)
+    assert load_fingerprints(path) == fingerprints